@@ -1,25 +1,236 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import json
 import base64
 import io
-from PIL import Image
+import codecs
+import tempfile
 import os
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Iterator, Iterable, Tuple, Callable
 import time
+import math
+import re
+import heapq
 import uuid
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import queue
+import zlib
+import struct
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import socket
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
 
-# Cấu hình trang
-st.set_page_config(
-    page_title="AI Chat Assistant",
-    page_icon="🤖",
-    layout="wide",
-    initial_sidebar_state="collapsed"
+# Địa chỉ AgentRouter, có thể trỏ sang mock server khi chạy offline
+DEFAULT_BASE_URL = os.environ.get("AGENTROUTER_BASE_URL", "https://agentrouter.org")
+
+# Khoảng cách tối thiểu (giây) giữa hai lần vẽ lại câu trả lời đang stream
+STREAM_RENDER_INTERVAL = 0.05
+
+# Số kết nối keep-alive tối đa tới upstream (một pool dùng chung cho mọi client)
+HTTP_POOL_SIZE = int(os.environ.get("AGENTROUTER_POOL_SIZE", "10"))
+
+# Bật HTTP/2 (cần cài httpx[http2]), mặc định dùng HTTP/1.1 qua requests
+HTTP2_ENABLED = os.environ.get("AGENTROUTER_HTTP2", "").lower() in ("1", "true", "yes")
+
+# Body request: bytes đã serialize của từng message được cache (giới hạn RAM) để lịch sử dài có ảnh
+# không phải encode lại mỗi lượt; nén gzip (Content-Encoding) chỉ bật khi upstream nhận, cho body đủ lớn
+PAYLOAD_CACHE_BYTES = int(os.environ.get("PAYLOAD_CACHE_MB", "128")) * 1024 * 1024
+REQUEST_GZIP = os.environ.get("REQUEST_GZIP", "").lower() in ("1", "true", "yes")
+REQUEST_GZIP_MIN_BYTES = 64 * 1024
+REQUEST_GZIP_LEVEL = 6
+
+# Khởi động nóng ở lần tải trang đầu: import trước module nặng, mở sẵn kết nối upstream rồi giữ nó
+# bằng request nhẹ mỗi WARMUP_KEEPALIVE giây (0 = không giữ) khi còn người dùng trong WARMUP_IDLE giây
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") != "0"
+WARMUP_KEEPALIVE = float(os.environ.get("WARMUP_KEEPALIVE", "50"))
+WARMUP_IDLE = float(os.environ.get("WARMUP_IDLE", "900"))
+WARMUP_MODULES = ("PIL.Image", "PIL.ImageOps", "pyarrow.csv", "pyarrow.compute", "pandas")
+
+# Timeout kết nối/đọc (giây) cho request tới upstream
+CONNECT_TIMEOUT = float(os.environ.get("AGENTROUTER_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.environ.get("AGENTROUTER_READ_TIMEOUT", "120"))
+
+# Thử lại lỗi tạm thời: số lần thử, backoff lũy thừa có jitter và các mã HTTP được thử lại
+RETRY_MAX_ATTEMPTS = int(os.environ.get("AGENTROUTER_RETRIES", "3"))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504, 529}
+# Mã lỗi do hạn mức của API key: vẫn thử lại nhưng không tính vào circuit breaker (dùng chung mọi key)
+KEY_LIMIT_STATUSES = {429}
+
+# Circuit breaker theo model: số lỗi liên tiếp để ngắt và thời gian (giây) trước khi thử lại
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30.0
+
+# Chuỗi model dự phòng khi model chính lỗi liên tục
+MODEL_FALLBACKS = {
+    "claude-opus-4-1-20250805": ["claude-opus-4-20250514", "claude-sonnet-4-20250514", "claude-3-5-haiku-20241022"],
+    "claude-opus-4-20250514": ["claude-sonnet-4-20250514", "claude-3-5-haiku-20241022"],
+    "claude-sonnet-4-20250514": ["claude-3-5-haiku-20241022"],
+    "gpt-5": ["claude-sonnet-4-20250514"],
+}
+
+# Hedged request (tùy chọn): chưa có response sau percentile TTFB gần đây của model thì gửi thêm một request
+# tới cùng model hoặc model thay thế (HEDGE_ALTERNATES, JSON {"model": "model thay thế"}), lấy cái về trước.
+# Ngân sách: mỗi request được tính thêm HEDGE_BUDGET lượt hedge, tích tối đa HEDGE_BURST
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.25
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.05"))
+HEDGE_BURST = 10
+HEDGE_ALTERNATES = json.loads(os.environ.get("HEDGE_ALTERNATES", "{}"))
+
+# Số liệu hiệu năng: port endpoint Prometheus (0 = tắt), file log JSONL (để trống = tắt)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LOG = os.environ.get("METRICS_LOG", "")
+METRICS_SAMPLES = 2048
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRIC_BUCKETS = {
+    "request_bytes": (1e3, 1e4, 1e5, 1e6, 1e7),
+    "response_bytes": (1e3, 1e4, 1e5, 1e6, 1e7),
+    "connect_seconds": (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+    "ttfb_seconds": LATENCY_BUCKETS,
+    "ttft_seconds": LATENCY_BUCKETS,
+    "latency_seconds": LATENCY_BUCKETS,
+    "prompt_tokens": (100, 1000, 10000, 50000, 100000, 200000),
+    "completion_tokens": (10, 100, 500, 1000, 4000, 10000),
+    "tokens_per_second": (1, 5, 10, 25, 50, 100, 200),
+    "queue_seconds": LATENCY_BUCKETS,
+    "cache_read_tokens": (100, 1000, 10000, 50000, 100000, 200000),
+    "cache_write_tokens": (100, 1000, 10000, 50000, 100000, 200000),
+}
+
+# Điều phối request lên upstream cho cả process: số request đồng thời, hạn mức mỗi API key
+# (request/phút, 0 = không giới hạn) và burst, thời gian chờ tối đa trong hàng đợi
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", "8"))
+RATE_LIMIT_RPM = float(os.environ.get("RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "10"))
+SCHEDULER_MAX_WAIT = float(os.environ.get("SCHEDULER_MAX_WAIT", "120"))
+SCHEDULER_REPORT_INTERVAL = 0.5
+
+# Lượt sinh chạy nền, sống qua rerun: số luồng worker, thời gian tối đa mỗi lượt (giây, tính cả lúc
+# xếp hàng) và thời gian giữ kết quả chưa được session nào nhận về (giây)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "32"))
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", "300"))
+JOB_RETENTION = 600
+
+# Tiền xử lý ảnh: cạnh dài tối đa mặc định, định dạng nén lại (JPEG/WEBP) và chất lượng
+DEFAULT_MAX_IMAGE_SIDE = 1568
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+IMAGE_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_MB", "64")) * 1024 * 1024
+
+# File text lớn: đọc theo khối, cắt đoạn theo dòng/record, giữ nội dung trong file tạm khi vượt ngưỡng RAM
+TEXT_READ_BYTES = 1024 * 1024
+TEXT_CHUNK_CHARS = 4000
+TEXT_SPOOL_BYTES = int(os.environ.get("TEXT_SPOOL_MB", "4")) * 1024 * 1024
+TEXT_SPOOL_DIR = os.environ.get("TEXT_SPOOL_DIR", "")
+TEXT_DOCUMENTS_MAX = 64
+TEXT_ATTACH_CHARS = 12000
+
+# Hồ sơ CSV: số dòng mỗi lô đọc, số giá trị phổ biến, số dòng mẫu, số mẫu giữ để tính phân vị
+CSV_CHUNK_ROWS = 250000
+CSV_TOP_K = 5
+CSV_SAMPLE_ROWS = 12
+CSV_RESERVOIR_ROWS = 2000
+CSV_MAX_TRACKED_VALUES = 1000
+
+# Trích xuất PDF trong process pool: số process, số trang mỗi tác vụ, cache text theo trang, chu kỳ cập nhật tiến độ
+PDF_POOL_SIZE = int(os.environ.get("PDF_POOL_SIZE", str(min(2, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = 8
+PDF_CACHE_BYTES = int(os.environ.get("PDF_CACHE_MB", "64")) * 1024 * 1024
+PDF_POLL_INTERVAL = 1.0
+
+# Kho blob cho file upload: giới hạn RAM và thư mục tràn xuống đĩa (disk /data trên Render).
+# Session không chạy lại script quá BLOB_REF_TTL giây (tab đã đóng) thì trả hết tham chiếu blob của nó
+BLOB_MEMORY_BYTES = int(os.environ.get("BLOB_MEMORY_MB", "256")) * 1024 * 1024
+BLOB_REF_TTL = float(os.environ.get("BLOB_REF_TTL", str(6 * 3600)))
+BLOB_SWEEP_INTERVAL = 60.0
+DATA_DIR = os.environ.get("DATA_DIR", "/data")
+BLOB_SPILL_DIR = os.environ.get("BLOB_SPILL_DIR", os.path.join(DATA_DIR, "blobs") if os.path.isdir(DATA_DIR) else "")
+
+# SQLite lưu hội thoại trên disk /data (để trống để tắt), số trang tải lại khi resume
+CONVERSATION_DB = os.environ.get("CONVERSATION_DB", os.path.join(DATA_DIR, "conversations.db") if os.path.isdir(DATA_DIR) else "")
+RESUME_PAGES = 5
+
+# Trạng thái dùng chung giữa nhiều replica (hội thoại, blob, hạn mức theo API key, cache phản hồi):
+# memory:// (trong process), sqlite:///data/state.db (file trên disk dùng chung) hoặc redis://host:6379/0.
+# Để trống thì mỗi process tự giữ như trước (hội thoại ở CONVERSATION_DB). Blob chưa gắn với hội thoại
+# đã lưu hết hạn sau SHARED_BLOB_TTL giây. Mỗi lệnh tới Redis chờ tối đa STATE_BACKEND_TIMEOUT giây;
+# hạn mức dùng chung lỗi thì dùng bucket cục bộ trong STATE_BACKEND_RETRY giây trước khi thử lại backend
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "")
+STATE_BACKEND_TIMEOUT = float(os.environ.get("STATE_BACKEND_TIMEOUT", "2"))
+STATE_BACKEND_RETRY = 10.0
+SHARED_BLOB_TTL = 7 * 24 * 3600
+
+# Danh mục model lấy từ /v1/models: thời gian sống (giây), chờ trước khi thử lại khi lỗi,
+# timeout đọc và snapshot trên disk để lần khởi động sau có ngay danh mục
+MODEL_CATALOG_TTL = int(os.environ.get("MODEL_CATALOG_TTL", "3600"))
+MODEL_CATALOG_RETRY = 60
+MODEL_CATALOG_TIMEOUT = 10.0
+MODEL_CATALOG_SNAPSHOT = os.environ.get(
+    "MODEL_CATALOG_SNAPSHOT", os.path.join(DATA_DIR, "models.json") if os.path.isdir(DATA_DIR) else ""
+)
+
+# Cache phản hồi cho request tất định (temperature=0 hoặc khi người dùng bật)
+RESPONSE_CACHE_ENTRIES = int(os.environ.get("RESPONSE_CACHE_ENTRIES", "1000"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "")
+
+# Chế độ so sánh: số model tối đa mỗi lượt và số luồng dùng chung cho mọi session
+COMPARE_MAX_MODELS = 4
+COMPARE_POOL_SIZE = int(os.environ.get("COMPARE_POOL_SIZE", "16"))
+
+# Ước lượng token cho context window: ký tự/token, chi phí mỗi ảnh và mỗi message
+CHARS_PER_TOKEN = 3
+IMAGE_TOKEN_ESTIMATE = 1600
+MESSAGE_TOKEN_OVERHEAD = 4
+DEFAULT_CONTEXT_WINDOW = 128000
+
+# Tìm đoạn liên quan (BM25) trong tài liệu đính kèm và các lượt cũ: số đoạn tối đa và ngân sách token
+RETRIEVAL_TOP_K = 5
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", "2000"))
+RETRIEVED_CONTEXT_HEADER = "📚 Đoạn liên quan từ tài liệu và hội thoại trước:"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Prompt caching kiểu Anthropic (cache_control) cho model có capability "prompt_caching":
+# số breakpoint tối đa mỗi request và độ dài prefix tối thiểu (token) mà provider chịu cache
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE", "1") != "0"
+PROMPT_CACHE_MAX_BREAKPOINTS = 4
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Số tin nhắn mỗi trang lịch sử; các trang cũ chỉ được render khi người dùng bấm xem thêm
+HISTORY_PAGE_SIZE = 20
+
+# st.fragment (Streamlit >= 1.37) cho phép rerun riêng phần lịch sử; bản cũ render bình thường
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+# Fragment tự chạy lại định kỳ để cập nhật tiến độ; bản cũ chỉ cập nhật ở lần rerun sau
+_polling_fragment = (
+    (lambda func: st.fragment(func, run_every=PDF_POLL_INTERVAL)) if hasattr(st, "fragment") else (lambda func: func)
 )
 
-# CSS tùy chỉnh giống Claude.ai
-st.markdown("""
-<style>
+# Cấu hình trang, áp dụng ở đầu main() để import app (benchmark, script phụ) không đụng tới UI
+PAGE_CONFIG = {
+    "page_title": "AI Chat Assistant",
+    "page_icon": "🤖",
+    "layout": "wide",
+    "initial_sidebar_state": "collapsed"
+}
+
+# CSS tùy chỉnh giống Claude.ai (bản rút gọn được tính một lần cho cả process, xem get_page_style)
+PAGE_CSS = """
     /* Hide Streamlit elements */
     #MainMenu {visibility: hidden;}
     footer {visibility: hidden;}
@@ -272,72 +483,3020 @@ st.markdown("""
         margin-bottom: 0.5rem;
     }
     
+    /* Compare mode */
+    .compare-grid {
+        display: grid;
+        grid-template-columns: repeat(auto-fit, minmax(260px, 1fr));
+        gap: 1rem;
+    }
+
+    .compare-grid .message-bubble {
+        max-width: 100%;
+    }
+
+    .compare-latency {
+        font-size: 0.75rem;
+        color: #999;
+        margin-top: 0.5rem;
+    }
+
     /* Content spacing for fixed input */
     .main-content {
         padding-bottom: 120px;
     }
-</style>
-""", unsafe_allow_html=True)
+"""
+
+class LRUCache:
+    """Cache LRU an toàn luồng, giới hạn theo số phần tử và (tùy chọn) tổng số byte"""
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._sizeof(self._data.pop(key))
+            self._data[key] = value
+            self._bytes += self._sizeof(value)
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= self._sizeof(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self._bytes -= self._sizeof(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Ảnh đã tiền xử lý, key theo (sha256, max_side, format, quality)
+_image_cache = LRUCache(max_entries=256, max_bytes=IMAGE_CACHE_BYTES, sizeof=lambda value: len(value[0]))
+
+
+def detect_encoding(head: bytes) -> str:
+    """Đoán encoding từ phần đầu file: BOM, UTF-8, rồi charset_normalizer nếu có"""
+    boms = (
+        (codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),
+        (codecs.BOM_UTF8, "utf-8-sig"),
+        (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"),
+    )
+    for bom, encoding in boms:
+        if head.startswith(bom):
+            return encoding
+
+    try:
+        # final=False: ký tự nhiều byte bị cắt ở cuối phần đầu không bị tính là lỗi
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    try:
+        from charset_normalizer import from_bytes
+        match = from_bytes(head).best()
+        if match is not None:
+            return match.encoding
+    except ImportError:
+        pass
+    return "cp1252"
+
+
+def _chunk_boundary(text: str, start: int, end: int, csv_records: bool, in_quotes: bool) -> int:
+    """Vị trí cắt đoạn trong text[start:end]: sau dòng cuối cùng (CSV: không nằm trong ô có ngoặc kép)"""
+    cut = text.rfind("\n", start, end)
+    while cut != -1 and csv_records and (text.count('"', start, cut) + in_quotes) % 2:
+        cut = text.rfind("\n", start, cut)
+    if cut != -1:
+        return cut + 1
+    if not csv_records:
+        # Một dòng quá dài (vd. JSON không xuống dòng): cắt sau dấu phẩy/khoảng trắng gần nhất
+        cut = max(text.rfind(",", start, end), text.rfind(" ", start, end))
+        if cut != -1:
+            return cut + 1
+    return end
+
+
+def iter_text_chunks(stream, encoding: str, chunk_chars: int = TEXT_CHUNK_CHARS,
+                     csv_records: bool = False, read_bytes: int = TEXT_READ_BYTES) -> Iterator[str]:
+    """Giải mã stream từng khối và trả về các đoạn khoảng chunk_chars ký tự, cắt theo dòng/record"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    buffer = ""
+    in_quotes = False
+    final = False
+    while not final:
+        block = stream.read(read_bytes)
+        final = not block
+        buffer += decoder.decode(block, final=final)
+
+        start = 0
+        while len(buffer) - start > chunk_chars or (final and start < len(buffer)):
+            end = min(start + chunk_chars, len(buffer))
+            if end < len(buffer):
+                end = _chunk_boundary(buffer, start, end, csv_records, in_quotes)
+            chunk = buffer[start:end]
+            if csv_records and chunk.count('"') % 2:
+                in_quotes = not in_quotes
+            yield chunk
+            start = end
+        buffer = buffer[start:]
+
+
+class TextDocument:
+    """File text đã giải mã, lưu UTF-8 trong file tạm (RAM tới TEXT_SPOOL_BYTES rồi tràn xuống đĩa), đọc theo đoạn"""
+    def __init__(self, name: str, encoding: str, csv_records: bool = False):
+        self.name = name
+        self.encoding = encoding
+        self.csv_records = csv_records
+        self.header = ""
+        self.chars = 0
+        self.size = 0
+        self._offsets = []
+        self._file = tempfile.SpooledTemporaryFile(max_size=TEXT_SPOOL_BYTES, dir=TEXT_SPOOL_DIR or None)
+        self._hash = hashlib.sha256()
+        self._lock = threading.Lock()
+
+    def append(self, chunk: str):
+        data = chunk.encode("utf-8")
+        with self._lock:
+            if not self._offsets and self.csv_records:
+                self.header = chunk.split("\n", 1)[0].rstrip("\r")
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._offsets.append((self.size, len(data)))
+            self.size += len(data)
+            self.chars += len(chunk)
+            self._hash.update(data)
+
+    def chunk(self, index: int) -> str:
+        offset, length = self._offsets[index]
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length).decode("utf-8")
+
+    @property
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def spilled(self) -> bool:
+        return bool(getattr(self._file, "_rolled", False))
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def close(self):
+        self._file.close()
+
+
+# Tài liệu text đã nạp, key theo digest nội dung; tài liệu bị đẩy ra thì file tạm được xóa khi GC
+_text_documents = LRUCache(max_entries=TEXT_DOCUMENTS_MAX)
+
+
+def ingest_text_file(stream, name: str, media_type: str, chunk_chars: int = TEXT_CHUNK_CHARS) -> TextDocument:
+    """Nạp file text/JSON/CSV theo từng khối, không đọc cả file vào RAM; trả về tài liệu dùng chung theo digest"""
+    head = stream.read(64 * 1024)
+    stream.seek(0)
+    document = TextDocument(name, detect_encoding(head), csv_records=media_type == "text/csv")
+    for chunk in iter_text_chunks(stream, document.encoding, chunk_chars, document.csv_records):
+        document.append(chunk)
+
+    return _register_document(document)
+
+
+def _register_document(document: TextDocument) -> TextDocument:
+    """Đưa tài liệu vào kho dùng chung; nội dung đã có thì dùng bản cũ"""
+    existing = _text_documents.get(document.digest)
+    if existing is not None:
+        document.close()
+        return existing
+    _text_documents.set(document.digest, document)
+    return document
+
+
+def get_text_document(digest: str) -> Optional[TextDocument]:
+    return _text_documents.get(digest)
+
+
+class _ColumnProfile:
+    """Thống kê gộp dần qua các lô của một cột CSV (giá trị phổ biến chỉ giữ tối đa CSV_MAX_TRACKED_VALUES)"""
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.kind = None
+        self.total = 0.0
+        self.squares = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.values = {}
+        self.distinct_capped = False
+
+    def _set_kind(self, kind: str):
+        # Cột đổi kiểu giữa các lô (vd. số rồi gặp chữ) thì coi là text
+        self.kind = kind if self.kind in (None, kind) else "text"
+
+    def _merge_range(self, low, high):
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+
+    def _merge_counts(self, values, counts, distinct: int):
+        if distinct > CSV_MAX_TRACKED_VALUES:
+            self.distinct_capped = True
+        for value, count in zip(values, counts):
+            self.values[value] = self.values.get(value, 0) + count
+        if len(self.values) > CSV_MAX_TRACKED_VALUES:
+            self.distinct_capped = True
+            self.values = dict(heapq.nlargest(CSV_MAX_TRACKED_VALUES, self.values.items(), key=lambda item: item[1]))
+
+    def update_arrow(self, array, pa, pc):
+        self.count += len(array)
+        self.nulls += array.null_count
+        if array.null_count == len(array):
+            return
+
+        if pa.types.is_integer(array.type) or pa.types.is_floating(array.type) or pa.types.is_decimal(array.type):
+            self._set_kind("số")
+            values = pc.cast(array, pa.float64())
+            bounds = pc.min_max(values)
+            self._merge_range(bounds["min"].as_py(), bounds["max"].as_py())
+            self.total += pc.sum(values).as_py() or 0.0
+            self.squares += pc.sum(pc.multiply(values, values)).as_py() or 0.0
+        elif pa.types.is_temporal(array.type):
+            self._set_kind("thời gian")
+            bounds = pc.min_max(array)
+            self._merge_range(str(bounds["min"].as_py()), str(bounds["max"].as_py()))
+        else:
+            self._set_kind("text")
+            counts = pc.value_counts(pc.cast(array, pa.string())).flatten()
+            values, frequencies = counts[0], counts[1]
+            if len(values) > CSV_MAX_TRACKED_VALUES:
+                top = pc.select_k_unstable(frequencies, CSV_MAX_TRACKED_VALUES, sort_keys=[("dummy", "descending")])
+                values, frequencies = pc.take(values, top), pc.take(frequencies, top)
+            self._merge_counts(values.to_pylist(), frequencies.to_pylist(), len(counts[0]))
+
+    def update_pandas(self, series, pd):
+        non_null = series.dropna()
+        self.count += len(series)
+        self.nulls += len(series) - len(non_null)
+        if non_null.empty:
+            return
+
+        if pd.api.types.is_numeric_dtype(non_null) and not pd.api.types.is_bool_dtype(non_null):
+            self._set_kind("số")
+            values = non_null.astype("float64")
+            self._merge_range(float(values.min()), float(values.max()))
+            self.total += float(values.sum())
+            self.squares += float((values * values).sum())
+        else:
+            self._set_kind("text")
+            counts = non_null.astype(str).value_counts()
+            top = counts.head(CSV_MAX_TRACKED_VALUES)
+            self._merge_counts(top.index.tolist(), top.tolist(), len(counts))
+
+    def summary(self, name: str, sample) -> Dict:
+        info = {"name": str(name), "nulls": self.nulls, "type": self.kind or "trống"}
+        non_null = self.count - self.nulls
+        if self.kind == "số" and non_null:
+            mean = self.total / non_null
+            median = sample[name].dropna().astype("float64").median() if sample is not None else None
+            info.update(
+                min=self.minimum, max=self.maximum, mean=mean,
+                std=math.sqrt(max(0.0, self.squares / non_null - mean * mean)),
+                median=None if median is None or median != median else float(median)
+            )
+        elif self.kind == "thời gian":
+            info.update(min=self.minimum, max=self.maximum)
+        elif self.kind == "text":
+            info["distinct"] = f"{len(self.values)}+" if self.distinct_capped else len(self.values)
+            info["top"] = heapq.nlargest(CSV_TOP_K, self.values.items(), key=lambda item: item[1])
+        return info
+
+
+def profile_csv(stream, encoding: str = "utf-8", chunk_rows: int = CSV_CHUNK_ROWS) -> Dict:
+    """Đọc CSV theo lô dạng cột và tính schema, null, thống kê số, top-k và mẫu phân tầng.
+
+    Dùng pyarrow.csv (có sẵn cùng Streamlit); file có kiểu cột không nhất quán giữa các lô
+    thì đọc lại bằng pandas theo chunksize.
+    """
+    import numpy as np
+    import pandas as pd
+
+    start = stream.tell()
+    try:
+        return _profile_batches(_arrow_batches(stream, encoding), np, pd)
+    except (ImportError, ValueError, TypeError):
+        # pyarrow.lib.ArrowInvalid là ValueError: vd. cột được đoán là số nhưng lô sau có chữ
+        stream.seek(start)
+        batches = pd.read_csv(stream, encoding=encoding, chunksize=chunk_rows, encoding_errors="replace")
+        return _profile_batches(((chunk, None) for chunk in batches), np, pd)
+
+
+def _arrow_batches(stream, encoding: str):
+    """Các lô (RecordBatch, module pyarrow) đọc bằng pyarrow.csv: dạng cột, nhiều luồng"""
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    reader = pa_csv.open_csv(
+        stream,
+        read_options=pa_csv.ReadOptions(
+            encoding="utf8" if encoding.lower().replace("-", "") in ("utf8", "utf8sig") else encoding,
+            block_size=16 * 1024 * 1024
+        )
+    )
+    for batch in reader:
+        yield batch, pa
+
+
+def _profile_batches(batches, np, pd) -> Dict:
+    rng = np.random.default_rng(0)
+    columns = {}
+    sample = None
+    threshold = 1.0
+    rows = 0
+    for batch, pa in batches:
+        rows += batch.num_rows
+        if pa is not None:
+            import pyarrow.compute as pc
+            for name, array in zip(batch.schema.names, batch.columns):
+                columns.setdefault(name, _ColumnProfile()).update_arrow(array, pa, pc)
+        else:
+            for name in batch.columns:
+                columns.setdefault(name, _ColumnProfile()).update_pandas(batch[name], pd)
+
+        # Lấy mẫu đều theo khóa ngẫu nhiên nhỏ nhất (bottom-k): chỉ đổi sang pandas các dòng có thể vào mẫu
+        keys = rng.random(batch.num_rows)
+        picked = np.flatnonzero(keys < threshold)
+        if len(picked) > CSV_RESERVOIR_ROWS:
+            picked = picked[np.argpartition(keys[picked], CSV_RESERVOIR_ROWS)[:CSV_RESERVOIR_ROWS]]
+        if len(picked):
+            rows_df = batch.take(pa.array(picked)).to_pandas() if pa is not None else batch.iloc[picked]
+            rows_df = rows_df.assign(_sample_key=keys[picked])
+            sample = rows_df if sample is None else pd.concat([sample, rows_df], ignore_index=True)
+            sample = sample.nsmallest(CSV_RESERVOIR_ROWS, "_sample_key")
+            if len(sample) >= CSV_RESERVOIR_ROWS:
+                threshold = float(sample["_sample_key"].iloc[-1])
+
+    sample = sample.drop(columns="_sample_key").reset_index(drop=True) if sample is not None else None
+    profile = {
+        "rows": rows,
+        "columns": [column.summary(name, sample) for name, column in columns.items()],
+        "sample": "",
+        "stratified_by": None,
+    }
+
+    if sample is not None and len(sample):
+        # Phân tầng theo cột text có ít giá trị nhất (2-20), mỗi nhóm lấy số dòng theo tỉ lệ, ít nhất 1
+        strata = [
+            c for c in profile["columns"]
+            if c["type"] == "text" and isinstance(c["distinct"], int) and 2 <= c["distinct"] <= 20
+        ]
+        if strata:
+            column = min(strata, key=lambda c: c["distinct"])["name"]
+            groups = sample.groupby(sample[column].astype(str), sort=False)
+            shares = (groups.size() / len(sample) * CSV_SAMPLE_ROWS).clip(lower=1).round().astype(int)
+            sample = pd.concat([group.head(shares[key]) for key, group in groups])
+            profile["stratified_by"] = column
+        else:
+            sample = sample.head(CSV_SAMPLE_ROWS)
+        profile["sample"] = sample.to_csv(index=False)
+    return profile
+
+
+def format_csv_profile(name: str, profile: Dict) -> str:
+    """Hồ sơ CSV dạng text ngắn gọn để gửi kèm tin nhắn"""
+    def number(value):
+        return "-" if value is None else f"{value:.6g}"
+
+    lines = [f"📊 **Hồ sơ CSV: {name}** ({profile['rows']:,} dòng × {len(profile['columns'])} cột)"]
+    lines.append("| Cột | Kiểu | Null | Thống kê |")
+    lines.append("|---|---|---|---|")
+    for column in profile["columns"]:
+        if column["type"] == "số":
+            stats = (f"min {number(column['min'])}, max {number(column['max'])}, "
+                     f"TB {number(column['mean'])}, ĐLC {number(column['std'])}, trung vị≈{number(column['median'])}")
+        elif column["type"] == "text":
+            top = ", ".join(f"{value[:40]} ({count:,})" for value, count in column["top"])
+            stats = f"{column['distinct']} giá trị khác nhau; phổ biến: {top}"
+        elif column["type"] == "thời gian":
+            stats = f"min {column['min']}, max {column['max']}"
+        else:
+            stats = ""
+        lines.append(f"| {column['name']} | {column['type']} | {column['nulls']:,} | {stats} |")
+
+    if profile["sample"]:
+        strata = f", phân tầng theo `{profile['stratified_by']}`" if profile["stratified_by"] else ""
+        lines.append(f"\nMẫu dòng{strata}:\n```csv\n{profile['sample'].rstrip()}\n```")
+    return "\n".join(lines)
+
+
+# Hồ sơ CSV theo digest nội dung (từ TextDocument)
+_csv_profiles = LRUCache(max_entries=256)
+
+
+# Text từng trang PDF, key theo (sha256 file, số trang); số trang của file key theo (sha256, None)
+_pdf_page_cache = LRUCache(max_entries=50000, max_bytes=PDF_CACHE_BYTES,
+                           sizeof=lambda value: len(value) if isinstance(value, str) else 8)
+
+
+class PdfJob:
+    """Một lượt trích xuất PDF: tiến độ theo trang, tài liệu text khi xong"""
+    def __init__(self, digest: str, name: str, path: str = ""):
+        self.digest = digest
+        self.name = name
+        self.path = path
+        self.total = None
+        self.pages = {}
+        self.error = None
+        self.document = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.document is not None or self.error is not None
+
+    def progress(self) -> Tuple[int, Optional[int]]:
+        with self._lock:
+            return len(self.pages), self.total
+
+    def add_pages(self, start: int, texts: List[str]) -> bool:
+        """Ghi nhận các trang vừa xong, True nếu đã đủ mọi trang"""
+        with self._lock:
+            for offset, text in enumerate(texts):
+                self.pages[start + offset] = text
+                _pdf_page_cache.set((self.digest, start + offset), text)
+            return self.total is not None and len(self.pages) >= self.total
+
+    def finish(self):
+        """Ghép các trang thành TextDocument (đoạn theo trang) và xóa file tạm"""
+        document = TextDocument(self.name, "utf-8")
+        for index in range(self.total):
+            page = f"--- Trang {index + 1} ---\n{self.pages.get(index, '')}\n"
+            for chunk in iter_text_chunks(io.BytesIO(page.encode("utf-8")), "utf-8"):
+                document.append(chunk)
+        self.document = _register_document(document)
+        self.pages = {}
+        self.cleanup()
+
+    def fail(self, error: str):
+        self.error = error
+        self.cleanup()
+
+    def cleanup(self):
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = ""
+
+
+class PdfExtractor:
+    """Trích xuất text PDF trong process pool, không chặn luồng script của Streamlit.
+
+    Đếm trang trước, sau đó chia lô PDF_PAGES_PER_TASK trang; trang đã có trong cache thì không chạy lại.
+    """
+    def __init__(self, max_workers: int = PDF_POOL_SIZE, pages_per_task: int = PDF_PAGES_PER_TASK):
+        self.max_workers = max(1, max_workers)
+        self.pages_per_task = pages_per_task
+        self._executor = None
+        self._jobs = LRUCache(max_entries=64)
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: an toàn với server nhiều luồng (fork có thể kế thừa lock đang bị giữ)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def submit(self, data: bytes, name: str) -> str:
+        """Bắt đầu trích xuất (nếu chưa có), trả về digest dùng để theo dõi tiến độ"""
+        digest = hashlib.sha256(data).hexdigest()
+        job = self._jobs.get(digest)
+        if job is not None and job.error is None:
+            return digest
+
+        job = PdfJob(digest, name)
+        self._jobs.set(digest, job)
+
+        total = _pdf_page_cache.get((digest, None))
+        if total is not None:
+            cached = [_pdf_page_cache.get((digest, index)) for index in range(total)]
+            if all(text is not None for text in cached):
+                job.total = total
+                job.add_pages(0, cached)
+                job.finish()
+                return digest
+
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False, dir=TEXT_SPOOL_DIR or None) as f:
+            f.write(data)
+            job.path = f.name
+        try:
+            import pdf_worker
+            future = self._pool().submit(pdf_worker.count_pages, job.path)
+        except Exception as e:
+            job.fail(f"Không khởi động được trình đọc PDF: {e}")
+            return digest
+        future.add_done_callback(lambda f: self._on_counted(job, f))
+        return digest
+
+    def job(self, digest: str) -> Optional[PdfJob]:
+        return self._jobs.get(digest)
+
+    def _on_counted(self, job: PdfJob, future):
+        try:
+            job.total = future.result()
+        except Exception as e:
+            job.fail(f"Không đọc được PDF: {e}")
+            return
+
+        _pdf_page_cache.set((job.digest, None), job.total)
+        if job.total == 0:
+            job.finish()
+            return
+
+        import pdf_worker
+        for start in range(0, job.total, self.pages_per_task):
+            stop = min(start + self.pages_per_task, job.total)
+            cached = [_pdf_page_cache.get((job.digest, index)) for index in range(start, stop)]
+            if all(text is not None for text in cached):
+                if job.add_pages(start, cached):
+                    job.finish()
+                continue
+            try:
+                future = self._pool().submit(pdf_worker.extract_pages, job.path, start, stop)
+            except Exception as e:
+                job.fail(f"Không trích xuất được PDF: {e}")
+                return
+            future.add_done_callback(lambda f, start=start: self._on_pages(job, start, f))
+
+    def _on_pages(self, job: PdfJob, start: int, future):
+        if job.done:
+            return
+        try:
+            texts = future.result()
+        except Exception as e:
+            job.fail(f"Không trích xuất được PDF: {e}")
+            return
+        if job.add_pages(start, texts):
+            job.finish()
+
+
+def preprocess_image(image_bytes: bytes, max_side: int = DEFAULT_MAX_IMAGE_SIDE,
+                     image_format: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY) -> Tuple[bytes, str]:
+    """Thu nhỏ ảnh theo cạnh dài, bỏ EXIF và nén lại; kết quả được cache theo hash nội dung"""
+    key = (hashlib.sha256(image_bytes).hexdigest(), max_side, image_format, quality)
+    cached = _image_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Import khi cần: PIL chỉ dùng lúc có ảnh, không làm chậm lần chạy đầu (warm-up import sẵn ở nền)
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(image_bytes))
+    # Xoay theo EXIF trước khi bỏ metadata để ảnh không bị lệch hướng
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    if image_format == "JPEG":
+        # JPEG không có kênh alpha: ghép lên nền trắng
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality, optimize=True, exif=b"")
+    result = (buffer.getvalue(), f"image/{image_format.lower()}")
+    _image_cache.set(key, result)
+    return result
+
+
+def _redis_range(items: List, start: int, stop: int) -> List:
+    """Cắt danh sách theo ngữ nghĩa LRANGE của Redis: stop tính cả phần tử cuối, chỉ số âm tính từ cuối"""
+    length = len(items)
+    start = max(0, length + start) if start < 0 else start
+    stop = length + stop if stop < 0 else stop
+    if stop < 0:
+        return []
+    return items[start:stop + 1]
+
+
+class MemoryStateBackend:
+    """Backend trạng thái trong RAM của process, cùng giao diện với backend dùng chung.
+
+    Giao diện chung: giá trị bytes theo key (TTL tùy chọn), bộ đếm nguyên tử và danh sách chỉ thêm,
+    đủ để dựng hội thoại, blob, hạn mức và cache phản hồi trên mọi backend. shared cho biết
+    dữ liệu có ra khỏi process không: với backend trong RAM, BlobStore và ResponseCache không chép
+    thêm một bản (chúng đã có tầng RAM riêng có giới hạn).
+    """
+    shared = False
+    # Chu kỳ (giây) quét bỏ key hết hạn chưa được đọc lại, vd. bộ đếm hạn mức của các cửa sổ cũ
+    sweep_interval = 60.0
+
+    def __init__(self):
+        self._values = {}
+        self._lists = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self.sweep_interval
+
+    def _entry(self, key: str) -> Optional[Tuple[bytes, Optional[float]]]:
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entry(key)
+        return None if entry is None else entry[0]
+
+    def _sweep(self):
+        """Bỏ mọi key đã hết hạn, tối đa một lần mỗi sweep_interval (gọi khi đang giữ lock)"""
+        if time.monotonic() < self._next_sweep:
+            return
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        now = time.time()
+        for key in [key for key, (_, expires_at) in self._values.items()
+                    if expires_at is not None and expires_at <= now]:
+            del self._values[key]
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        with self._lock:
+            self._sweep()
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+            self._lists.pop(key, None)
+
+    def exists(self, key: str) -> bool:
+        with self._lock:
+            return self._entry(key) is not None or key in self._lists
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        """Đặt lại thời gian sống (None = giữ mãi); False nếu key không tồn tại"""
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return False
+            self._values[key] = (entry[0], time.time() + ttl if ttl else None)
+            return True
+
+    def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        """Tăng bộ đếm, trả về giá trị mới; ttl chỉ áp dụng khi bộ đếm vừa được tạo"""
+        with self._lock:
+            self._sweep()
+            entry = self._entry(key)
+            if entry is None:
+                value, expires_at = 1, time.time() + ttl if ttl else None
+            else:
+                value, expires_at = int(entry[0]) + 1, entry[1]
+            self._values[key] = (str(value).encode(), expires_at)
+            return value
+
+    def push(self, key: str, value: bytes) -> int:
+        with self._lock:
+            items = self._lists.setdefault(key, [])
+            items.append(value)
+            return len(items)
+
+    def range(self, key: str, start: int, stop: int) -> List[bytes]:
+        with self._lock:
+            return _redis_range(self._lists.get(key, []), start, stop)
+
+    def length(self, key: str) -> int:
+        with self._lock:
+            return len(self._lists.get(key, []))
+
+    def trim(self, key: str, keep: int):
+        """Chỉ giữ keep phần tử cuối của danh sách"""
+        with self._lock:
+            if key in self._lists:
+                self._lists[key] = self._lists[key][-keep:]
+
+
+class SQLiteStateBackend:
+    """Backend trạng thái trong một file SQLite (WAL), dùng chung giữa các process cùng thấy file đó"""
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS kv (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS list_items (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_list_items_key ON list_items(key, seq);
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Mỗi thread một connection như ConversationStore
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _expire_rows(self, conn: sqlite3.Connection):
+        # Dọn key hết hạn theo đợt thay vì mỗi lần ghi
+        self._writes += 1
+        if self._writes % 100 == 0:
+            conn.execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        # Bộ đếm của incr lưu dạng số nguyên
+        return str(row[0]).encode() if isinstance(row[0], int) else row[0]
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl if ttl else None)
+            )
+            self._expire_rows(conn)
+
+    def delete(self, key: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            conn.execute("DELETE FROM list_items WHERE key = ?", (key,))
+
+    def exists(self, key: str) -> bool:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT 1 FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row is not None or conn.execute("SELECT 1 FROM list_items WHERE key = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE kv SET expires_at = ? WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (now + ttl if ttl else None, key, now)
+            )
+            return cursor.rowcount > 0
+
+    def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        with self._connect() as conn:
+            # Upsert một câu lệnh nên nguyên tử giữa các process; bộ đếm hết hạn thì bắt đầu lại từ 1
+            conn.execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, 1, ?) ON CONFLICT(key) DO UPDATE SET "
+                "value = CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN 1 ELSE CAST(value AS INTEGER) + 1 END, "
+                "expires_at = CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN excluded.expires_at ELSE expires_at END",
+                (key, now + ttl if ttl else None, now, now)
+            )
+            value = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()[0]
+            self._expire_rows(conn)
+        return int(value)
+
+    def push(self, key: str, value: bytes) -> int:
+        with self._connect() as conn:
+            conn.execute("INSERT INTO list_items (key, value) VALUES (?, ?)", (key, value))
+            return conn.execute("SELECT COUNT(*) FROM list_items WHERE key = ?", (key,)).fetchone()[0]
+
+    def range(self, key: str, start: int, stop: int) -> List[bytes]:
+        if start >= 0 and stop >= 0:
+            rows = self._connect().execute(
+                "SELECT value FROM list_items WHERE key = ? ORDER BY seq LIMIT ? OFFSET ?",
+                (key, max(0, stop - start + 1), start)
+            ).fetchall()
+            return [row[0] for row in rows]
+        rows = self._connect().execute("SELECT value FROM list_items WHERE key = ? ORDER BY seq", (key,)).fetchall()
+        return _redis_range([row[0] for row in rows], start, stop)
+
+    def length(self, key: str) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM list_items WHERE key = ?", (key,)).fetchone()[0]
+
+    def trim(self, key: str, keep: int):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM list_items WHERE key = ? AND seq NOT IN "
+                "(SELECT seq FROM list_items WHERE key = ? ORDER BY seq DESC LIMIT ?)",
+                (key, key, keep)
+            )
+
+
+class RedisStateBackend:
+    """Backend trạng thái trên Redis hoặc server tương thích (mock_redis.py khi chạy offline), cần cài redis"""
+    shared = True
+
+    def __init__(self, url: str, timeout: float = STATE_BACKEND_TIMEOUT):
+        import redis
+        # redis-py mặc định chờ vô hạn: Redis chậm hoặc mất mạng sẽ treo mọi request của replica
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self._client.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key: str):
+        self._client.delete(key)
+
+    def exists(self, key: str) -> bool:
+        return bool(self._client.exists(key))
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        if ttl:
+            return bool(self._client.pexpire(key, int(ttl * 1000)))
+        # PERSIST trả về 0 cả khi key vốn không có TTL nên kiểm tra tồn tại riêng
+        self._client.persist(key)
+        return self.exists(key)
+
+    def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        value = self._client.incr(key)
+        if value == 1 and ttl:
+            self._client.pexpire(key, int(ttl * 1000))
+        return value
+
+    def push(self, key: str, value: bytes) -> int:
+        return self._client.rpush(key, value)
+
+    def range(self, key: str, start: int, stop: int) -> List[bytes]:
+        return self._client.lrange(key, start, stop)
+
+    def length(self, key: str) -> int:
+        return self._client.llen(key)
+
+    def trim(self, key: str, keep: int):
+        self._client.ltrim(key, -keep, -1)
+
+
+def create_state_backend(url: str = STATE_BACKEND):
+    """Tạo backend trạng thái theo URL: memory://, sqlite:///đường/dẫn.db hoặc redis://host:port/db"""
+    scheme, _, location = url.partition("://")
+    if scheme == "memory":
+        return MemoryStateBackend()
+    if scheme == "sqlite":
+        return SQLiteStateBackend(location)
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisStateBackend(url)
+    raise ValueError(f"STATE_BACKEND không hỗ trợ: {url}")
+
+
+class BlobStore:
+    """Kho blob dùng chung theo SHA-256: mỗi nội dung lưu một lần, có refcount, giới hạn RAM theo LRU.
+
+    Khi có backend trạng thái dùng chung, blob còn được ghi vào backend để replica khác đọc được;
+    bản trong backend hết hạn sau shared_ttl giây trừ khi được persist (gắn với hội thoại đã lưu).
+    Tham chiếu gắn với người giữ (session): người giữ không touch() quá ref_ttl giây thì mọi tham chiếu
+    của nó được trả, để session đã đóng không giữ blob trong RAM hay trên đĩa mãi mãi.
+    """
+    def __init__(self, max_bytes: int = BLOB_MEMORY_BYTES, spill_dir: str = BLOB_SPILL_DIR,
+                 persistent: bool = False, backend=None, shared_ttl: float = SHARED_BLOB_TTL,
+                 ref_ttl: float = BLOB_REF_TTL):
+        self.max_bytes = max_bytes
+        self.ref_ttl = ref_ttl
+        self.spill_dir = spill_dir or None
+        # persistent: hội thoại đã lưu có thể tham chiếu blob, không xóa bản trên đĩa
+        self.persistent = persistent
+        # Backend trong RAM chỉ nhân đôi blob, bỏ qua giới hạn max_bytes
+        self.backend = backend if backend is not None and backend.shared else None
+        self.shared_ttl = shared_ttl
+        self._memory = OrderedDict()
+        self._refcounts = {}
+        # người giữ -> (digest -> số tham chiếu, lần touch cuối theo monotonic)
+        self._holders = {}
+        self._next_sweep = time.monotonic() + BLOB_SWEEP_INTERVAL
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if self.spill_dir:
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            except OSError:
+                self.spill_dir = None
+
+    def put(self, data: bytes) -> str:
+        """Lưu bytes, trả về digest SHA-256 dùng làm tham chiếu"""
+        self._expire_holders()
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+            else:
+                self._memory[digest] = data
+                self._bytes += len(data)
+                self._evict()
+        if self.backend is not None and not self.backend.exists(f"blob:{digest}"):
+            self.backend.set(f"blob:{digest}", data, ttl=self.shared_ttl)
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        """Đọc bytes theo digest (từ RAM hoặc từ đĩa), None nếu đã bị xóa"""
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return self._memory[digest]
+
+        path = self._spill_path(digest)
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+        elif self.backend is not None:
+            # Blob do replica khác nhận
+            data = self.backend.get(f"blob:{digest}")
+            if data is None:
+                return None
+        else:
+            return None
+
+        with self._lock:
+            if digest not in self._memory:
+                self._memory[digest] = data
+                self._bytes += len(data)
+                self._evict()
+        return data
+
+    def incref(self, digest: str, holder: str = ""):
+        """Thêm một tham chiếu; holder (id session) để tham chiếu được trả khi session bỏ đi, "" là giữ mãi"""
+        with self._lock:
+            self._refcounts[digest] = self._refcounts.get(digest, 0) + 1
+            if holder:
+                held, _ = self._holders.get(holder, ({}, None))
+                held[digest] = held.get(digest, 0) + 1
+                self._holders[holder] = (held, time.monotonic())
+
+    def touch(self, holder: str):
+        """Đánh dấu người giữ còn hoạt động (gọi mỗi lần session chạy script)"""
+        with self._lock:
+            if holder in self._holders:
+                self._holders[holder] = (self._holders[holder][0], time.monotonic())
+        self._expire_holders()
+
+    def _expire_holders(self):
+        """Trả tham chiếu của các người giữ đã quá ref_ttl giây không touch, tối đa một lần mỗi BLOB_SWEEP_INTERVAL"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + BLOB_SWEEP_INTERVAL
+            expired = [holder for holder, (_, seen) in self._holders.items() if now - seen > self.ref_ttl]
+            released = [self._holders.pop(holder)[0] for holder in expired]
+        for held in released:
+            for digest, count in held.items():
+                for _ in range(count):
+                    self.decref(digest)
+
+    def decref(self, digest: str, holder: str = ""):
+        with self._lock:
+            if holder:
+                held = self._holders.get(holder, ({}, None))[0]
+                if digest not in held:
+                    # Tham chiếu đã được trả khi người giữ hết hạn
+                    return
+                held[digest] -= 1
+                if not held[digest]:
+                    del held[digest]
+            count = self._refcounts.get(digest, 0) - 1
+            if count > 0:
+                self._refcounts[digest] = count
+                return
+            self._refcounts.pop(digest, None)
+
+        # Không còn message nào tham chiếu: bỏ bản trên đĩa
+        path = self._spill_path(digest)
+        if path and not self.persistent and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def persist(self, digest: str) -> bool:
+        """Ghi blob xuống đĩa (hoặc bỏ hạn trong backend dùng chung) để message đã lưu vẫn đọc được sau khi restart"""
+        if self.backend is not None:
+            # Bỏ hạn của bản trong backend; đã hết hạn thì ghi lại từ RAM
+            if self.backend.expire(f"blob:{digest}", None):
+                return True
+            with self._lock:
+                data = self._memory.get(digest)
+            if data is None:
+                return False
+            self.backend.set(f"blob:{digest}", data)
+            return True
+        path = self._spill_path(digest)
+        if not path:
+            return False
+        if os.path.exists(path):
+            return True
+        with self._lock:
+            data = self._memory.get(digest)
+        if data is None:
+            return False
+        self._write_spill(path, data)
+        return True
+
+    def __contains__(self, digest: str) -> bool:
+        with self._lock:
+            if digest in self._memory:
+                return True
+        path = self._spill_path(digest)
+        if path and os.path.exists(path):
+            return True
+        return self.backend is not None and self.backend.exists(f"blob:{digest}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "blobs": len(self._memory),
+                "memory_bytes": self._bytes,
+                "referenced": len(self._refcounts)
+            }
+
+    def _spill_path(self, digest: str) -> Optional[str]:
+        return os.path.join(self.spill_dir, digest) if self.spill_dir else None
+
+    def _evict(self):
+        """Đẩy blob cũ nhất ra khỏi RAM; blob còn được tham chiếu thì ghi xuống đĩa trước"""
+        for digest in list(self._memory):
+            if self._bytes <= self.max_bytes:
+                break
+            if self._refcounts.get(digest, 0) > 0:
+                path = self._spill_path(digest)
+                if not path:
+                    # Không có đĩa thì phải giữ blob đang được dùng trong RAM
+                    continue
+                if not os.path.exists(path):
+                    self._write_spill(path, self._memory[digest])
+            self._bytes -= len(self._memory.pop(digest))
+
+    def _write_spill(self, path: str, data: bytes):
+        # Ghi ra file tạm rồi đổi tên để không bao giờ đọc phải file ghi dở
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def message_blob_digests(message: Dict) -> List[str]:
+    """Liệt kê các blob mà một message tham chiếu"""
+    content = message.get("content")
+    if not isinstance(content, list):
+        return []
+    return [
+        item["source"]["digest"] for item in content
+        if item.get("type") == "image" and (item.get("source") or {}).get("type") == "blob"
+    ]
+
+
+class ConversationStore:
+    """Lưu hội thoại trong SQLite (WAL): mỗi message là một dòng chỉ thêm, file đính kèm lưu theo digest blob"""
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id TEXT NOT NULL REFERENCES conversations(id),
+                    message_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    model TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, seq);
+                CREATE INDEX IF NOT EXISTS idx_conversations_owner ON conversations(owner, updated_at);
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Mỗi thread một connection; WAL cho phép đọc song song với ghi
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create_conversation(self, owner: str, title: str) -> str:
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO conversations (id, owner, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, owner, title[:100], now, now)
+            )
+        return conversation_id
+
+    def append_message(self, conversation_id: str, message: Dict):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO messages (conversation_id, message_id, role, content, model, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, message["id"], message["role"],
+                 json.dumps(message["content"], ensure_ascii=False), message.get("model"), now)
+            )
+            conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, conversation_id))
+
+    def count_messages(self, conversation_id: str) -> int:
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return row[0]
+
+    def load_messages(self, conversation_id: str, offset: int, limit: int) -> List[Dict]:
+        """Tải một đoạn message theo thứ tự thời gian, bắt đầu từ vị trí offset"""
+        rows = self._connect().execute(
+            "SELECT message_id, role, content, model FROM messages WHERE conversation_id = ? "
+            "ORDER BY seq LIMIT ? OFFSET ?",
+            (conversation_id, limit, offset)
+        ).fetchall()
+        messages = []
+        for message_id, role, content, model in rows:
+            message = {"id": message_id, "role": role, "content": json.loads(content)}
+            if model:
+                message["model"] = model
+            messages.append(message)
+        return messages
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        row = self._connect().execute(
+            "SELECT id, owner, title, updated_at FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "owner": row[1], "title": row[2], "updated_at": row[3]}
+
+    def list_conversations(self, owner: str, limit: int = 10) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT id, title, updated_at FROM conversations WHERE owner = ? ORDER BY updated_at DESC LIMIT ?",
+            (owner, limit)
+        ).fetchall()
+        return [{"id": row[0], "title": row[1], "updated_at": row[2]} for row in rows]
+
+
+class SharedConversationStore:
+    """Kho hội thoại trên backend trạng thái dùng chung, cùng giao diện với ConversationStore.
+
+    Mỗi hội thoại gồm metadata JSON và danh sách message chỉ thêm; mỗi người dùng có danh sách id
+    hội thoại vừa hoạt động (mới nhất ở cuối, giữ recent_limit mục) để liệt kê không phải quét hết.
+    """
+    recent_limit = 200
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _touch(self, owner: str, conversation_id: str):
+        key = f"owner:{owner}:conversations"
+        if self.backend.range(key, -1, -1) == [conversation_id.encode()]:
+            return
+        if self.backend.push(key, conversation_id.encode()) > self.recent_limit:
+            self.backend.trim(key, self.recent_limit)
+
+    def create_conversation(self, owner: str, title: str) -> str:
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        meta = {"id": conversation_id, "owner": owner, "title": title[:100], "created_at": now, "updated_at": now}
+        self.backend.set(f"conversation:{conversation_id}", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        self._touch(owner, conversation_id)
+        return conversation_id
+
+    def append_message(self, conversation_id: str, message: Dict):
+        stored = {"id": message["id"], "role": message["role"], "content": message["content"]}
+        if message.get("model"):
+            stored["model"] = message["model"]
+        self.backend.push(f"conversation:{conversation_id}:messages",
+                          json.dumps(stored, ensure_ascii=False).encode("utf-8"))
+        meta = self.get_conversation(conversation_id)
+        if meta is not None:
+            meta["updated_at"] = time.time()
+            self.backend.set(f"conversation:{conversation_id}", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+            self._touch(meta["owner"], conversation_id)
+
+    def count_messages(self, conversation_id: str) -> int:
+        return self.backend.length(f"conversation:{conversation_id}:messages")
+
+    def load_messages(self, conversation_id: str, offset: int, limit: int) -> List[Dict]:
+        """Tải một đoạn message theo thứ tự thời gian, bắt đầu từ vị trí offset"""
+        if limit <= 0:
+            return []
+        items = self.backend.range(f"conversation:{conversation_id}:messages", offset, offset + limit - 1)
+        return [json.loads(item) for item in items]
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        data = self.backend.get(f"conversation:{conversation_id}")
+        return None if data is None else json.loads(data)
+
+    def list_conversations(self, owner: str, limit: int = 10) -> List[Dict]:
+        conversations = []
+        seen = set()
+        for item in reversed(self.backend.range(f"owner:{owner}:conversations", 0, -1)):
+            conversation_id = item.decode()
+            if conversation_id in seen:
+                continue
+            seen.add(conversation_id)
+            meta = self.get_conversation(conversation_id)
+            if meta is not None:
+                conversations.append({"id": meta["id"], "title": meta["title"], "updated_at": meta["updated_at"]})
+            if len(conversations) >= limit:
+                break
+        return conversations
+
+
+class ResponseCache:
+    """Cache phản hồi chat completion: tầng LRU trong RAM, tầng thứ hai là backend trạng thái dùng chung
+    hoặc SQLite (tùy chọn), có TTL và bộ đếm hit/miss"""
+    def __init__(self, max_entries: int = RESPONSE_CACHE_ENTRIES, ttl: int = RESPONSE_CACHE_TTL,
+                 db_path: str = RESPONSE_CACHE_DB, backend=None):
+        self.ttl = ttl
+        # Backend trong RAM chỉ nhân đôi tầng LRU, không giới hạn số mục
+        self.backend = backend if backend is not None and backend.shared else None
+        self._memory = LRUCache(max_entries=max_entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db_path = db_path or None
+        self._local = threading.local()
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], max_tokens: int, temperature: float, owner: str = "") -> str:
+        """Hash chuẩn hóa của request; ảnh được đại diện bằng digest blob nên không phải hash base64.
+
+        owner (owner_key của API key) tách cache theo key: key khác, kể cả key sai hoặc đã thu hồi,
+        không nhận được câu trả lời của người khác mà bỏ qua xác thực và hạn mức.
+        """
+        canonical = json.dumps({
+            "owner": owner,
+            "model": model,
+            "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None and entry[0] <= now:
+            self._memory.pop(key)
+            entry = None
+
+        if entry is None and self.backend is not None:
+            data = self.backend.get(f"response:{key}")
+            if data is not None:
+                # Hạn trong backend do backend tự quản, bản trong RAM sống tối đa ttl kể từ lúc đọc
+                entry = (now + self.ttl, json.loads(data))
+                self._memory.set(key, entry)
+        elif entry is None and self.db_path:
+            row = self._connect().execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                entry = (row[1], json.loads(row[0]))
+                self._memory.set(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, response: Dict):
+        expires_at = time.time() + self.ttl
+        self._memory.set(key, (expires_at, response))
+        if self.backend is not None:
+            self.backend.set(f"response:{key}", json.dumps(response, ensure_ascii=False).encode("utf-8"), ttl=self.ttl)
+        elif self.db_path:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(response, ensure_ascii=False), expires_at)
+                )
+                conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._memory)}
+
+
+# Số token ước lượng đã tính cho từng message (theo id message)
+_token_count_cache = LRUCache(max_entries=20000)
+
+# HTML đã render của từng message, key theo (id, hash nội dung, tên model)
+_render_cache = LRUCache(max_entries=5000)
+
+
+def estimate_message_tokens(message: Dict) -> int:
+    """Ước lượng số token của một message (text theo số ký tự, ảnh theo chi phí cố định)"""
+    message_id = message.get("id")
+    if message_id:
+        cached = _token_count_cache.get(message_id)
+        if cached is not None:
+            return cached
+
+    content = message["content"]
+    tokens = MESSAGE_TOKEN_OVERHEAD
+    if isinstance(content, list):
+        for item in content:
+            if item.get("type") == "image":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += len(item.get("text", "")) // CHARS_PER_TOKEN + 1
+    else:
+        tokens += len(content) // CHARS_PER_TOKEN + 1
+
+    if message_id:
+        _token_count_cache.set(message_id, tokens)
+    return tokens
+
+
+def select_context_window(messages: List[Dict], context_window: int, max_tokens: int,
+                          budget: Optional[int] = None, pin_first: bool = False,
+                          reserve: int = 0) -> List[Dict]:
+    """Chọn các message gửi lên sao cho vừa context của model trừ max_tokens.
+
+    reserve là số token sẽ thêm vào prompt sau khi chọn (vd. đoạn tìm được), tính vào cả context lẫn budget.
+    Message được ghim (pinned, system hoặc message đầu khi pin_first) được giữ trước,
+    phần còn lại bỏ dần từ cũ nhất (drop-oldest). Nếu riêng các message ghim đã vượt giới hạn thì
+    bỏ bớt message ghim cũ nhất (system bỏ sau cùng); câu hỏi hiện tại luôn được gửi.
+    """
+    available = context_window - max_tokens - reserve
+    if budget:
+        available = min(available, budget - reserve)
+
+    pinned = []
+    for i, message in enumerate(messages[:-1]):
+        if message.get("pinned") or message["role"] == "system" or (pin_first and i == 0):
+            pinned.append(i)
+    # Message mới nhất (câu hỏi hiện tại) luôn được gửi
+    latest = [len(messages) - 1] if messages else []
+
+    used = sum(estimate_message_tokens(messages[i]) for i in pinned + latest)
+    # Thứ tự bỏ khi quá giới hạn: message ghim thường từ cũ nhất, rồi mới tới system
+    for i in sorted(pinned, key=lambda i: (messages[i]["role"] == "system", i)):
+        if used <= available:
+            break
+        pinned.remove(i)
+        used -= estimate_message_tokens(messages[i])
+    pinned = set(pinned + latest)
+
+    kept = set(pinned)
+    for i in range(len(messages) - 1, -1, -1):
+        if i in kept:
+            continue
+        tokens = estimate_message_tokens(messages[i])
+        if used + tokens > available:
+            break
+        kept.add(i)
+        used += tokens
+
+    window = [messages[i] for i in sorted(kept)]
+    # Lịch sử sau khi cắt phải bắt đầu bằng message của user
+    while len(window) > 1 and window[0]["role"] == "assistant" and not window[0].get("pinned"):
+        window.pop(0)
+    return window
+
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Tách từ cho chỉ mục: chữ thường, bỏ từ một ký tự (trừ chữ số)"""
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 or token.isdigit()]
+
+
+class BM25Index:
+    """Chỉ mục đảo BM25 trong RAM, thêm tài liệu dần dần, key tùy ý (hashable)"""
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._keys = []
+        self._lengths = []
+        self._positions = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, text: str):
+        """Thêm một tài liệu; key đã có thì bỏ qua"""
+        terms = {}
+        for token in tokenize(text):
+            terms[token] = terms.get(token, 0) + 1
+        with self._lock:
+            if key in self._positions:
+                return
+            position = len(self._keys)
+            self._positions[key] = position
+            self._keys.append(key)
+            length = sum(terms.values())
+            self._lengths.append(length)
+            self._total_length += length
+            for term, frequency in terms.items():
+                self._postings.setdefault(term, {})[position] = frequency
+
+    def search(self, query: str, k: int = RETRIEVAL_TOP_K) -> List[Tuple[object, float]]:
+        """k tài liệu điểm cao nhất cho câu truy vấn, dạng [(key, điểm)]"""
+        with self._lock:
+            total = len(self._keys)
+            if not total:
+                return []
+            average_length = self._total_length / total or 1.0
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for position, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[position] / average_length)
+                    scores[position] = scores.get(position, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(self._keys[position], score) for position, score in best]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._positions
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class ConversationIndex:
+    """Chỉ mục của một hội thoại: các đoạn tài liệu text đã đính kèm và các lượt chat trước"""
+    def __init__(self):
+        self.index = BM25Index()
+        self.documents = {}
+
+    def add_document(self, digest: str, name: str):
+        """Đánh chỉ mục mọi đoạn của tài liệu (mỗi tài liệu chỉ một lần)"""
+        document = get_text_document(digest)
+        if digest in self.documents or document is None:
+            return
+        self.documents[digest] = name
+        for i in range(len(document)):
+            self.index.add(("doc", digest, i), document.chunk(i))
+
+    def add_turns(self, messages: List[Dict]):
+        for message in messages:
+            if message.get("id") and message["role"] in ("user", "assistant"):
+                self.index.add(("turn", message["id"], message["role"]), content_text(message["content"]))
+
+    def retrieve(self, query: str, context_messages: List[Dict], budget_tokens: int = RETRIEVAL_TOKEN_BUDGET,
+                 top_k: int = RETRIEVAL_TOP_K, messages: Optional[List[Dict]] = None) -> List[Tuple[str, str]]:
+        """Các đoạn liên quan nhất chưa có trong context, trong ngân sách token; trả về [(nhãn, nội dung)]"""
+        in_context = {message.get("id") for message in context_messages}
+        context_text = "\n".join(content_text(message["content"]) for message in context_messages)
+        turns = {message.get("id"): message for message in messages or []}
+
+        results = []
+        used = 0
+        for key, _ in self.index.search(query, top_k * 4):
+            if key[0] == "turn":
+                message = turns.get(key[1])
+                if key[1] in in_context or message is None:
+                    continue
+                label = "Lượt trước của người dùng" if key[2] == "user" else "Câu trả lời trước"
+                text = content_text(message["content"])
+            else:
+                document = get_text_document(key[1])
+                if document is None:
+                    continue
+                text = document.chunk(key[2])
+                if text.strip() in context_text:
+                    continue
+                label = f"{self.documents[key[1]]}, đoạn {key[2] + 1}/{len(document)}"
+
+            tokens = len(text) // CHARS_PER_TOKEN + 1
+            if used + tokens > budget_tokens:
+                continue
+            results.append((label, text))
+            used += tokens
+            if len(results) >= top_k:
+                break
+        return results
+
+
+def add_retrieved_context(index: ConversationIndex, messages: List[Dict], context_messages: List[Dict],
+                          budget_tokens: int = RETRIEVAL_TOKEN_BUDGET) -> Tuple[List[Dict], int]:
+    """Gắn các đoạn liên quan với tin nhắn cuối vào bản sao tin nhắn đó; trả về (messages gửi đi, số đoạn)"""
+    index.add_turns(messages[:-1])
+    question = context_messages[-1]
+    results = index.retrieve(content_text(question["content"]), context_messages, budget_tokens, messages=messages)
+    if not results:
+        return context_messages, 0
+
+    retrieved = "\n\n".join(f"[{label}]\n{text}" for label, text in results)
+    content = question["content"]
+    blocks = list(content) if isinstance(content, list) else [{"type": "text", "text": content}]
+    blocks.append({"type": "text", "text": f"\n\n{RETRIEVED_CONTEXT_HEADER}\n{retrieved}"})
+    return context_messages[:-1] + [dict(question, content=blocks)], len(results)
+
+
+def _is_retrieved_block(block: Dict) -> bool:
+    return block.get("type") == "text" and block.get("text", "").lstrip().startswith(RETRIEVED_CONTEXT_HEADER)
+
+
+def add_cache_breakpoints(messages: List[Dict], min_tokens: int = PROMPT_CACHE_MIN_TOKENS,
+                          max_breakpoints: int = PROMPT_CACHE_MAX_BREAKPOINTS) -> List[Dict]:
+    """Đánh dấu cache_control trên prefix ổn định của messages (ảnh dạng blob hay base64 đều được),
+    trả về bản sao đã đánh dấu.
+
+    Thứ tự ưu tiên: cuối tin nhắn mới nhất (ghi cache cho lượt sau; bỏ qua đoạn tìm kiếm vì đổi mỗi lượt),
+    cuối tin nhắn user trước đó (đọc lại cache lượt trước đã ghi), cuối phần system đầu hội thoại
+    (vẫn ổn định khi cửa sổ context trượt) rồi các tin nhắn có ảnh, mới nhất trước.
+    Breakpoint có prefix ngắn hơn min_tokens bị bỏ vì provider không cache prefix ngắn.
+    """
+    if not messages or max_breakpoints <= 0:
+        return messages
+
+    prefix_tokens = []
+    total = 0
+    for message in messages:
+        total += estimate_message_tokens(message)
+        prefix_tokens.append(total)
+
+    last = len(messages) - 1
+    candidates = [last]
+    candidates += [i for i in range(last - 1, -1, -1) if messages[i]["role"] == "user"][:1]
+    leading_system = -1
+    while leading_system + 1 < last and messages[leading_system + 1]["role"] == "system":
+        leading_system += 1
+    if leading_system >= 0:
+        candidates.append(leading_system)
+    candidates += [
+        i for i in range(last, -1, -1)
+        if isinstance(messages[i]["content"], list)
+        and any(item.get("type") == "image" for item in messages[i]["content"])
+    ]
+
+    marked = {}
+    for i in candidates:
+        if len(marked) >= max_breakpoints:
+            break
+        if i in marked or prefix_tokens[i] < min_tokens:
+            continue
+        content = messages[i]["content"]
+        blocks = list(content) if isinstance(content, list) else [{"type": "text", "text": content}]
+        position = len(blocks) - 1
+        while position >= 0 and _is_retrieved_block(blocks[position]):
+            position -= 1
+        if position < 0:
+            continue
+        blocks[position] = dict(blocks[position], cache_control={"type": "ephemeral"})
+        marked[i] = blocks
+
+    if not marked:
+        return messages
+    return [dict(message, content=marked[i]) if i in marked else message for i, message in enumerate(messages)]
+
+
+class Histogram:
+    """Histogram theo bucket (cho Prometheus) kèm các mẫu gần nhất để tính percentile"""
+    def __init__(self, buckets: Iterable[float], samples: int = METRICS_SAMPLES):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Percentile (0-100) theo nearest-rank trên các mẫu gần nhất"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class MetricsRegistry:
+    """Số liệu từng request theo model: histogram trong process, xuất dạng Prometheus và log JSONL"""
+    def __init__(self, log_path: str = METRICS_LOG):
+        self.log_path = log_path
+        self._histograms = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, values: Dict, status: str = "ok"):
+        """Ghi một request: values gồm các khóa trong METRIC_BUCKETS (khóa thiếu/None được bỏ qua)"""
+        with self._lock:
+            key = (model, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for name, value in values.items():
+                if name not in METRIC_BUCKETS or value is None:
+                    continue
+                self._histogram(name, model).observe(value)
+
+            if self.log_path:
+                record = {"ts": time.time(), "model": model, "status": status}
+                record.update((k, v) for k, v in values.items() if k in METRIC_BUCKETS and v is not None)
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record) + "\n")
+                except OSError:
+                    pass
+
+    def observe(self, name: str, model: str, value: float):
+        """Thêm một mẫu vào histogram mà không tính thành một request (vd. TTFB của lượt hedge thua)"""
+        with self._lock:
+            self._histogram(name, model).observe(value)
+
+    def _histogram(self, name: str, model: str) -> Histogram:
+        histogram = self._histograms.get((name, model))
+        if histogram is None:
+            histogram = self._histograms[(name, model)] = Histogram(METRIC_BUCKETS[name])
+        return histogram
+
+    def percentile(self, name: str, model: str, q: float) -> Optional[float]:
+        with self._lock:
+            histogram = self._histograms.get((name, model))
+            return histogram.percentile(q) if histogram else None
+
+    def count(self, name: str, model: str) -> int:
+        with self._lock:
+            histogram = self._histograms.get((name, model))
+            return len(histogram.samples) if histogram else 0
+
+    def total(self, name: str, model: str) -> float:
+        with self._lock:
+            histogram = self._histograms.get((name, model))
+            return histogram.sum if histogram else 0.0
+
+    def summary(self) -> List[Dict]:
+        """Bảng tóm tắt theo model: số request, p50/p95/p99 latency, TTFT p50, token/giây p50 và tổng token prompt cache"""
+        with self._lock:
+            models = sorted({model for model, _ in self._requests})
+            requests_by_model = {m: sum(n for (model, _), n in self._requests.items() if model == m) for m in models}
+        rows = []
+        for model in models:
+            rows.append({
+                "model": model,
+                "requests": requests_by_model[model],
+                "latency_p50": self.percentile("latency_seconds", model, 50),
+                "latency_p95": self.percentile("latency_seconds", model, 95),
+                "latency_p99": self.percentile("latency_seconds", model, 99),
+                "ttft_p50": self.percentile("ttft_seconds", model, 50),
+                "tokens_per_second_p50": self.percentile("tokens_per_second", model, 50),
+                "cache_read_tokens": self.total("cache_read_tokens", model),
+                "cache_write_tokens": self.total("cache_write_tokens", model),
+            })
+        return rows
+
+    def render_prometheus(self) -> str:
+        """Xuất toàn bộ số liệu theo định dạng text của Prometheus"""
+        lines = ["# TYPE agentrouter_requests_total counter"]
+        with self._lock:
+            for (model, status), count in sorted(self._requests.items()):
+                lines.append(f'agentrouter_requests_total{{model="{model}",status="{status}"}} {count}')
+            for name in METRIC_BUCKETS:
+                metric = f"agentrouter_{name}"
+                series = sorted((model, h) for (n, model), h in self._histograms.items() if n == name)
+                if not series:
+                    continue
+                lines.append(f"# TYPE {metric} histogram")
+                for model, histogram in series:
+                    for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        lines.append(f'{metric}_bucket{{model="{model}",le="{bound:g}"}} {count}')
+                    lines.append(f'{metric}_bucket{{model="{model}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{model="{model}"}} {histogram.sum:g}')
+                    lines.append(f'{metric}_count{{model="{model}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            self._send(200, self.server.metrics.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+        elif path == "/ready":
+            # Khác /_stcore/health của Streamlit: chỉ 200 khi warm-up đã xong
+            readiness = self.server.readiness() if self.server.readiness else {"ready": True}
+            self._send(200 if readiness["ready"] else 503, json.dumps(readiness), "application/json")
+        else:
+            self.send_error(404)
+
+    def _send(self, status: int, body: str, content_type: str):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(metrics: MetricsRegistry, port: int = METRICS_PORT, host: str = "0.0.0.0",
+                         readiness: Optional[Callable[[], Dict]] = None) -> ThreadingHTTPServer:
+    """Chạy endpoint /metrics và /ready (trạng thái từ readiness()) trong luồng nền"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.metrics = metrics
+    server.readiness = readiness
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+class RetryPolicy:
+    """Backoff lũy thừa với full jitter, ưu tiên Retry-After của server (có giới hạn)"""
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Thời gian chờ (giây) trước lần thử thứ attempt + 1"""
+        server_delay = self.parse_retry_after(retry_after)
+        if server_delay is not None:
+            return min(server_delay, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After dạng số giây hoặc HTTP-date, None nếu không đọc được"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+
+
+class CircuitBreaker:
+    """Ngắt mạch cho một model: closed → open sau nhiều lỗi liên tiếp → half-open cho một request thử"""
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # Id luồng đang giữ lượt thử ở half-open (None nếu không có)
+        self._probing = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and self._probing is None:
+                self._probing = threading.get_ident()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = None
+
+    def release_probe(self):
+        """Trả lượt thử half-open của luồng hiện tại mà không tính thành công hay lỗi
+        (vd. lỗi 4xx do request của client, không phải do model)"""
+        with self._lock:
+            if self._probing == threading.get_ident():
+                self._probing = None
+
+
+class CircuitBreakerRegistry:
+    """Tập circuit breaker theo model, dùng chung cho mọi client trong process"""
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[model]
+
+    def states(self) -> Dict[str, str]:
+        with self._lock:
+            return {model: breaker.state for model, breaker in self._breakers.items()}
+
+
+class HedgeBudget:
+    """Giới hạn số request hedge theo tỉ lệ request thường (kiểu retry budget), dùng chung cho cả process"""
+    def __init__(self, ratio: float = HEDGE_BUDGET, burst: float = HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        # Bắt đầu từ 0 để process mới không hedge dồn trước khi có request nào
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            return True
+
+    def refund(self):
+        """Trả lại lượt vừa lấy khi không gửi được request hedge"""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+            self.hedged -= 1
+
+    def record_win(self):
+        with self._lock:
+            self.won += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"requests": self.requests, "hedged": self.hedged, "won": self.won}
+
+
+class AgentRouterError(Exception):
+    """Lỗi khi gọi AgentRouter API"""
+
+
+class TokenBucket:
+    """Token bucket: nạp rate token/giây, tối đa capacity token (không tự khóa, dùng dưới lock của scheduler)"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: Optional[float] = None) -> float:
+        """Lấy một token; trả về 0 nếu lấy được, ngược lại là số giây tới khi có token"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SharedTokenBucket:
+    """Hạn mức dùng chung giữa các replica qua bộ đếm nguyên tử của backend trạng thái.
+
+    Đếm theo cửa sổ cố định dài capacity/rate giây, mỗi cửa sổ tối đa capacity request (trung bình
+    vẫn là rate request/giây). Backend lỗi thì tạm dùng bucket cục bộ thay vì chặn mọi request.
+    take chạy dưới lock của scheduler nên không gọi backend: nó chỉ dùng token đã xin trước, hết thì
+    bật needs_refill để scheduler gọi refill() (một round trip tới backend) sau khi nhả lock.
+    """
+    # Thời gian chờ take trả về khi đang chờ refill, để luồng không tự refill thử lại sau đó
+    refill_wait = 0.05
+
+    def __init__(self, backend, key: str, rate: float, capacity: float, retry_after: float = STATE_BACKEND_RETRY):
+        self.backend = backend
+        self.key = key
+        self.capacity = max(1.0, capacity)
+        self.window = self.capacity / rate
+        self.retry_after = retry_after
+        self.needs_refill = False
+        self._local = TokenBucket(rate, capacity)
+        self._full_window = None
+        self._backend_retry_at = 0.0
+        # Token đã được backend cấp (đã tính vào cửa sổ chung) nhưng chưa dùng, chỉ có giá trị trong cửa sổ đó
+        self._grants = 0
+        self._grants_window = None
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+
+    def take(self, now: Optional[float] = None) -> float:
+        """Như TokenBucket.take; now (monotonic) chỉ dùng cho bucket cục bộ, cửa sổ tính theo giờ hệ thống"""
+        wall = time.time()
+        window = int(wall // self.window)
+        with self._lock:
+            if window == self._full_window:
+                return (window + 1) * self.window - wall
+            if wall < self._backend_retry_at:
+                return self._local.take(now)
+            if self._grants and self._grants_window == window:
+                self._grants -= 1
+                return 0.0
+            self.needs_refill = True
+            return self.refill_wait
+
+    def refill(self):
+        """Xin backend một token cho lần take sau; gọi ngoài lock của scheduler vì là round trip mạng"""
+        with self._refill_lock:
+            if not self.needs_refill:
+                # Luồng khác vừa refill xong
+                return
+            wall = time.time()
+            window = int(wall // self.window)
+            try:
+                count = self.backend.incr(f"{self.key}:{window}", ttl=self.window * 2)
+            except Exception:
+                count = None
+            with self._lock:
+                self.needs_refill = False
+                if count is None:
+                    self._backend_retry_at = wall + self.retry_after
+                elif count > self.capacity:
+                    self._full_window = window
+                else:
+                    if self._grants_window != window:
+                        self._grants, self._grants_window = 0, window
+                    self._grants += 1
+
+
+class _Ticket:
+    __slots__ = ("api_key", "session_id", "enqueued", "granted")
+
+    def __init__(self, api_key: str, session_id: str):
+        self.api_key = api_key
+        self.session_id = session_id
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class UpstreamScheduler:
+    """Điều phối request lên upstream dùng chung cho mọi session trong process.
+
+    Mỗi request phải có một chỗ trong giới hạn số request đồng thời và một token trong bucket
+    của API key. Các session chờ được phục vụ lần lượt (round-robin) nên một người gửi dồn dập
+    không chiếm hết lượt của người khác.
+    """
+    def __init__(self, max_concurrency: int = SCHEDULER_MAX_CONCURRENCY, rpm: float = RATE_LIMIT_RPM,
+                 burst: int = RATE_LIMIT_BURST, max_wait: float = SCHEDULER_MAX_WAIT, backend=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rpm = rpm
+        self.burst = burst
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.served = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self._queues = OrderedDict()
+        self._buckets = {}
+        # Có backend dùng chung thì hạn mức của API key tính chung cho mọi replica
+        self.backend = backend
+        self._cond = threading.Condition()
+
+    def _take_token(self, api_key: str, now: float) -> float:
+        if self.rpm <= 0:
+            return 0.0
+        bucket = self._buckets.get(api_key)
+        if bucket is None:
+            if self.backend is not None:
+                key = f"rate:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]}"
+                bucket = SharedTokenBucket(self.backend, key, self.rpm / 60.0, self.burst)
+            else:
+                bucket = TokenBucket(self.rpm / 60.0, self.burst)
+            self._buckets[api_key] = bucket
+        return bucket.take(now)
+
+    def _dispatch(self, now: float) -> Optional[float]:
+        """Cấp lượt cho các request đứng đầu theo vòng session; trả về số giây tới khi có token mới (nếu đang chờ token)"""
+        next_token = None
+        while self.in_flight < self.max_concurrency:
+            granted = False
+            # Session đứng đầu OrderedDict là session lâu chưa được phục vụ nhất
+            for session_id, tickets in self._queues.items():
+                wait = self._take_token(tickets[0].api_key, now)
+                if wait:
+                    next_token = wait if next_token is None else min(next_token, wait)
+                    continue
+                ticket = tickets.popleft()
+                ticket.granted = True
+                self.in_flight += 1
+                self.served += 1
+                self.total_wait += now - ticket.enqueued
+                if tickets:
+                    self._queues.move_to_end(session_id)
+                else:
+                    del self._queues[session_id]
+                granted = True
+                break
+            if not granted:
+                break
+        return next_token
+
+    def _pending_refills(self) -> List[SharedTokenBucket]:
+        """Bucket dùng chung đang chờ refill (gọi dưới lock, refill ngoài lock bằng _refill)"""
+        return [bucket for bucket in self._buckets.values() if getattr(bucket, "needs_refill", False)]
+
+    def _refill(self, buckets: List[SharedTokenBucket]):
+        """Xin token từ backend ngoài lock rồi đánh thức các luồng đang chờ để chúng xếp lịch lại"""
+        for bucket in buckets:
+            bucket.refill()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _position(self, ticket: _Ticket) -> int:
+        return 1 + sum(1 for tickets in self._queues.values() for other in tickets if other.enqueued < ticket.enqueued)
+
+    def acquire(self, api_key: str, session_id: str = "",
+                on_wait: Optional[Callable[[int, float], None]] = None) -> float:
+        """Chờ tới lượt gửi; trả về số giây đã chờ. Quá max_wait thì bỏ lượt và báo AgentRouterError"""
+        ticket = _Ticket(api_key, session_id)
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    next_token = self._dispatch(now)
+                    if ticket.granted:
+                        self._cond.notify_all()
+                        return now - ticket.enqueued
+                    waited = now - ticket.enqueued
+                    if waited >= self.max_wait:
+                        self.rejected += 1
+                        raise AgentRouterError(
+                            f"⏳ Hệ thống đang quá tải, đã chờ {waited:.0f} giây trong hàng đợi. Vui lòng thử lại sau."
+                        )
+                    position = self._position(ticket)
+                    refills = self._pending_refills()
+                    if not refills:
+                        timeout = SCHEDULER_REPORT_INTERVAL if next_token is None else min(next_token, SCHEDULER_REPORT_INTERVAL)
+                        self._cond.wait(timeout)
+                        if ticket.granted:
+                            return time.monotonic() - ticket.enqueued
+                if refills:
+                    # Round trip tới backend dùng chung không được giữ lock của mọi session khác
+                    self._refill(refills)
+                    continue
+                if on_wait is not None:
+                    on_wait(position, waited)
+        except BaseException:
+            # Hết giờ, hoặc Streamlit dừng script giữa chừng: bỏ vé, trả lại chỗ nếu đã được cấp
+            with self._cond:
+                if ticket.granted:
+                    self.in_flight -= 1
+                else:
+                    tickets = self._queues.get(session_id)
+                    if tickets is not None and ticket in tickets:
+                        tickets.remove(ticket)
+                        if not tickets:
+                            del self._queues[session_id]
+                self._dispatch(time.monotonic())
+                self._cond.notify_all()
+            raise
+
+    def release(self):
+        """Trả lại chỗ sau khi request (kể cả stream) kết thúc"""
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._dispatch(time.monotonic())
+            self._cond.notify_all()
+
+    def throttle(self, api_key: str):
+        """Chờ token của API key cho request phát sinh thêm (thử lại, model dự phòng) khi đã có chỗ"""
+        while True:
+            with self._cond:
+                wait = self._take_token(api_key, time.monotonic())
+                if not wait:
+                    return
+                refills = self._pending_refills()
+                if not refills:
+                    self._cond.wait(wait)
+            if refills:
+                self._refill(refills)
+
+    def try_acquire(self, api_key: str) -> bool:
+        """Lấy ngay một chỗ và một token nếu có, không xếp hàng và không vượt lượt session đang chờ
+        (dùng cho request hedge); lấy được thì phải release() như request thường"""
+        # Lần thứ hai chỉ chạy khi bucket dùng chung vừa hết token xin trước và refill ngoài lock
+        for _ in range(2):
+            with self._cond:
+                if self.in_flight >= self.max_concurrency or self._queues:
+                    return False
+                if not self._take_token(api_key, time.monotonic()):
+                    self.in_flight += 1
+                    return True
+                refills = self._pending_refills()
+            if not refills:
+                return False
+            self._refill(refills)
+        return False
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "waiting": sum(len(tickets) for tickets in self._queues.values()),
+                "in_flight": self.in_flight,
+                "served": self.served,
+                "rejected": self.rejected,
+                "average_wait": self.total_wait / self.served if self.served else 0.0,
+            }
+
+
+def _deflate_segment(data: bytes, level: int = REQUEST_GZIP_LEVEL) -> bytes:
+    """Nén data thành các block deflate độc lập, căn byte (sync flush) để ghép nối tiếp được"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+# Block deflate cuối (rỗng) đóng stream ghép từ các đoạn _deflate_segment
+_DEFLATE_END = zlib.compressobj(REQUEST_GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+class PayloadBuilder:
+    """Ghép body JSON của request từ bytes đã serialize của từng message.
+
+    Bytes của mỗi message (sau khi prepare, tức đã có base64 ảnh) được cache theo nội dung message
+    gốc, vốn chỉ chứa tham chiếu blob nên băm rẻ; mỗi lượt chỉ serialize message mới. Dùng orjson nếu
+    đã cài. Khi bật nén, mỗi message còn giữ sẵn đoạn deflate riêng để body gzip cũng chỉ là phép ghép.
+    """
+    def __init__(self, max_bytes: int = PAYLOAD_CACHE_BYTES, compress: bool = REQUEST_GZIP,
+                 compress_min_bytes: int = REQUEST_GZIP_MIN_BYTES):
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self._parts = LRUCache(max_entries=4096, max_bytes=max_bytes,
+                               sizeof=lambda value: len(value[0]) + len(value[1] or b""))
+        self.hits = 0
+        self.misses = 0
+        try:
+            import orjson
+            self.dumps = orjson.dumps
+        except ImportError:
+            self.dumps = lambda value: json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def _part(self, message: Dict, prepare: Callable[[Dict], Dict]) -> Tuple[bytes, Optional[bytes]]:
+        key = hashlib.sha1(self.dumps(message)).digest()
+        part = self._parts.get(key)
+        if part is not None:
+            self.hits += 1
+            return part
+        self.misses += 1
+        prepared = prepare(message)
+        data = self.dumps(prepared)
+        part = (data, _deflate_segment(data) if self.compress else None)
+        # Ảnh có blob chưa đọc được đã bị thay bằng chữ báo lỗi; blob có thể có lại sau (upload lại,
+        # replica khác ghi vào backend) nên không cache phần thiếu ảnh dưới key của message gốc
+        if self._count_images(prepared) == self._count_images(message):
+            self._parts.set(key, part)
+        return part
+
+    @staticmethod
+    def _count_images(message: Dict) -> int:
+        content = message["content"]
+        return sum(item.get("type") == "image" for item in content) if isinstance(content, list) else 0
+
+    def build(self, payload: Dict, messages: List[Dict],
+              prepare: Callable[[Dict], Dict]) -> Tuple[bytes, Dict[str, str]]:
+        """Body cho payload kèm messages (chưa prepare) và header cần thêm (Content-Encoding khi nén)"""
+        parts = [self._part(message, prepare) for message in messages]
+        rest = self.dumps({key: value for key, value in payload.items() if key != "messages"})
+        # {"messages":[m1,m2,...],<các field còn lại>}
+        pieces = [b'{"messages":[']
+        for i, (data, _) in enumerate(parts):
+            pieces.append(data if i == 0 else b"," + data)
+        pieces.append(b"]" + (b"," + rest[1:] if len(rest) > 2 else b"}"))
+        body = b"".join(pieces)
+        if not self.compress or len(body) < self.compress_min_bytes:
+            return body, {}
+
+        segments = [_GZIP_HEADER, _deflate_segment(pieces[0])]
+        for i, (data, deflated) in enumerate(parts):
+            if i:
+                segments.append(_deflate_segment(b","))
+            segments.append(deflated)
+        segments += [_deflate_segment(pieces[-1]), _DEFLATE_END,
+                     struct.pack("<II", zlib.crc32(body) & 0xffffffff, len(body) & 0xffffffff)]
+        return b"".join(segments), {"Content-Encoding": "gzip"}
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._parts)}
+
+
+def parse_sse_events(lines: Iterable) -> Iterator[Dict]:
+    """Phân tích các dòng Server-Sent Events thành từng event JSON"""
+    data_lines = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r')
+        
+        # Dòng trống kết thúc một event
+        if not line:
+            if data_lines:
+                data = "\n".join(data_lines)
+                data_lines = []
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+            continue
+        
+        # Comment/keep-alive
+        if line.startswith(':'):
+            continue
+        
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            data_lines.append(value)
+    
+    if data_lines:
+        data = "\n".join(data_lines)
+        if data != "[DONE]":
+            yield json.loads(data)
+
+
+# Thời gian mở kết nối (TCP + TLS) của request hiện tại trên từng luồng
+_connect_timing = threading.local()
+
+# on_connection(kết nối hoặc None) của từng luồng: được báo kết nối đang chờ header của upstream,
+# None khi header đã về (lúc đó response giữ kết nối), để luồng khác hủy được request đang treo;
+# hook ném exception thì request dừng luôn
+_request_hooks = threading.local()
+
+
+def _notify_connection(connection):
+    callback = getattr(_request_hooks, "on_connection", None)
+    if callback is not None:
+        callback(connection)
+
+
+class _TimedConnectionMixin:
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.perf_counter() - start
+
+    def request(self, *args, **kwargs):
+        _notify_connection(self)
+        return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        try:
+            return super().getresponse(*args, **kwargs)
+        finally:
+            _notify_connection(None)
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter ghi lại thời gian mở kết nối mới (kết nối keep-alive dùng lại tính là 0)"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class _Http2Response:
+    """Bọc httpx.Response theo giao diện requests.Response mà AgentRouterAPI dùng"""
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    @property
+    def text(self) -> str:
+        self._response.read()
+        return self._response.text
+
+    @property
+    def content(self) -> bytes:
+        return self._response.read()
+
+    def json(self):
+        self._response.read()
+        return self._response.json()
+
+    def iter_lines(self, chunk_size=None):
+        import httpx
+        try:
+            yield from self._response.iter_lines()
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Http2Session:
+    """Session HTTP/2 dựa trên httpx, giữ giao diện get()/post() giống requests.Session"""
+    def __init__(self, pool_size: int):
+        import httpx
+        self._client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        # Client dùng chung cho mọi API key: không lưu cookie để cookie của người này không gửi kèm request người khác
+        self._client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    def get(self, url: str, headers: Optional[Dict] = None, timeout=None) -> _Http2Response:
+        return self._request("GET", url, headers=headers, timeout=timeout)
+
+    def post(self, url: str, headers: Optional[Dict] = None, json=None, data=None,
+             timeout=None, stream: bool = False) -> _Http2Response:
+        return self._request("POST", url, headers=headers, json=json, data=data, timeout=timeout, stream=stream)
+
+    def _request(self, method: str, url: str, headers: Optional[Dict] = None, json=None, data=None,
+                 timeout=None, stream: bool = False) -> _Http2Response:
+        import httpx
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            request = self._client.build_request(method, url, headers=headers, json=json,
+                                                 content=data, timeout=timeout)
+            response = self._client.send(request, stream=True)
+            if not stream:
+                response.read()
+            return _Http2Response(response)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def close(self):
+        self._client.close()
+
+
+def create_http_session(pool_size: int = HTTP_POOL_SIZE, http2: bool = HTTP2_ENABLED):
+    """Tạo HTTP session với connection pool keep-alive (HTTP/2 nếu bật và có httpx[http2])"""
+    if http2:
+        try:
+            return _Http2Session(pool_size)
+        except ImportError:
+            # Thiếu httpx/h2 thì quay về HTTP/1.1
+            pass
+
+    session = requests.Session()
+    adapter = _TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Session dùng chung cho mọi API key: không lưu Set-Cookie của upstream, tránh gửi lại cho tenant khác
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    # Session dùng chung có thể sống qua nhiều lần chạy script (mỗi lần định nghĩa lại module),
+    # nên client đọc thời gian kết nối qua chính session thay vì biến toàn cục của lần chạy hiện tại
+    session.connect_timing = _connect_timing
+    return session
+
+
+def shutdown_socket(sock):
+    """Cắt socket để luồng đang chờ recv trên nó nhận lỗi ngay (close() từ luồng khác không đánh thức được)"""
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def abort_response(response):
+    """Đóng response đang được luồng khác đọc: shutdown socket trước rồi mới close()
+    (response HTTP/2 không lộ socket, chỉ close)"""
+    raw = getattr(response, "raw", None)
+    sock = getattr(getattr(raw, "_connection", None), "sock", None)
+    if sock is None:
+        # Upstream báo đóng kết nối sau response thì http.client đã tách socket khỏi connection,
+        # socket chỉ còn nằm trong file đọc của response
+        fp = getattr(getattr(raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    shutdown_socket(sock)
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+# Model có sẵn: metadata (tên, mô tả, capability, cỡ ảnh, context) trộn vào danh sách từ /v1/models
+BUILTIN_MODELS = [
+    {
+        "id": "claude-sonnet-4-20250514",
+        "name": "Claude 4 Sonnet",
+        "provider": "Anthropic",
+        "description": "Mô hình Claude mới nhất, cân bằng giữa hiệu suất và tốc độ",
+        "capabilities": ["text", "vision", "code", "analysis", "prompt_caching"],
+        "max_image_side": 1568,
+        "context_window": 200000
+    },
+    {
+        "id": "claude-opus-4-20250514",
+        "name": "Claude 4 Opus",
+        "provider": "Anthropic",
+        "description": "Mô hình Claude mạnh nhất, tối ưu cho các tác vụ phức tạp",
+        "capabilities": ["text", "vision", "code", "analysis", "reasoning", "prompt_caching"],
+        "max_image_side": 1568,
+        "context_window": 200000
+    },
+    {
+        "id": "claude-opus-4-1-20250805",
+        "name": "Claude 4.1 Opus",
+        "provider": "Anthropic",
+        "description": "Phiên bản cải tiến của Claude 4 Opus với hiệu suất vượt trội",
+        "capabilities": ["text", "vision", "code", "analysis", "reasoning", "prompt_caching"],
+        "max_image_side": 1568,
+        "context_window": 200000
+    },
+    {
+        "id": "claude-3-5-haiku-20241022",
+        "name": "Claude 3.5 Haiku",
+        "provider": "Anthropic",
+        "description": "Mô hình Claude nhỏ gọn, tốc độ cao cho các tác vụ cơ bản",
+        "capabilities": ["text", "code", "prompt_caching"],
+        "cache_min_tokens": 2048,
+        "context_window": 200000
+    },
+    {
+        "id": "gpt-5",
+        "name": "GPT-5",
+        "provider": "OpenAI",
+        "description": "Mô hình GPT thế hệ mới nhất từ OpenAI",
+        "capabilities": ["text", "vision", "code", "analysis", "reasoning"],
+        "max_image_side": 2048,
+        "context_window": 400000
+    },
+    {
+        "id": "glm-4.5",
+        "name": "GLM-4.5",
+        "provider": "Zhipu AI",
+        "description": "Mô hình AI tiên tiến từ Zhipu AI với khả năng đa ngôn ngữ",
+        "capabilities": ["text", "vision", "code", "multilingual"],
+        "max_image_side": 1568,
+        "context_window": 128000
+    }
+]
+
+
+class ModelCatalog:
+    """Danh mục model dùng chung: danh sách từ /v1/models trộn với BUILTIN_MODELS, chỉ mục theo id và capability.
+
+    Đọc luôn trả ngay danh mục hiện có (built-in, snapshot trên disk hoặc lần lấy trước);
+    hết TTL thì làm mới ở luồng nền, mỗi lúc chỉ một luồng, lỗi thì giữ danh mục cũ.
+    """
+    def __init__(self, base_url: str, snapshot_path: str = MODEL_CATALOG_SNAPSHOT,
+                 ttl: int = MODEL_CATALOG_TTL, builtin: Optional[List[Dict]] = None):
+        self.base_url = base_url
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self._builtin = {model["id"]: model for model in (builtin if builtin is not None else BUILTIN_MODELS)}
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._next_refresh = 0.0
+        self._set_models(list(self._builtin.values()))
+        self._load_snapshot()
+
+    def _set_models(self, models: List[Dict]):
+        by_capability = {}
+        for model in models:
+            for capability in model.get("capabilities", []):
+                by_capability.setdefault(capability, []).append(model["id"])
+        # Thay cả bộ chỉ mục trong một phép gán để luồng đọc không thấy trạng thái nửa vời
+        self._index = (
+            models,
+            {model["id"]: model for model in models},
+            {model["id"]: i for i, model in enumerate(models)},
+            {capability: (ids, frozenset(ids)) for capability, ids in by_capability.items()},
+        )
+
+    def models(self) -> List[Dict]:
+        return self._index[0]
+
+    def by_id(self) -> Dict[str, Dict]:
+        return self._index[1]
+
+    def get(self, model_id: str) -> Optional[Dict]:
+        return self._index[1].get(model_id)
+
+    def position(self, model_id: str) -> Optional[int]:
+        """Vị trí của model trong models(), None nếu không có"""
+        return self._index[2].get(model_id)
+
+    def supports(self, model_id: str, capability: str) -> bool:
+        entry = self._index[3].get(capability)
+        return entry is not None and model_id in entry[1]
+
+    def with_capability(self, capability: str) -> List[str]:
+        """Id các model có capability, theo thứ tự danh mục"""
+        entry = self._index[3].get(capability)
+        return list(entry[0]) if entry else []
+
+    def merge(self, entries: List[Dict]) -> List[Dict]:
+        """Trộn danh sách /v1/models với metadata có sẵn; model mới nhận metadata suy ra từ response"""
+        models = {}
+        for entry in entries:
+            model_id = entry.get("id")
+            if not model_id or model_id in models:
+                continue
+            known = self._builtin.get(model_id)
+            model = dict(known) if known else {
+                "id": model_id,
+                "name": entry.get("name") or model_id,
+                "provider": entry.get("owned_by") or "",
+                "description": entry.get("description") or "",
+                "capabilities": ["text"],
+            }
+            capabilities = list(model["capabilities"])
+            modalities = entry.get("input_modalities") or (entry.get("architecture") or {}).get("input_modalities") or []
+            for capability in list(entry.get("capabilities") or []) + (["vision"] if "image" in modalities else []):
+                if capability not in capabilities:
+                    capabilities.append(capability)
+            model["capabilities"] = capabilities
+            context_window = entry.get("context_window") or entry.get("context_length")
+            if context_window:
+                model["context_window"] = int(context_window)
+            models[model_id] = model
+
+        # Model có sẵn giữ thứ tự cũ, model mới xếp sau theo id
+        order = {model_id: i for i, model_id in enumerate(self._builtin)}
+        return sorted(models.values(), key=lambda m: (order.get(m["id"], len(order)), m["id"]))
+
+    def refresh_if_stale(self, fetch: Callable[[], List[Dict]], wait: bool = False):
+        """Làm mới ở luồng nền nếu đã hết TTL và chưa có luồng nào đang làm (wait=True để chờ xong)"""
+        with self._lock:
+            if self._refreshing or time.monotonic() < self._next_refresh:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._refresh, args=(fetch,), daemon=True, name="model-catalog")
+        thread.start()
+        if wait:
+            thread.join()
+
+    def _refresh(self, fetch: Callable[[], List[Dict]]):
+        models = None
+        try:
+            models = self.merge(fetch()) or None
+        except (AgentRouterError, requests.exceptions.RequestException, ValueError, TypeError, AttributeError):
+            pass
+        if models:
+            self._set_models(models)
+            self._save_snapshot(models)
+        with self._lock:
+            self._refreshing = False
+            self._next_refresh = time.monotonic() + (self.ttl if models else min(self.ttl, MODEL_CATALOG_RETRY))
+
+    def _load_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        if snapshot.get("base_url") != self.base_url or not snapshot.get("models"):
+            return
+        self._set_models(snapshot["models"])
+        # Snapshot còn hạn thì chưa cần gọi upstream
+        age = max(0.0, time.time() - snapshot.get("saved_at", 0))
+        self._next_refresh = time.monotonic() + max(0.0, self.ttl - age)
+
+    def _save_snapshot(self, models: List[Dict]):
+        if not self.snapshot_path:
+            return
+        try:
+            temp_path = f"{self.snapshot_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"base_url": self.base_url, "saved_at": time.time(), "models": models}, f)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError:
+            pass
+
+
+class Warmup:
+    """Khởi động nóng cho cả process: import trước module nặng và mở sẵn kết nối upstream trong pool dùng chung.
+
+    Chạy ở luồng nền; sau đó gửi request nhẹ định kỳ để kết nối keep-alive không bị upstream đóng,
+    nhưng chỉ khi có người dùng hoạt động trong idle giây gần nhất (touch() mỗi lần chạy script).
+    """
+    def __init__(self, session, base_url: str, modules: Iterable[str] = WARMUP_MODULES,
+                 keepalive: float = WARMUP_KEEPALIVE, idle: float = WARMUP_IDLE):
+        self.session = session
+        self.base_url = base_url.rstrip('/')
+        self.modules = tuple(modules)
+        self.keepalive = keepalive
+        self.idle = idle
+        self.ready = threading.Event()
+        self.steps = {}
+        self.error = None
+        self._last_active = time.monotonic()
+        self._started_at = time.time()
+
+    def start(self):
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def touch(self):
+        self._last_active = time.monotonic()
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready.is_set(),
+            "started_at": self._started_at,
+            "steps": dict(self.steps),
+            "error": self.error,
+        }
+
+    def _run(self):
+        self._step("imports", self._import_modules)
+        self._step("connection", self.ping)
+        self.ready.set()
+        while self.keepalive > 0:
+            time.sleep(self.keepalive)
+            if time.monotonic() - self._last_active <= self.idle:
+                self.ping()
+
+    def _step(self, name: str, func: Callable[[], None]):
+        start = time.perf_counter()
+        func()
+        self.steps[name] = time.perf_counter() - start
+
+    def _import_modules(self):
+        import importlib
+        for name in self.modules:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
+    def ping(self):
+        """Request nhẹ (không cần API key) để mở hoặc giữ kết nối; mọi status đều được, chỉ cần kết nối"""
+        try:
+            response = self.session.get(f"{self.base_url}/v1/models", timeout=(CONNECT_TIMEOUT, MODEL_CATALOG_TIMEOUT))
+            # Đọc hết body để kết nối quay lại pool thay vì bị đóng
+            response.content
+            response.close()
+            self.error = None
+        except requests.exceptions.RequestException as e:
+            self.error = str(e)
+
+
+class JobCancelled(Exception):
+    """Job bị hủy hoặc quá giờ; status là trạng thái cuối của job"""
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+class GenerationJob:
+    """Một lượt sinh câu trả lời chạy nền: worker ghi từng đoạn text, UI đọc lại bất cứ lúc nào"""
+    def __init__(self, owner: str, model: str, timeout: float = JOB_TIMEOUT):
+        self.id = str(uuid.uuid4())
+        self.owner = owner
+        self.model = model
+        # queued -> running -> done | error | cancelled | timeout
+        self.status = "queued"
+        self.error = None
+        self.info = {}
+        self.queue_position = None
+        self.deadline = time.monotonic() + timeout
+        self.finished_at = None
+        # Số ký tự đã nhận, để UI biết có gì mới mà không phải ghép lại toàn bộ text
+        self.length = 0
+        # Lý do dừng (cancelled/timeout), kết nối đang chờ header và response đang đọc,
+        # để dừng được cả khi upstream im lặng
+        self._reason = None
+        self._connection = None
+        self._response = None
+        self._parts = []
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    def text(self) -> str:
+        with self._lock:
+            return "".join(self._parts)
+
+    def append(self, text: str):
+        with self._lock:
+            self._parts.append(text)
+            self.length += len(text)
+        self.status = "running"
+        self.queue_position = None
+
+    def on_queue(self, position: int, waited: float):
+        """Dùng làm on_queue của chat_completion_stream: ghi vị trí hàng đợi và bỏ lượt nếu đã hủy"""
+        self.queue_position = position
+        self.check()
+
+    def abort_reason(self) -> Optional[str]:
+        """"cancelled" hoặc "timeout" nếu job phải dừng, None nếu vẫn chạy tiếp được"""
+        if self._cancelled.is_set():
+            return self._reason
+        if time.monotonic() > self.deadline:
+            return "timeout"
+        return None
+
+    def check(self):
+        """Ném JobCancelled nếu job đã bị hủy hoặc quá hạn"""
+        reason = self.abort_reason()
+        if reason:
+            raise JobCancelled(reason)
+
+    def on_connection(self, connection):
+        """Hook _request_hooks của luồng worker: nhớ kết nối đang chờ header để cancel() cắt được.
+        Job đã dừng thì ném JobCancelled ngay để client không thử lại hay gửi tiếp model dự phòng"""
+        with self._lock:
+            self._connection = connection
+        self.check()
+
+    def attach_response(self, response):
+        """Dùng làm on_response của chat_completion_stream: nhớ response đang đọc để cancel() đóng được"""
+        with self._lock:
+            self._response = response
+        if self._cancelled.is_set():
+            abort_response(response)
+
+    def detach(self):
+        """Quên kết nối/response khi worker xong: kết nối đã về pool có thể đang phục vụ request khác"""
+        with self._lock:
+            self._connection = self._response = None
+
+    def cancel(self, reason: str = "cancelled"):
+        """Dừng job (gọi được từ luồng bất kỳ): đóng luôn response đang đọc vì luồng worker
+        có thể đang chờ upstream gửi chunk tiếp và không tự kiểm tra được"""
+        with self._lock:
+            if self._reason is None:
+                self._reason = reason
+            connection, response = self._connection, self._response
+        self._cancelled.set()
+        if connection is not None:
+            shutdown_socket(connection.sock)
+        if response is not None:
+            abort_response(response)
+
+    def wait(self, timeout: float) -> bool:
+        """Chờ tối đa timeout giây cho tới khi job xong; trả về job đã xong chưa"""
+        return self._finished.wait(timeout)
+
+    def message(self) -> Optional[Dict]:
+        """Message assistant từ text đã nhận (kể cả khi bị hủy giữa chừng), None nếu chưa có gì"""
+        text = self.text()
+        if not text:
+            return None
+        return {"id": self.id, "role": "assistant", "content": text, "model": self.info.get("model", self.model)}
+
+    def finish(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._finished.set()
+
+
+class JobManager:
+    """Chạy các lượt sinh trên luồng nền dùng chung cho cả process.
+
+    Session chỉ giữ id job nên rerun hay rời trang không làm mất request đang chạy; mỗi lần chạy
+    script thì gắn lại vào output. Job xong mà không được nhận về bị bỏ sau retention giây.
+    """
+    def __init__(self, max_workers: int = JOB_WORKERS, timeout: float = JOB_TIMEOUT,
+                 retention: float = JOB_RETENTION):
+        self.timeout = timeout
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner: str, model: str, generate: Callable[[GenerationJob], Iterator[str]],
+               on_finish: Optional[Callable[[GenerationJob], None]] = None) -> GenerationJob:
+        """Chạy generate(job) trên worker, ghi từng đoạn text vào job; on_finish(job) chạy trên worker
+        trước khi job được đánh dấu xong (ví dụ để lưu câu trả lời kể cả khi session đã đi)"""
+        self._expire()
+        job = GenerationJob(owner, model, self.timeout)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, generate, on_finish)
+        return job
+
+    def get(self, job_id: Optional[str], owner: str) -> Optional[GenerationJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None and job.owner == owner else None
+
+    def pop(self, job_id: str):
+        """Bỏ job đã được session nhận kết quả"""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {"running": sum(not job.done for job in jobs), "finished": sum(job.done for job in jobs)}
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job.done and now - job.finished_at > self.retention]:
+                del self._jobs[job_id]
+
+    def _run(self, job: GenerationJob, generate: Callable[[GenerationJob], Iterator[str]],
+             on_finish: Optional[Callable[[GenerationJob], None]]):
+        status, error = "error", None
+        stream = None
+        # Hết hạn thì đóng response từ luồng hẹn giờ: upstream im lặng thì vòng đọc không tự kiểm tra được
+        watchdog = threading.Timer(max(0.0, job.deadline - time.monotonic()), job.cancel, args=("timeout",))
+        watchdog.daemon = True
+        watchdog.start()
+        _request_hooks.on_connection = job.on_connection
+        try:
+            # Có thể đã bị hủy/quá hạn trong lúc chờ worker trống
+            job.check()
+            stream = generate(job)
+            for text in stream:
+                job.append(text)
+                job.check()
+            status = "done"
+        except JobCancelled as e:
+            status = e.status
+        except AgentRouterError as e:
+            error = str(e)
+        except Exception as e:
+            error = f"❌ Lỗi: {e}"
+        finally:
+            watchdog.cancel()
+            _request_hooks.on_connection = None
+            # Đóng generator để hủy stream upstream khi dừng giữa chừng
+            if stream is not None:
+                stream.close()
+            job.detach()
+        if status == "error" and job.abort_reason():
+            # Lỗi đọc do chính cancel()/hẹn giờ đóng response
+            status, error = job.abort_reason(), None
+        if status == "timeout":
+            error = f"⏱️ Quá {self.timeout:.0f} giây chưa trả lời xong, đã dừng."
+        if on_finish is not None:
+            try:
+                on_finish(job)
+            except Exception as e:
+                error = error or f"❌ Không lưu được câu trả lời: {e}"
+        job.finish(status, error)
+
 
 class AgentRouterAPI:
-    def __init__(self, api_key: str, base_url: str = "https://agentrouter.org"):
+    def __init__(self, api_key: str, base_url: str = DEFAULT_BASE_URL, session=None,
+                 blob_store: Optional[BlobStore] = None, response_cache: Optional[ResponseCache] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 circuit_breakers: Optional[CircuitBreakerRegistry] = None,
+                 metrics: Optional[MetricsRegistry] = None,
+                 pdf_extractor: Optional[PdfExtractor] = None,
+                 scheduler: Optional[UpstreamScheduler] = None,
+                 model_catalog: Optional[ModelCatalog] = None,
+                 hedge_budget: Optional[HedgeBudget] = None,
+                 payload_builder: Optional[PayloadBuilder] = None):
         self.api_key = api_key
         self.base_url = base_url.rstrip('/')
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        self.session = session if session is not None else create_http_session()
+        self.blob_store = blob_store if blob_store is not None else BlobStore()
+        self.response_cache = response_cache
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.circuit_breakers = circuit_breakers if circuit_breakers is not None else CircuitBreakerRegistry()
+        self.metrics = metrics
+        self.pdf_extractor = pdf_extractor if pdf_extractor is not None else PdfExtractor()
+        self.scheduler = scheduler
+        self.model_catalog = model_catalog if model_catalog is not None else ModelCatalog(self.base_url, snapshot_path="")
+        self.hedge_budget = hedge_budget if hedge_budget is not None else HedgeBudget()
+        self.payload_builder = payload_builder if payload_builder is not None else PayloadBuilder()
     
     def get_available_models(self) -> List[Dict]:
-        """Lấy danh sách các model có sẵn từ AgentRouter"""
-        models = [
-            {
-                "id": "claude-sonnet-4-20250514",
-                "name": "Claude 4 Sonnet",
-                "provider": "Anthropic",
-                "description": "Mô hình Claude mới nhất, cân bằng giữa hiệu suất và tốc độ",
-                "capabilities": ["text", "vision", "code", "analysis"]
-            },
-            {
-                "id": "claude-opus-4-20250514", 
-                "name": "Claude 4 Opus",
-                "provider": "Anthropic",
-                "description": "Mô hình Claude mạnh nhất, tối ưu cho các tác vụ phức tạp",
-                "capabilities": ["text", "vision", "code", "analysis", "reasoning"]
-            },
-            {
-                "id": "claude-opus-4-1-20250805",
-                "name": "Claude 4.1 Opus", 
-                "provider": "Anthropic",
-                "description": "Phiên bản cải tiến của Claude 4 Opus với hiệu suất vượt trội",
-                "capabilities": ["text", "vision", "code", "analysis", "reasoning"]
-            },
-            {
-                "id": "claude-3-5-haiku-20241022",
-                "name": "Claude 3.5 Haiku",
-                "provider": "Anthropic", 
-                "description": "Mô hình Claude nhỏ gọn, tốc độ cao cho các tác vụ cơ bản",
-                "capabilities": ["text", "code"]
-            },
-            {
-                "id": "gpt-5",
-                "name": "GPT-5",
-                "provider": "OpenAI",
-                "description": "Mô hình GPT thế hệ mới nhất từ OpenAI",
-                "capabilities": ["text", "vision", "code", "analysis", "reasoning"]
-            },
-            {
-                "id": "glm-4.5",
-                "name": "GLM-4.5",
-                "provider": "Zhipu AI",
-                "description": "Mô hình AI tiên tiến từ Zhipu AI với khả năng đa ngôn ngữ",
-                "capabilities": ["text", "vision", "code", "multilingual"]
-            }
-        ]
-        return models
-    
-    def encode_image_to_base64(self, image_file) -> str:
-        """Chuyển đổi ảnh thành base64"""
+        """Lấy danh sách các model có sẵn (danh mục dùng chung, tự làm mới từ AgentRouter khi hết hạn)"""
+        self.model_catalog.refresh_if_stale(self._fetch_models)
+        return self.model_catalog.models()
+
+    def get_model(self, model_id: str) -> Optional[Dict]:
+        """Tìm thông tin model theo id"""
+        return self.model_catalog.get(model_id)
+
+    def _fetch_models(self) -> List[Dict]:
+        """Danh sách model thô từ endpoint /v1/models của AgentRouter"""
+        response = self.session.get(
+            f"{self.base_url}/v1/models",
+            headers=self.headers,
+            timeout=(CONNECT_TIMEOUT, MODEL_CATALOG_TIMEOUT)
+        )
+        try:
+            if response.status_code != 200:
+                raise AgentRouterError(f"❌ {self._error_message(response)}")
+            return response.json().get("data") or []
+        finally:
+            response.close()
+
+    def encode_image_to_base64(self, image_file, max_side: int = DEFAULT_MAX_IMAGE_SIDE) -> Tuple[str, str]:
+        """Tiền xử lý ảnh rồi chuyển thành base64, trả về (data, media_type)"""
+        from PIL import Image
         if isinstance(image_file, Image.Image):
             buffer = io.BytesIO()
             image_file.save(buffer, format='PNG')
@@ -346,50 +3505,80 @@ class AgentRouterAPI:
             image_bytes = image_file.read()
             # Reset file pointer for display
             image_file.seek(0)
-        
-        return base64.b64encode(image_bytes).decode('utf-8')
-    
-    def process_file_content(self, file) -> Dict:
-        """Xử lý nội dung file"""
+
+        image_bytes, media_type = preprocess_image(image_bytes, max_side)
+        return base64.b64encode(image_bytes).decode('utf-8'), media_type
+
+    def process_file_content(self, file, model: Optional[str] = None) -> Dict:
+        """Xử lý nội dung file (ảnh được thu nhỏ theo giới hạn của model)"""
         file_info = {
             "name": file.name,
             "type": file.type,
             "size": file.size,
             "id": str(uuid.uuid4())
         }
-        
-        # Xử lý file ảnh
+
+        # Xử lý file ảnh: chỉ lưu tham chiếu tới blob, base64 được tạo lúc gửi
         if file.type.startswith('image/'):
             try:
-                file_info["content"] = self.encode_image_to_base64(file)
-                file_info["media_type"] = file.type
+                model_info = self.get_model(model) or {}
+                max_side = model_info.get("max_image_side", DEFAULT_MAX_IMAGE_SIDE)
+                image_bytes, file_info["media_type"] = preprocess_image(file.getvalue(), max_side)
+                file_info["blob"] = self.blob_store.put(image_bytes)
                 file_info["category"] = "image"
                 return file_info
             except Exception as e:
                 st.error(f"❌ Lỗi xử lý ảnh: {e}")
                 return None
-        
-        # Xử lý file text
+
+        # Xử lý file text: nạp theo khối thành các đoạn, chỉ giữ tham chiếu tới tài liệu
         elif file.type in ['text/plain', 'application/json', 'text/csv']:
             try:
-                content = file.read().decode('utf-8')
-                file_info["content"] = content
+                file.seek(0)
+                document = ingest_text_file(file, file.name, file.type)
+                file_info["document"] = document.digest
+                file_info["encoding"] = document.encoding
+                file_info["chunks"] = len(document)
                 file_info["category"] = "text"
+                if file.type == "text/csv":
+                    file_info["csv_profile"] = self._profile_csv(file, document) is not None
                 return file_info
             except Exception as e:
                 st.error(f"❌ Lỗi xử lý file: {e}")
                 return None
         
-        # Xử lý file PDF
+        # Xử lý file PDF: trích xuất text chạy nền trong process pool, xong thì thành tài liệu text
         elif file.type == 'application/pdf':
-            file_info["content"] = "PDF file - Nội dung sẽ được xử lý bởi AI"
-            file_info["category"] = "document"
+            file_info["pdf"] = self.pdf_extractor.submit(file.getvalue(), file.name)
+            file_info["category"] = "pdf"
+            self.refresh_pdf(file_info)
             return file_info
         
         return file_info
     
-    def create_message_with_files(self, text: str, files: List[Dict]) -> List[Dict]:
-        """Tạo message với file đính kèm"""
+    def refresh_pdf(self, file_info: Dict) -> bool:
+        """Cập nhật file PDF đang trích xuất; trả về True nếu vừa xong (file thành tài liệu text)"""
+        if file_info.get("category") != "pdf":
+            return False
+        job = self.pdf_extractor.job(file_info["pdf"])
+        if job is None:
+            file_info["category"] = "document"
+            file_info["content"] = "Không còn dữ liệu trích xuất PDF, vui lòng upload lại"
+            return True
+        if job.error:
+            file_info["category"] = "document"
+            file_info["content"] = job.error
+            return True
+        if job.document is None:
+            return False
+        file_info["category"] = "text"
+        file_info["document"] = job.document.digest
+        file_info["encoding"] = job.document.encoding
+        file_info["chunks"] = len(job.document)
+        return True
+
+    def create_message_with_files(self, text: str, files: List[Dict], holder: str = "") -> List[Dict]:
+        """Tạo message với file đính kèm (holder: id session giữ tham chiếu blob của ảnh)"""
         content = []
         
         # Thêm text
@@ -402,18 +3591,34 @@ class AgentRouterAPI:
         # Thêm files
         for file_info in files:
             if file_info["category"] == "image":
+                # Message chỉ giữ tham chiếu blob, giữ blob sống bằng refcount
+                self.blob_store.incref(file_info["blob"], holder)
                 content.append({
                     "type": "image",
                     "source": {
-                        "type": "base64",
+                        "type": "blob",
                         "media_type": file_info["media_type"],
-                        "data": file_info["content"]
+                        "digest": file_info["blob"]
                     }
                 })
             elif file_info["category"] == "text":
+                # CSV gửi hồ sơ cột thay cho dữ liệu thô, trừ khi người dùng chọn một khoảng đoạn cụ thể
+                profile = _csv_profiles.get(file_info["document"]) if file_info.get("csv_profile") else None
+                selected = file_info.get("selected_chunks")
+                if profile is not None and (selected is None or len(selected) >= file_info["chunks"]):
+                    text_block = f"\n\n{format_csv_profile(file_info['name'], profile)}"
+                else:
+                    text_block = self._document_text(file_info)
                 content.append({
-                    "type": "text", 
-                    "text": f"\n\n📄 **File: {file_info['name']}**\n```\n{file_info['content'][:2000]}{'...' if len(file_info['content']) > 2000 else ''}\n```"
+                    "type": "text",
+                    "text": text_block
+                })
+            elif file_info["category"] == "pdf":
+                job = self.pdf_extractor.job(file_info["pdf"])
+                done, total = job.progress() if job else (0, None)
+                content.append({
+                    "type": "text",
+                    "text": f"\n\n📎 **PDF**: {file_info['name']} (đang trích xuất nội dung, {done}/{total or '?'} trang)"
                 })
             else:
                 content.append({
@@ -422,11 +3627,349 @@ class AgentRouterAPI:
                 })
         
         return content
-    
-    def chat_completion(self, messages: List[Dict], model: str = "claude-sonnet-4-20250514", 
-                       max_tokens: int = 4000, temperature: float = 0.7) -> Optional[Dict]:
-        """Gửi request chat completion tới AgentRouter"""
+
+    @staticmethod
+    def _profile_csv(file, document: TextDocument) -> Optional[Dict]:
+        """Hồ sơ CSV của file (cache theo digest nội dung), None nếu không phân tích được"""
+        profile = _csv_profiles.get(document.digest)
+        if profile is None:
+            try:
+                file.seek(0)
+                profile = profile_csv(file, document.encoding)
+            except Exception:
+                return None
+            _csv_profiles.set(document.digest, profile)
+        return profile
+
+    def _document_text(self, file_info: Dict, max_chars: int = TEXT_ATTACH_CHARS) -> str:
+        """Nội dung file text gửi kèm: các đoạn được chọn (mặc định từ đầu) trong giới hạn max_chars"""
+        document = get_text_document(file_info["document"])
+        if document is None:
+            return f"\n\n📄 **File: {file_info['name']}** [Nội dung không còn khả dụng, vui lòng upload lại]"
+
+        selected = file_info.get("selected_chunks")
+        if selected is None:
+            selected = range(len(document))
+
+        parts = []
+        used = 0
+        for index in selected:
+            chunk = document.chunk(index)
+            if parts and used + len(chunk) > max_chars:
+                break
+            parts.append((index, chunk[:max_chars]))
+            used += len(chunk)
+
+        if len(parts) == len(document):
+            body = "".join(chunk for _, chunk in parts)
+            return f"\n\n📄 **File: {file_info['name']}**\n```\n{body}\n```"
+
+        def with_header(index: int, chunk: str) -> str:
+            # Đoạn CSV giữa file: lặp lại dòng tiêu đề để model hiểu các cột
+            return f"{document.header}\n{chunk}" if document.header and index > 0 else chunk
+
+        body = "\n".join(f"--- Đoạn {index + 1}/{len(document)} ---\n{with_header(index, chunk)}"
+                          for index, chunk in parts)
+        return (
+            f"\n\n📄 **File: {file_info['name']}** ({len(parts)}/{len(document)} đoạn)"
+            f"\n```\n{body}\n```"
+        )
+
+    def prepare_message(self, message: Dict) -> Dict:
+        """Chuyển tham chiếu blob trong một message thành base64 ngay trước khi gửi"""
+        content = message["content"]
+        if isinstance(content, list):
+            blocks = []
+            for item in content:
+                source = item.get("source") or {}
+                if item.get("type") == "image" and source.get("type") == "blob":
+                    data = self.blob_store.get(source["digest"])
+                    if data is None:
+                        blocks.append({"type": "text", "text": "\n\n🖼️ [Ảnh không còn khả dụng]"})
+                        continue
+                    # Giữ các field khác của block (ví dụ cache_control)
+                    item = dict(item, source={
+                        "type": "base64",
+                        "media_type": source["media_type"],
+                        "data": base64.b64encode(data).decode('utf-8')
+                    })
+                blocks.append(item)
+            content = blocks
+        return {"role": message["role"], "content": content}
+
+    def prepare_messages(self, messages: List[Dict]) -> List[Dict]:
+        """Chuyển tham chiếu blob trong messages thành base64 ngay trước khi gửi"""
+        return [self.prepare_message(message) for message in messages]
+
+    def _cache_key(self, messages: List[Dict], model: str, max_tokens: int, temperature: float,
+                   use_cache: Optional[bool]) -> Optional[str]:
+        """Key cache cho request, None nếu request này không dùng cache"""
+        if self.response_cache is None:
+            return None
+        if use_cache is None:
+            use_cache = temperature == 0
+        if not use_cache:
+            return None
+        return ResponseCache.make_key(model, messages, max_tokens, temperature, owner_key(self.api_key))
+
+    def _send(self, payload: Dict, stream: bool, fallback: bool = False,
+              info: Optional[Dict] = None, deadline: Optional[float] = None) -> Tuple[requests.Response, str]:
+        """Gửi request với retry/backoff, circuit breaker theo model và chuỗi model dự phòng.
+
+        Trả về (response 200, model thực sự trả lời). Lỗi 4xx không tạm thời được báo ngay,
+        lỗi tạm thời (timeout, mạng, 429/5xx) được thử lại rồi chuyển sang model dự phòng.
+        info (nếu có) nhận số byte gửi đi, thời gian kết nối, TTFB và số lần thử.
+        deadline (mốc time.monotonic) giới hạn tổng thời gian chờ header của mọi lần thử.
+        """
+        info = info if info is not None else {}
+        info["attempts"] = 0
+        models = [payload["model"]]
+        if fallback:
+            models += [m for m in self._fallback_models(payload) if m not in models]
+
+        last_error = None
+        for model in models:
+            breaker = self.circuit_breakers.get(model)
+            if not breaker.allow_request():
+                last_error = AgentRouterError(f"🚧 Model {model} đang tạm ngưng vì lỗi liên tiếp, thử lại sau.")
+                continue
+            try:
+                result, last_error = self._send_to_model(payload, model, stream, breaker, info, deadline)
+            except BaseException:
+                # Lỗi không do model (4xx của client, lỗi dựng payload...) không được giữ lượt thử half-open
+                breaker.release_probe()
+                raise
+            if result is not None:
+                return result
+
+        raise last_error
+
+    def _fallback_models(self, payload: Dict) -> List[str]:
+        """Chuỗi model dự phòng của payload, bỏ các model không nhận ảnh (khi có ảnh) hoặc context không đủ"""
+        messages = payload["messages"]
+        has_images = any(isinstance(message["content"], list) and
+                         any(item.get("type") == "image" for item in message["content"])
+                         for message in messages)
+        needed = sum(estimate_message_tokens(message) for message in messages) + payload.get("max_tokens", 0)
+        models = []
+        for model in MODEL_FALLBACKS.get(payload["model"], []):
+            if has_images and not self.model_catalog.supports(model, "vision"):
+                continue
+            if needed > (self.get_model(model) or {}).get("context_window", DEFAULT_CONTEXT_WINDOW):
+                continue
+            models.append(model)
+        return models
+
+    def _send_to_model(self, payload: Dict, model: str, stream: bool, breaker: CircuitBreaker,
+                       info: Dict, deadline: Optional[float] = None) -> Tuple[Optional[Tuple[requests.Response, str]], Optional[AgentRouterError]]:
+        """Gửi payload tới một model với retry/backoff; trả về ((response, model), None) khi thành công,
+        (None, lỗi cuối) khi hết lượt thử hoặc breaker ngắt. Lỗi 4xx không tạm thời được raise ngay."""
+        # Breakpoint prompt cache đặt theo model thực sự gửi (model dự phòng có thể không hỗ trợ)
+        messages = payload["messages"]
+        if PROMPT_CACHE_ENABLED and self.model_catalog.supports(model, "prompt_caching"):
+            messages = add_cache_breakpoints(
+                messages, self.get_model(model).get("cache_min_tokens", PROMPT_CACHE_MIN_TOKENS)
+            )
+
+        # Serialize một lần cho mọi lần thử (chỉ message mới, phần còn lại lấy từ cache),
+        # đồng thời biết chính xác số byte gửi đi
+        serialize_start = time.perf_counter()
+        body, extra_headers = self.payload_builder.build(dict(payload, model=model), messages,
+                                                         self.prepare_message)
+        info["serialize_seconds"] = time.perf_counter() - serialize_start
+        headers = dict(self.headers, **extra_headers) if extra_headers else self.headers
+        last_error = None
+        for attempt in range(self.retry_policy.max_attempts):
+            retry_after = None
+            key_limited = False
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AgentRouterError("⏱️ Request timeout. Vui lòng thử lại.")
+                timeout = (min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining))
+            if info["attempts"] and self.scheduler is not None:
+                # Lượt đầu đã lấy token khi được xếp lịch; thử lại/dự phòng cũng tính vào hạn mức của key
+                self.scheduler.throttle(self.api_key)
+            info["attempts"] += 1
+            info["request_bytes"] = len(body)
+            connect_timing = getattr(self.session, "connect_timing", None)
+            if connect_timing is not None:
+                connect_timing.seconds = 0.0
+            sent_at = time.perf_counter()
+            try:
+                response = self.session.post(
+                    f"{self.base_url}/v1/chat/completions",
+                    headers=headers,
+                    data=body,
+                    timeout=timeout,
+                    stream=stream
+                )
+            except requests.exceptions.Timeout:
+                last_error = AgentRouterError("⏱️ Request timeout. Vui lòng thử lại.")
+            except requests.exceptions.RequestException as e:
+                last_error = AgentRouterError(f"🌐 Network error: {e}")
+            else:
+                if response.status_code == 200:
+                    breaker.record_success()
+                    info["ttfb_seconds"] = time.perf_counter() - sent_at
+                    # httpx không đi qua adapter có đo giờ nên không có số liệu kết nối
+                    if connect_timing is not None:
+                        info["connect_seconds"] = connect_timing.seconds
+                    return (response, model), None
+
+                last_error = AgentRouterError(f"❌ {self._error_message(response)}")
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+                if response.status_code not in RETRY_STATUSES:
+                    # Lỗi của request (key sai, payload sai...) không tính là lỗi của model
+                    raise last_error
+                key_limited = response.status_code in KEY_LIMIT_STATUSES
+
+            if key_limited:
+                # Một key hết hạn mức không được ngắt model cho mọi session khác
+                breaker.release_probe()
+            else:
+                breaker.record_failure()
+            if attempt + 1 < self.retry_policy.max_attempts and breaker.allow_request():
+                time.sleep(self.retry_policy.delay(attempt, retry_after))
+            else:
+                break
+        return None, last_error
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        """Số giây chờ response trước khi hedge: percentile TTFB gần đây của model, None nếu chưa đủ mẫu"""
+        if self.metrics is None or self.metrics.count("ttfb_seconds", model) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, self.metrics.percentile("ttfb_seconds", model, HEDGE_PERCENTILE))
+
+    def _send_hedged(self, payload: Dict, stream: bool, fallback: bool,
+                     info: Dict, deadline: Optional[float] = None) -> Tuple[requests.Response, str]:
+        """Như _send, nhưng nếu chưa có response sau _hedge_delay thì gửi thêm một request (cùng model
+        hoặc HEDGE_ALTERNATES) khi còn ngân sách hedge và hạn mức của key; dùng response về trước,
+        response về sau bị đóng ngay (với stream là hủy luôn phần sinh tiếp ở upstream).
+        """
+        self.hedge_budget.record_request()
+        delay = self._hedge_delay(payload["model"])
+        if delay is None:
+            return self._send(payload, stream, fallback, info, deadline)
+
+        results = queue.Queue()
+        lock = threading.Lock()
+        # Luồng gọi giữ một chỗ của scheduler cho cả lượt gửi; lượt hedge lấy thêm một chỗ (slot_held),
+        # trả lại khi số lượt còn cần chỗ (đang chạy, cộng response thắng) không quá một
+        state = {"winner": None, "running": 0, "slot_held": False}
+        attempt_infos = []
+        # Kết nối đang chờ header của từng lượt (qua _request_hooks), để lượt thắng cắt lượt còn lại
+        connections = {}
+
+        def on_connection(label: str, connection):
+            with lock:
+                connections[label] = connection
+                lost = state["winner"] not in (None, label)
+            if lost:
+                # Không gửi/thử lại nữa: lượt kia đã thắng, dừng ngay để trả chỗ và kết nối
+                raise AgentRouterError("🔁 Lượt hedge khác đã trả lời trước")
+
+        def attempt(label: str, attempt_payload: Dict):
+            # Mỗi lượt có info riêng vì hai lượt chạy song song
+            attempt_info = {}
+            attempt_infos.append(attempt_info)
+            _request_hooks.on_connection = lambda connection: on_connection(label, connection)
+            try:
+                result, error = self._send(attempt_payload, stream, fallback, attempt_info, deadline), None
+            except Exception as e:
+                # Mọi lỗi đều phải về hàng đợi, nếu không luồng gọi chờ mãi
+                result, error = None, e
+            finally:
+                _request_hooks.on_connection = None
+            with lock:
+                lost = state["winner"] is not None
+                if not lost and error is None:
+                    state["winner"] = label
+                state["running"] -= 1
+                release_slot = state["slot_held"] and state["running"] + (state["winner"] is not None) <= 1
+                if release_slot:
+                    state["slot_held"] = False
+                losers = [c for other, c in connections.items() if other != label and c is not None] \
+                    if state["winner"] == label else []
+            # Lượt thua đang chờ upstream thì cắt kết nối: nó trả chỗ scheduler ngay thay vì chờ hết response
+            for connection in losers:
+                shutdown_socket(connection.sock)
+            if release_slot:
+                self.scheduler.release()
+            if lost:
+                if result is not None:
+                    result[0].close()
+                    # TTFB của lượt thua vẫn là một mẫu thật; bỏ đi thì ngưỡng hedge tụt dần
+                    if self.metrics is not None and "ttfb_seconds" in attempt_info:
+                        self.metrics.observe("ttfb_seconds", result[1], attempt_info["ttfb_seconds"])
+                return
+            results.put((label, result, error, attempt_info))
+
+        def start(label: str, attempt_payload: Dict, slot: bool = False):
+            with lock:
+                state["running"] += 1
+                state["slot_held"] = slot
+            threading.Thread(target=attempt, args=(label, attempt_payload), name="hedge", daemon=True).start()
+
+        start("primary", payload)
+        outstanding = 1
         try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            outcome = None
+            if self.hedge_budget.try_acquire():
+                # Lượt hedge cũng chiếm một chỗ trong max_concurrency và một token của key
+                if self.scheduler is None or self.scheduler.try_acquire(self.api_key):
+                    model = HEDGE_ALTERNATES.get(payload["model"], payload["model"])
+                    start("hedge", dict(payload, model=model), slot=self.scheduler is not None)
+                    outstanding += 1
+                    info["hedged"] = True
+                else:
+                    self.hedge_budget.refund()
+
+        while True:
+            label, result, error, attempt_info = outcome if outcome is not None else results.get()
+            outcome = None
+            outstanding -= 1
+            if error is None or outstanding == 0:
+                break
+
+        info.update(attempt_info)
+        info["attempts"] = sum(other.get("attempts", 0) for other in attempt_infos)
+        if error is not None:
+            raise error
+        if label == "hedge":
+            info["hedge_won"] = True
+            self.hedge_budget.record_win()
+        return result
+
+    def chat_completion(self, messages: List[Dict], model: str = "claude-sonnet-4-20250514",
+                       max_tokens: int = 4000, temperature: float = 0.7,
+                       use_cache: Optional[bool] = None, fallback: bool = False,
+                       info: Optional[Dict] = None, session_id: str = "",
+                       on_queue: Optional[Callable[[int, float], None]] = None,
+                       hedge: bool = False) -> Optional[Dict]:
+        """Gửi request chat completion tới AgentRouter (info, session_id, on_queue, hedge như chat_completion_stream)"""
+        info = info if info is not None else {}
+        info["model"] = model
+
+        cache_key = self._cache_key(messages, model, max_tokens, temperature, use_cache)
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                # Câu trả lời có thể đến từ model dự phòng: báo đúng model đã trả lời
+                info["model"] = cached.get("model", model)
+                info["cached"] = True
+                return cached
+
+        status = "error"
+        admitted = False
+        try:
+            self._admit(session_id, on_queue, info)
+            admitted = True
+            start = time.perf_counter()
             payload = {
                 "model": model,
                 "messages": messages,
@@ -434,65 +3977,494 @@ class AgentRouterAPI:
                 "temperature": temperature,
                 "stream": False
             }
-            
-            response = requests.post(
-                f"{self.base_url}/v1/chat/completions",
-                headers=self.headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                error_msg = f"API Error {response.status_code}"
-                try:
-                    error_detail = response.json()
-                    if "error" in error_detail:
-                        error_msg += f": {error_detail['error'].get('message', response.text)}"
-                except:
-                    error_msg += f": {response.text}"
-                
-                st.error(f"❌ {error_msg}")
-                return None
-                
+
+            send = self._send_hedged if hedge else self._send
+            response, info["model"] = send(payload, stream=False, fallback=fallback, info=info)
+            info["response_bytes"] = len(response.content)
+            result = response.json()
+            info["latency_seconds"] = time.perf_counter() - start
+            self._add_usage(info, result.get("usage"))
+            status = "ok"
+            if cache_key:
+                self.response_cache.set(cache_key, dict(result, model=info["model"]))
+            return result
+
+        except AgentRouterError as e:
+            info["error"] = str(e)
         except requests.exceptions.Timeout:
-            st.error("⏱️ Request timeout. Vui lòng thử lại.")
-            return None
+            info["error"] = "⏱️ Request timeout. Vui lòng thử lại."
         except requests.exceptions.RequestException as e:
-            st.error(f"🌐 Network error: {e}")
-            return None
+            info["error"] = f"🌐 Network error: {e}"
         except Exception as e:
-            st.error(f"❌ Unexpected error: {e}")
-            return None
+            info["error"] = f"❌ Unexpected error: {e}"
+        finally:
+            if admitted:
+                self._release()
+                self._record_metrics(info, status)
+        # Lỗi được báo trên UI và ghi vào info["error"] cho nơi gọi không chạy trong Streamlit
+        st.error(info["error"])
+        return None
 
-def render_message(message: Dict, model_name: str = ""):
-    """Render một tin nhắn chat"""
-    role = message["role"]
-    content = message["content"]
-    
-    # Extract text content
+    def chat_completion_stream(self, messages: List[Dict], model: str = "claude-sonnet-4-20250514",
+                               max_tokens: int = 4000, temperature: float = 0.7,
+                               use_cache: Optional[bool] = None, fallback: bool = False,
+                               info: Optional[Dict] = None, session_id: str = "",
+                               on_queue: Optional[Callable[[int, float], None]] = None,
+                               hedge: bool = False, deadline: Optional[float] = None,
+                               on_response: Optional[Callable[[requests.Response], None]] = None) -> Iterator[str]:
+        """Gửi request chat completion dạng stream, trả về từng đoạn text ngay khi nhận được.
+
+        Nếu truyền info (dict), nó được điền thông tin về request: model thực sự trả lời,
+        số byte, thời gian chờ trong hàng đợi, thời gian kết nối, TTFB, thời gian tới token đầu,
+        tổng thời gian và usage. Khi có scheduler, request xếp hàng theo session_id và
+        on_queue(vị trí, số giây đã chờ) được gọi định kỳ trong lúc chờ. hedge=True bật hedged
+        request (xem _send_hedged) để cắt đuôi latency. deadline (mốc time.monotonic) giới hạn thời gian
+        chờ header; on_response(response) được gọi khi bắt đầu đọc stream để nơi gọi đóng được nó
+        từ luồng khác (upstream im lặng thì vòng đọc không tự dừng được).
+        """
+        info = info if info is not None else {}
+        info["model"] = model
+
+        cache_key = self._cache_key(messages, model, max_tokens, temperature, use_cache)
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                info["model"] = cached.get("model", model)
+                info["cached"] = True
+                yield cached["choices"][0]["message"]["content"]
+                return
+
+        payload = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True,
+            # Yêu cầu event usage cuối stream để tính token/giây
+            "stream_options": {"include_usage": True}
+        }
+
+        status = "error"
+        self._admit(session_id, on_queue, info)
+        start = time.perf_counter()
+        try:
+            try:
+                # Chỉ thử lại trước khi nhận được response; stream đã bắt đầu thì không gửi lại
+                send = self._send_hedged if hedge else self._send
+                response, info["model"] = send(payload, stream=True, fallback=fallback, info=info,
+                                               deadline=deadline)
+            except AgentRouterError:
+                self._record_metrics(info, status)
+                raise
+            if on_response is not None:
+                on_response(response)
+
+            info["response_bytes"] = 0
+
+            def count_bytes(lines):
+                for line in lines:
+                    info["response_bytes"] += len(line) + 1
+                    yield line
+
+            with response:
+                try:
+                    parts = []
+                    usage = None
+                    # chunk_size=None: nhận từng chunk ngay khi tới thay vì chờ đầy buffer
+                    lines = count_bytes(response.iter_lines(chunk_size=None))
+                    for event in parse_sse_events(lines):
+                        if "error" in event:
+                            error = event["error"]
+                            detail = error.get("message", error) if isinstance(error, dict) else error
+                            raise AgentRouterError(f"❌ API Error: {detail}")
+                        if event.get("usage"):
+                            usage = event["usage"]
+
+                        for choice in event.get("choices") or []:
+                            text = (choice.get("delta") or {}).get("content")
+                            if text:
+                                if not parts:
+                                    info["ttft_seconds"] = time.perf_counter() - start
+                                parts.append(text)
+                                yield text
+
+                    # Đọc nốt phần sau [DONE] (chunk kết thúc) để kết nối quay lại pool thay vì bị đóng
+                    for _ in lines:
+                        pass
+                    info["latency_seconds"] = time.perf_counter() - start
+                    self._add_usage(info, usage)
+                    status = "ok"
+                    if cache_key and parts:
+                        self.response_cache.set(cache_key, {
+                            "model": info["model"],
+                            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)}}]
+                        })
+                except requests.exceptions.Timeout:
+                    raise AgentRouterError("⏱️ Request timeout. Vui lòng thử lại.")
+                except requests.exceptions.RequestException as e:
+                    raise AgentRouterError(f"🌐 Network error: {e}")
+                except json.JSONDecodeError as e:
+                    raise AgentRouterError(f"❌ Stream không hợp lệ: {e}")
+                except GeneratorExit:
+                    status = "cancelled"
+                    raise
+                finally:
+                    self._record_metrics(info, status)
+        finally:
+            self._release()
+
+    @staticmethod
+    def _add_usage(info: Dict, usage: Optional[Dict]):
+        """Thêm số token (kể cả token prompt cache) từ usage và tốc độ sinh token (stream tính từ token đầu tiên)"""
+        if not usage:
+            return
+        info["prompt_tokens"] = usage.get("prompt_tokens")
+        info["completion_tokens"] = usage.get("completion_tokens")
+        # Token đọc/ghi prompt cache: trường kiểu Anthropic, hoặc prompt_tokens_details kiểu OpenAI
+        details = usage.get("prompt_tokens_details") or {}
+        info["cache_read_tokens"] = usage.get("cache_read_input_tokens", details.get("cached_tokens"))
+        info["cache_write_tokens"] = usage.get("cache_creation_input_tokens")
+        generation = info.get("latency_seconds", 0) - info.get("ttft_seconds", 0)
+        if info["completion_tokens"] and generation > 0:
+            info["tokens_per_second"] = info["completion_tokens"] / generation
+
+    def _admit(self, session_id: str, on_queue: Optional[Callable[[int, float], None]], info: Dict):
+        """Xin lượt gửi từ scheduler dùng chung (nếu có); request bị từ chối vẫn được ghi số liệu"""
+        if self.scheduler is None:
+            return
+        try:
+            info["queue_seconds"] = self.scheduler.acquire(self.api_key, session_id, on_queue)
+        except AgentRouterError:
+            self._record_metrics(info, "rejected")
+            raise
+
+    def _release(self):
+        if self.scheduler is not None:
+            self.scheduler.release()
+
+    def _record_metrics(self, info: Dict, status: str):
+        if self.metrics is not None:
+            self.metrics.record(info.get("model", ""), info, status)
+
+    def chat_completion_compare(self, requests_by_model: Dict[str, List[Dict]], max_tokens: int = 4000,
+                                temperature: float = 0.7, use_cache: Optional[bool] = None,
+                                executor: Optional[ThreadPoolExecutor] = None,
+                                session_id: str = "") -> Iterator[Tuple[str, str, object]]:
+        """Gửi song song tới nhiều model, trả về event (model, "delta"/"done"/"error", dữ liệu) theo thứ tự đến"""
+        events = queue.Queue()
+        cancelled = threading.Event()
+
+        def run(model: str, messages: List[Dict]):
+            start = time.perf_counter()
+            ttft = None
+            stream = self.chat_completion_stream(messages, model, max_tokens, temperature, use_cache,
+                                                 session_id=session_id)
+            try:
+                for text in stream:
+                    if cancelled.is_set():
+                        return
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    events.put((model, "delta", text))
+                events.put((model, "done", {"ttft": ttft, "latency": time.perf_counter() - start}))
+            except AgentRouterError as e:
+                events.put((model, "error", str(e)))
+            except Exception as e:
+                events.put((model, "error", f"❌ Lỗi: {e}"))
+            finally:
+                stream.close()
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max(1, len(requests_by_model)))
+        for model, messages in requests_by_model.items():
+            executor.submit(run, model, messages)
+
+        try:
+            pending = len(requests_by_model)
+            while pending:
+                event = events.get()
+                if event[1] != "delta":
+                    pending -= 1
+                yield event
+        finally:
+            # Người dùng rời trang/rerun giữa chừng: dừng các stream còn lại
+            cancelled.set()
+            if own_executor:
+                executor.shutdown(wait=False)
+
+    def _error_message(self, response) -> str:
+        """Tạo thông báo lỗi từ response không thành công"""
+        error_msg = f"API Error {response.status_code}"
+        try:
+            error_detail = response.json()
+            if "error" in error_detail:
+                error_msg += f": {error_detail['error'].get('message', response.text)}"
+        except:
+            error_msg += f": {response.text}"
+        return error_msg
+
+@st.cache_resource(show_spinner=False)
+def get_state_backend():
+    """Backend trạng thái dùng chung giữa các replica, None nếu mỗi process tự giữ trạng thái"""
+    return create_state_backend(STATE_BACKEND) if STATE_BACKEND else None
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_store():
+    """Kho hội thoại dùng chung (trên backend trạng thái hoặc SQLite), None nếu không có chỗ để lưu"""
+    backend = get_state_backend()
+    if backend is not None:
+        return SharedConversationStore(backend)
+    if not CONVERSATION_DB:
+        return None
+    try:
+        return ConversationStore(CONVERSATION_DB)
+    except sqlite3.Error:
+        return None
+
+@st.cache_resource(show_spinner=False)
+def get_blob_store() -> BlobStore:
+    """Kho blob dùng chung cho mọi session trong process"""
+    return BlobStore(persistent=get_conversation_store() is not None, backend=get_state_backend())
+
+@st.cache_resource(show_spinner=False)
+def get_compare_executor() -> ThreadPoolExecutor:
+    """Pool luồng có giới hạn, dùng chung cho các lượt so sánh của mọi session"""
+    return ThreadPoolExecutor(max_workers=COMPARE_POOL_SIZE, thread_name_prefix="compare")
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """Cache phản hồi dùng chung cho mọi session trong process (và các replica nếu có backend dùng chung)"""
+    return ResponseCache(backend=get_state_backend())
+
+@st.cache_resource(show_spinner=False)
+def get_metrics() -> MetricsRegistry:
+    """Số liệu hiệu năng dùng chung, mở endpoint /metrics và /ready nếu đặt METRICS_PORT"""
+    metrics = MetricsRegistry()
+    if METRICS_PORT:
+        try:
+            start_metrics_server(metrics, METRICS_PORT, readiness=get_warmup().status)
+        except OSError:
+            # Port đã bị chiếm (vd. nhiều process), vẫn giữ số liệu trong process
+            pass
+    return metrics
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Connection pool dùng chung cho mọi client, để kết nối đã mở sẵn (warm-up) phục vụ mọi session"""
+    return create_http_session(pool_size=max(HTTP_POOL_SIZE, SCHEDULER_MAX_CONCURRENCY))
+
+@st.cache_resource(show_spinner=False)
+def get_warmup() -> Warmup:
+    """Khởi động nóng một lần cho cả process: tạo sẵn tài nguyên dùng chung rồi chạy phần chậm ở nền"""
+    warmup = Warmup(get_http_session(), DEFAULT_BASE_URL)
+    if WARMUP_ENABLED:
+        get_conversation_store()
+        get_blob_store()
+        get_model_catalog(DEFAULT_BASE_URL)
+        warmup.start()
+    else:
+        warmup.ready.set()
+    return warmup
+
+@st.cache_resource(show_spinner=False)
+def get_page_style() -> str:
+    """Thẻ <style> của trang, đã bỏ comment và khoảng trắng thừa (tính một lần cho cả process)"""
+    css = re.sub(r"/\*.*?\*/", "", PAGE_CSS, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    return f"<style>{css.strip()}</style>"
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_extractor() -> PdfExtractor:
+    """Process pool trích xuất PDF dùng chung cho mọi session"""
+    return PdfExtractor()
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler() -> UpstreamScheduler:
+    """Scheduler dùng chung: giới hạn request đồng thời và hạn mức theo API key cho mọi session"""
+    return UpstreamScheduler(backend=get_state_backend())
+
+@st.cache_resource(show_spinner=False)
+def get_hedge_budget() -> HedgeBudget:
+    """Ngân sách hedge dùng chung, để tổng số request hedge của process không vượt HEDGE_BUDGET"""
+    return HedgeBudget()
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager() -> JobManager:
+    """Worker chạy nền cho các lượt sinh của mọi session"""
+    return JobManager()
+
+@st.cache_resource(show_spinner=False)
+def get_payload_builder() -> PayloadBuilder:
+    """Cache bytes message đã serialize dùng chung (key theo nội dung nên an toàn giữa các API key)"""
+    return PayloadBuilder()
+
+@st.cache_resource(show_spinner=False)
+def get_model_catalog(base_url: str = DEFAULT_BASE_URL) -> ModelCatalog:
+    """Danh mục model dùng chung cho mọi session trỏ tới cùng base URL"""
+    return ModelCatalog(base_url.rstrip('/'))
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breakers() -> CircuitBreakerRegistry:
+    """Circuit breaker theo model dùng chung, để mọi session cùng tránh model đang lỗi"""
+    return CircuitBreakerRegistry()
+
+def owner_key(api_key: str) -> str:
+    """Khóa chủ sở hữu hội thoại (hash của API key, không lưu key gốc)"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def save_message(message: Dict):
+    """Thêm message vào session và ghi vào kho hội thoại (nếu bật)"""
+    st.session_state.messages.append(message)
+    store = get_conversation_store()
+    if store is None:
+        return
+
+    if not st.session_state.conversation_id:
+        title = content_text(message["content"]).strip()[:100] or "Cuộc trò chuyện mới"
+        st.session_state.conversation_id = store.create_conversation(owner_key(st.session_state.api_key), title)
+        st.query_params["c"] = st.session_state.conversation_id
+
+    blob_store = get_blob_store()
+    # Không có chỗ lưu blob lâu dài (thiếu BLOB_SPILL_DIR và backend dùng chung): tin nhắn vẫn được lưu
+    # nhưng ảnh sẽ mất khi process khởi động lại, nên phải báo cho người dùng biết
+    lost = sum(not blob_store.persist(digest) for digest in message_blob_digests(message))
+    # Kho hội thoại trong RAM (memory://) thì cả hội thoại cũng mất khi khởi động lại, không cần báo riêng ảnh
+    if lost and getattr(getattr(store, "backend", None), "shared", True):
+        st.toast(f"⚠️ {lost} ảnh chỉ nằm trong bộ nhớ, sẽ không còn khi mở lại hội thoại sau khi ứng dụng khởi động lại")
+    store.append_message(st.session_state.conversation_id, message)
+
+def release_messages(messages: List[Dict]):
+    """Bỏ tham chiếu blob của các message không còn giữ trong session"""
+    blob_store = get_blob_store()
+    for message in messages:
+        for digest in message_blob_digests(message):
+            blob_store.decref(digest, st.session_state.session_id)
+
+def resume_conversation(conversation_id: str) -> bool:
+    """Nạp lại RESUME_PAGES trang cuối của một hội thoại đã lưu vào session"""
+    store = get_conversation_store()
+    conversation = store.get_conversation(conversation_id) if store else None
+    if conversation is None or conversation["owner"] != owner_key(st.session_state.api_key):
+        return False
+
+    release_messages(st.session_state.messages)
+    total = store.count_messages(conversation_id)
+    # Bắt đầu ở ranh giới trang để các trang lịch sử giữ nguyên khi tải thêm
+    total_pages = -(-total // HISTORY_PAGE_SIZE)
+    offset = max(0, total_pages - RESUME_PAGES) * HISTORY_PAGE_SIZE
+    messages = store.load_messages(conversation_id, offset, total - offset)
+
+    blob_store = get_blob_store()
+    for message in messages:
+        for digest in message_blob_digests(message):
+            blob_store.incref(digest, st.session_state.session_id)
+
+    # Lượt sinh đang chạy vẫn được lưu vào hội thoại cũ, chỉ không hiện trong hội thoại vừa mở
+    st.session_state.active_job = None
+    st.session_state.conversation_id = conversation_id
+    st.session_state.messages = messages
+    st.session_state.history_offset = offset
+    st.session_state.history_pages = 1
+    st.session_state.retrieval_index = ConversationIndex()
+    return True
+
+def load_older_messages(start: int):
+    """Tải thêm các message cũ (từ vị trí tuyệt đối start) từ kho hội thoại vào đầu lịch sử"""
+    store = get_conversation_store()
+    offset = st.session_state.history_offset
+    if store is None or not st.session_state.conversation_id or start >= offset:
+        return
+
+    older = store.load_messages(st.session_state.conversation_id, start, offset - start)
+    blob_store = get_blob_store()
+    for message in older:
+        for digest in message_blob_digests(message):
+            blob_store.incref(digest, st.session_state.session_id)
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.history_offset = start
+
+@st.cache_resource(max_entries=100, show_spinner=False)
+def get_api_client(api_key: str, base_url: str = DEFAULT_BASE_URL) -> AgentRouterAPI:
+    """Lấy client dùng chung toàn process cho mỗi cặp (API key, base URL), giữ kết nối giữa các lần rerun"""
+    return AgentRouterAPI(api_key, base_url, session=get_http_session(),
+                          blob_store=get_blob_store(), response_cache=get_response_cache(),
+                          circuit_breakers=get_circuit_breakers(), metrics=get_metrics(),
+                          pdf_extractor=get_pdf_extractor(), scheduler=get_scheduler(),
+                          model_catalog=get_model_catalog(base_url), hedge_budget=get_hedge_budget(),
+                          payload_builder=get_payload_builder())
+
+def content_text(content) -> str:
+    """Lấy phần text của nội dung message (chuỗi hoặc danh sách block)"""
     if isinstance(content, list):
         text_content = ""
         for item in content:
             if item.get("type") == "text":
                 text_content += item.get("text", "")
+        return text_content
+    return content
+
+def format_message_html(message: Dict, model_name: str = "") -> str:
+    """Tạo HTML cho một tin nhắn chat"""
+    role = message["role"]
+    text_content = content_text(message["content"])
+
+    # Message đã lưu được render một lần rồi dùng lại ở các lần rerun sau
+    cache_key = None
+    if message.get("id"):
+        content_hash = hashlib.sha1(text_content.encode('utf-8')).hexdigest()
+        cache_key = (message["id"], content_hash, model_name)
+        cached = _render_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    if message.get("compare"):
+        html = _build_compare_html(message["compare"])
     else:
-        text_content = content
-    
+        html = _build_message_html(role, text_content, model_name)
+    if cache_key:
+        _render_cache.set(cache_key, html)
+    return html
+
+def _build_compare_html(results: List[Dict]) -> str:
+    """HTML cho một lượt so sánh: mỗi model một cột kèm độ trễ"""
+    columns = []
+    for result in results:
+        latency = ""
+        if result.get("latency") is not None:
+            latency = f"TTFT {result['ttft']:.2f}s · tổng {result['latency']:.2f}s" if result.get("ttft") is not None \
+                else f"tổng {result['latency']:.2f}s"
+        columns.append(f"""
+            <div class="message-bubble assistant-bubble">
+                <div style="font-size: 0.8rem; color: #666; margin-bottom: 0.5rem;">
+                    {result['model_name']}
+                </div>
+                {result['content'].replace(chr(10), '<br>')}
+                <div class="compare-latency">{latency}</div>
+            </div>
+        """)
+    return f"""
+        <div class="message-container">
+            <div class="message-avatar assistant-avatar">🤖</div>
+            <div class="compare-grid" style="flex: 1;">{''.join(columns)}</div>
+        </div>
+        """
+
+def _build_message_html(role: str, text_content: str, model_name: str) -> str:
     if role == "user":
         formatted_content = text_content.replace('\n', '<br>')
-        st.markdown(f"""
+        return f"""
         <div class="message-container user-message">
             <div class="message-avatar user-avatar">👤</div>
             <div class="message-bubble user-bubble">
                 {formatted_content}
             </div>
         </div>
-        """, unsafe_allow_html=True)
+        """
     else:
         formatted_content = text_content.replace('\n', '<br>')
-        st.markdown(f"""
+        return f"""
         <div class="message-container">
             <div class="message-avatar assistant-avatar">🤖</div>
             <div class="message-bubble assistant-bubble">
@@ -502,7 +4474,182 @@ def render_message(message: Dict, model_name: str = ""):
                 {formatted_content}
             </div>
         </div>
-        """, unsafe_allow_html=True)
+        """
+
+def render_message(message: Dict, model_name: str = ""):
+    """Render một tin nhắn chat"""
+    st.markdown(format_message_html(message, model_name), unsafe_allow_html=True)
+
+@_fragment
+def render_history(model_names: Dict[str, str], default_model_name: str):
+    """Render lịch sử chat theo trang cố định tính từ đầu cuộc trò chuyện.
+
+    Trang đã đầy không đổi giữa các lần rerun nên Streamlit gửi lại bằng hash cache,
+    chỉ trang cuối (lượt mới) thực sự được vẽ lại. Trang cũ chỉ tải (từ kho hội thoại
+    nếu chưa nằm trong session) khi người dùng yêu cầu.
+    """
+    offset = st.session_state.history_offset
+    total_pages = -(-(offset + len(st.session_state.messages)) // HISTORY_PAGE_SIZE)
+    # Luôn hiện trang cuối (có thể chưa đầy) cùng history_pages trang đầy trước nó
+    first_page = max(0, total_pages - 1 - st.session_state.history_pages)
+    if first_page > 0 and st.button("⬆️ Xem tin nhắn cũ hơn", key="load_older_messages"):
+        st.session_state.history_pages += 1
+        first_page -= 1
+    if first_page * HISTORY_PAGE_SIZE < offset:
+        load_older_messages(first_page * HISTORY_PAGE_SIZE)
+        offset = st.session_state.history_offset
+
+    messages = st.session_state.messages
+    for page in range(first_page, total_pages):
+        start = max(0, page * HISTORY_PAGE_SIZE - offset)
+        page_messages = messages[start:(page + 1) * HISTORY_PAGE_SIZE - offset]
+        st.markdown("".join(
+            format_message_html(message, model_names.get(message.get("model"), default_model_name))
+            for message in page_messages
+        ), unsafe_allow_html=True)
+
+def run_compare_turn(api_client: AgentRouterAPI, models_by_id: Dict[str, Dict], model_ids: List[str],
+                     max_tokens: int, temperature: float, context_budget: Optional[int], pin_first: bool,
+                     use_cache: Optional[bool],
+                     retrieval_index: Optional[ConversationIndex] = None) -> Optional[Dict]:
+    """Gửi lượt hiện tại tới nhiều model cùng lúc, mỗi model một cột; trả về message kết quả"""
+    reserve = RETRIEVAL_TOKEN_BUDGET if retrieval_index is not None else 0
+    requests_by_model = {}
+    for model_id in model_ids:
+        context_messages = select_context_window(
+            st.session_state.messages,
+            models_by_id[model_id].get("context_window", DEFAULT_CONTEXT_WINDOW),
+            max_tokens, budget=context_budget, pin_first=pin_first, reserve=reserve
+        )
+        if retrieval_index is not None:
+            context_messages, _ = add_retrieved_context(retrieval_index, st.session_state.messages, context_messages)
+        requests_by_model[model_id] = context_messages
+
+    columns = st.columns(len(model_ids))
+    placeholders = {}
+    captions = {}
+    for column, model_id in zip(columns, model_ids):
+        with column:
+            placeholders[model_id] = st.empty()
+            with placeholders[model_id]:
+                show_typing_indicator()
+            captions[model_id] = st.empty()
+
+    replies = {model_id: "" for model_id in model_ids}
+    results = {}
+    last_render = {model_id: 0.0 for model_id in model_ids}
+
+    for model_id, kind, data in api_client.chat_completion_compare(
+        requests_by_model, max_tokens, temperature, use_cache, executor=get_compare_executor(),
+        session_id=st.session_state.session_id
+    ):
+        model_name = models_by_id[model_id]["name"]
+        if kind == "delta":
+            replies[model_id] += data
+            now = time.monotonic()
+            if now - last_render[model_id] < STREAM_RENDER_INTERVAL:
+                continue
+            last_render[model_id] = now
+            placeholders[model_id].markdown(
+                format_message_html({"role": "assistant", "content": replies[model_id] + "▌"}, model_name),
+                unsafe_allow_html=True
+            )
+        elif kind == "done":
+            placeholders[model_id].markdown(
+                format_message_html({"role": "assistant", "content": replies[model_id]}, model_name),
+                unsafe_allow_html=True
+            )
+            ttft = f"{data['ttft']:.2f}s" if data["ttft"] is not None else "—"
+            captions[model_id].caption(f"⏱️ TTFT {ttft} · tổng {data['latency']:.2f}s")
+            results[model_id] = {"model": model_id, "model_name": model_name, "content": replies[model_id], **data}
+        else:
+            placeholders[model_id].error(data)
+            results[model_id] = {"model": model_id, "model_name": model_name, "content": data,
+                                 "ttft": None, "latency": None, "error": True}
+
+    succeeded = [model_id for model_id in model_ids if not results[model_id].get("error") and results[model_id]["content"]]
+    if not succeeded:
+        return None
+
+    # Câu trả lời của model đang chọn (hoặc model đầu tiên thành công) là nội dung chính của lượt
+    primary = st.session_state.selected_model if st.session_state.selected_model in succeeded else succeeded[0]
+    return {
+        "id": str(uuid.uuid4()),
+        "role": "assistant",
+        "content": results[primary]["content"],
+        "model": primary,
+        "compare": [results[model_id] for model_id in model_ids]
+    }
+
+@_polling_fragment
+def render_pdf_progress(pending: List[Dict]):
+    """Tiến độ trích xuất các file PDF đang xử lý; xong thì chạy lại cả trang để đính kèm nội dung"""
+    api_client = get_api_client(st.session_state.api_key)
+    finished = False
+    for file_info in pending:
+        if api_client.refresh_pdf(file_info):
+            finished = True
+            continue
+        job = api_client.pdf_extractor.job(file_info["pdf"])
+        done, total = job.progress() if job else (0, None)
+        st.progress(done / total if total else 0.0, text=f"📄 {file_info['name']}: {done}/{total or '?'} trang")
+    if finished:
+        st.rerun()
+
+def attach_job(job_manager: JobManager, model_names: Dict[str, str], default_model_name: str):
+    """Vẽ output của lượt sinh đang chạy tới khi xong rồi nhận kết quả vào lịch sử.
+
+    Rerun giữa chừng chỉ dừng vòng vẽ này, job vẫn chạy; lần chạy script sau gắn lại từ đầu.
+    """
+    job = job_manager.get(st.session_state.active_job, st.session_state.session_id)
+    if job is None:
+        # Job đã hết hạn giữ (hoặc process vừa khởi động lại)
+        st.session_state.active_job = None
+        return
+
+    model_name = model_names.get(job.model, default_model_name)
+    placeholder = st.empty()
+    if not job.done and st.button("⏹️ Dừng trả lời", key=f"cancel_job_{job.id}"):
+        job.cancel()
+
+    # Chỉ vẽ lại khi có text mới hoặc vị trí hàng đợi đổi, không gửi lại cùng một HTML mỗi lần chờ
+    rendered = None
+    while not job.wait(STREAM_RENDER_INTERVAL):
+        # Đọc session_state là điểm Streamlit kiểm tra yêu cầu rerun/dừng (bấm nút Dừng, đổi widget);
+        # thiếu nó thì lúc chờ token đầu hay xếp hàng script không nhận được tương tác nào
+        st.session_state.get("active_job")
+        state = (job.length, job.queue_position)
+        if state == rendered:
+            continue
+        rendered = state
+        if job.length:
+            placeholder.markdown(
+                format_message_html({"role": "assistant", "content": job.text() + "▌"}, model_name),
+                unsafe_allow_html=True
+            )
+        elif job.queue_position is not None:
+            placeholder.info(f"⏳ Đang xếp hàng chờ gửi: vị trí {job.queue_position}")
+        else:
+            with placeholder:
+                show_typing_indicator()
+
+    job_manager.pop(job.id)
+    st.session_state.active_job = None
+    message = job.message()
+    if message is not None:
+        # Worker đã ghi vào kho hội thoại, ở đây chỉ thêm vào session
+        st.session_state.messages.append(message)
+        if job.status == "done":
+            st.session_state.files = []
+        if message["model"] != job.model:
+            fallback_model = model_names.get(message["model"], message["model"])
+            st.toast(f"🔁 {model_name} đang lỗi, đã trả lời bằng {fallback_model}")
+    if job.error:
+        st.session_state.job_error = job.error
+    elif message is None and job.status == "done":
+        st.session_state.job_error = "❌ Không nhận được phản hồi từ AI. Vui lòng thử lại."
+    # Luôn rerun: phần text đã nhận hiện trong lịch sử và ô nhập được mở lại; lỗi hiện ở lần chạy sau
+    st.rerun()
 
 def show_typing_indicator():
     """Hiển thị typing indicator"""
@@ -552,15 +4699,39 @@ def render_welcome_screen():
     """, unsafe_allow_html=True)
 
 def main():
+    st.set_page_config(**PAGE_CONFIG)
+    st.markdown(get_page_style(), unsafe_allow_html=True)
+    # Lần chạy đầu của process bắt đầu warm-up; các lần sau báo còn người dùng để giữ kết nối
+    get_warmup().touch()
+    get_metrics()
+
     # Khởi tạo session state
     if "messages" not in st.session_state:
         st.session_state.messages = []
     if "files" not in st.session_state:
         st.session_state.files = []
+    if "processed_files" not in st.session_state:
+        st.session_state.processed_files = {}
+    if "history_pages" not in st.session_state:
+        st.session_state.history_pages = 1
+    if "history_offset" not in st.session_state:
+        st.session_state.history_offset = 0
+    if "conversation_id" not in st.session_state:
+        st.session_state.conversation_id = None
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())
+    # Session còn chạy script thì tham chiếu blob của nó còn hiệu lực
+    get_blob_store().touch(st.session_state.session_id)
+    if "retrieval_index" not in st.session_state:
+        st.session_state.retrieval_index = ConversationIndex()
     if "api_key" not in st.session_state:
         st.session_state.api_key = ""
     if "selected_model" not in st.session_state:
         st.session_state.selected_model = "claude-sonnet-4-20250514"
+    if "active_job" not in st.session_state:
+        st.session_state.active_job = None
+    if "job_error" not in st.session_state:
+        st.session_state.job_error = None
     
     # Header
     st.markdown("""
@@ -588,9 +4759,19 @@ def main():
         st.session_state.api_key = api_key
         
         if api_key:
+            # Tiếp tục hội thoại đã lưu theo ?c=<id> trên URL
+            requested_conversation = st.query_params.get("c")
+            if requested_conversation and requested_conversation != st.session_state.conversation_id:
+                if not resume_conversation(requested_conversation):
+                    st.warning("⚠️ Không tìm thấy hội thoại đã lưu.")
+                    st.query_params.pop("c", None)
+
             # Model selection
-            api_client = AgentRouterAPI(api_key)
+            api_client = get_api_client(api_key)
             models = api_client.get_available_models()
+            # Model đã chọn có thể không còn trong danh mục mới nhất
+            if api_client.get_model(st.session_state.selected_model) is None:
+                st.session_state.selected_model = models[0]['id']
             
             st.subheader("🤖 Chọn AI Model")
             for model in models:
@@ -603,20 +4784,139 @@ def main():
                     st.session_state.selected_model = model['id']
             
             # Hiển thị model đang chọn
-            current_model = next((m for m in models if m['id'] == st.session_state.selected_model), models[0])
+            current_model = api_client.get_model(st.session_state.selected_model)
             st.info(f"🎯 **Đang sử dụng**: {current_model['name']}")
             
             # Parameters
             st.subheader("🎛️ Tham số")
             temperature = st.slider("Temperature", 0.0, 2.0, 0.7, 0.1)
             max_tokens = st.slider("Max Tokens", 100, 8000, 4000, 100)
-            
-            # Clear chat
+            context_budget = st.number_input(
+                "Giới hạn context (token, 0 = theo model)", 0, 1000000, 0, 1000,
+                help="Bỏ bớt tin nhắn cũ nhất để lịch sử gửi lên không vượt quá giới hạn này"
+            )
+            pin_first = st.checkbox("📌 Luôn giữ tin nhắn đầu tiên", value=False)
+            # Ghim từng tin nhắn trong phiên: trạng thái nằm ngay trên message (pinned) mà select_context_window đọc
+            pinnable = {message["id"]: message for message in st.session_state.messages if message.get("id")}
+            if pinnable:
+                pinned_ids = st.multiselect(
+                    "📌 Ghim tin nhắn", list(pinnable),
+                    default=[message_id for message_id, message in pinnable.items() if message.get("pinned")],
+                    format_func=lambda message_id: (
+                        f"{'👤' if pinnable[message_id]['role'] == 'user' else '🤖'} "
+                        f"{content_text(pinnable[message_id]['content']).strip()[:60]}"
+                    ),
+                    help="Tin nhắn được ghim luôn được gửi lên, kể cả khi tin nhắn cũ bị bỏ bớt để vừa context"
+                )
+                for message_id, message in pinnable.items():
+                    if message_id in pinned_ids:
+                        message["pinned"] = True
+                    else:
+                        message.pop("pinned", None)
+            use_cache = st.checkbox(
+                "⚡ Dùng cache phản hồi", value=False,
+                help="Trả lại kết quả đã có cho đúng cùng một yêu cầu (luôn bật khi Temperature = 0)"
+            )
+            if api_client.response_cache is not None:
+                cache_stats = api_client.response_cache.stats()
+                st.caption(f"Cache: {cache_stats['hits']} hit / {cache_stats['misses']} miss")
+            use_fallback = st.checkbox(
+                "🔁 Tự chuyển model dự phòng khi lỗi", value=True,
+                help="Khi model đang chọn quá tải hoặc lỗi liên tục, gửi sang model dự phòng cùng dòng"
+            )
+            use_hedge = st.checkbox(
+                "🏁 Gửi thêm request khi phản hồi chậm", value=False,
+                help="Nếu chưa có phản hồi sau mức p95 gần đây của model, gửi thêm một request và dùng kết quả về trước"
+            )
+            use_retrieval = st.checkbox(
+                "🔎 Tự tìm đoạn liên quan", value=True,
+                help="Thêm các đoạn khớp nhất từ tài liệu đã gửi và các lượt chat cũ (ngoài context) vào tin nhắn"
+            )
+
+            # So sánh nhiều model
+            st.subheader("⚖️ So sánh model")
+            compare_mode = st.checkbox("Gửi cùng lúc tới nhiều model", value=False)
+            compare_models = []
+            if compare_mode:
+                model_names = {m['id']: m['name'] for m in models}
+                compare_models = st.multiselect(
+                    "Model so sánh",
+                    list(model_names),
+                    default=[st.session_state.selected_model],
+                    format_func=lambda model_id: model_names[model_id],
+                    max_selections=COMPARE_MAX_MODELS
+                )
+
+            # Clear chat (hội thoại đã lưu vẫn còn trong kho, phiên mới bắt đầu hội thoại mới)
             if st.button("🗑️ Xóa lịch sử", use_container_width=True):
+                job = get_job_manager().get(st.session_state.active_job, st.session_state.session_id)
+                if job is not None:
+                    job.cancel()
+                st.session_state.active_job = None
+                release_messages(st.session_state.messages)
                 st.session_state.messages = []
                 st.session_state.files = []
+                st.session_state.history_pages = 1
+                st.session_state.history_offset = 0
+                st.session_state.conversation_id = None
+                st.session_state.retrieval_index = ConversationIndex()
+                st.query_params.pop("c", None)
                 st.rerun()
-    
+
+            # Hội thoại đã lưu trên disk
+            store = get_conversation_store()
+            if store is not None:
+                st.subheader("💬 Hội thoại đã lưu")
+                for conversation in store.list_conversations(owner_key(api_key)):
+                    if st.button(
+                        conversation["title"],
+                        key=f"conversation_{conversation['id']}",
+                        use_container_width=True
+                    ):
+                        st.query_params["c"] = conversation["id"]
+                        st.rerun()
+
+            # Số liệu hiệu năng theo model (cùng dữ liệu với endpoint /metrics)
+            with st.expander("📊 Hiệu năng theo model"):
+                summary = api_client.metrics.summary() if api_client.metrics is not None else []
+                if summary:
+                    def ms(value):
+                        return None if value is None else round(value * 1000)
+                    st.dataframe([
+                        {
+                            "Model": row["model"],
+                            "Request": row["requests"],
+                            "p50 (ms)": ms(row["latency_p50"]),
+                            "p95 (ms)": ms(row["latency_p95"]),
+                            "p99 (ms)": ms(row["latency_p99"]),
+                            "TTFT p50 (ms)": ms(row["ttft_p50"]),
+                            "Token/s p50": None if row["tokens_per_second_p50"] is None else round(row["tokens_per_second_p50"], 1),
+                            "Cache đọc (token)": int(row["cache_read_tokens"]),
+                            "Cache ghi (token)": int(row["cache_write_tokens"]),
+                        }
+                        for row in summary
+                    ], hide_index=True, use_container_width=True)
+                else:
+                    st.caption("Chưa có request nào.")
+                if api_client.scheduler is not None:
+                    queue_stats = api_client.scheduler.stats()
+                    st.caption(
+                        f"Hàng đợi: {queue_stats['waiting']} đang chờ, {queue_stats['in_flight']}/"
+                        f"{api_client.scheduler.max_concurrency} đang gửi, chờ TB {queue_stats['average_wait']:.1f} giây, "
+                        f"{queue_stats['rejected']} bị từ chối"
+                    )
+                hedge_stats = api_client.hedge_budget.stats()
+                if hedge_stats["hedged"]:
+                    st.caption(
+                        f"Hedge: {hedge_stats['hedged']}/{hedge_stats['requests']} request, "
+                        f"{hedge_stats['won']} lần về trước"
+                    )
+                job_stats = get_job_manager().stats()
+                if job_stats["running"]:
+                    st.caption(f"Job nền: {job_stats['running']} đang chạy")
+                if METRICS_PORT:
+                    st.caption(f"Prometheus: http://<host>:{METRICS_PORT}/metrics")
+
     # Main content
     st.markdown('<div class="main-content">', unsafe_allow_html=True)
     
@@ -624,25 +4924,22 @@ def main():
         st.warning("🔑 Vui lòng nhập AgentRouter API Key trong sidebar để bắt đầu!")
         render_welcome_screen()
     else:
-        # Model selector nổi
-        api_client = AgentRouterAPI(st.session_state.api_key)
-        models = api_client.get_available_models()
-        current_model = next((m for m in models if m['id'] == st.session_state.selected_model), models[0])
-        
-        model_options = [f"{m['name']} ({m['provider']})" for m in models]
-        model_ids = [m['id'] for m in models]
-        current_index = model_ids.index(st.session_state.selected_model)
+        # Model selector nổi (api_client, models và current_model đã lấy ở sidebar cùng lượt chạy)
+        current_index = api_client.model_catalog.position(st.session_state.selected_model) or 0
+        model_names = {m['id']: m['name'] for m in models}
+        model_providers = {m['id']: m['provider'] for m in models}
         
-        selected_index = st.selectbox(
+        # Chọn theo id để lựa chọn không bị lệch khi danh mục được làm mới
+        selected_id = st.selectbox(
             "🤖 AI Model",
-            range(len(models)),
+            [m['id'] for m in models],
             index=current_index,
-            format_func=lambda x: model_options[x],
+            format_func=lambda model_id: f"{model_names.get(model_id, model_id)} ({model_providers.get(model_id, '')})",
             key="model_selector"
         )
         
-        if model_ids[selected_index] != st.session_state.selected_model:
-            st.session_state.selected_model = model_ids[selected_index]
+        if selected_id != st.session_state.selected_model:
+            st.session_state.selected_model = selected_id
             st.rerun()
         
         # File upload
@@ -658,16 +4955,41 @@ def main():
                 st.session_state.files = []
                 cols = st.columns(min(len(uploaded_files), 4))
                 
+                processed_files = {}
                 for i, file in enumerate(uploaded_files):
-                    processed_file = api_client.process_file_content(file)
+                    # Chỉ xử lý lại khi file hoặc model thay đổi, không phải mỗi lần rerun
+                    cache_key = (getattr(file, "file_id", None) or f"{file.name}:{file.size}", st.session_state.selected_model)
+                    processed_file = st.session_state.processed_files.get(cache_key)
+                    if (processed_file is None
+                            or ("blob" in processed_file and processed_file["blob"] not in api_client.blob_store)
+                            or ("document" in processed_file and get_text_document(processed_file["document"]) is None)):
+                        processed_file = api_client.process_file_content(file, st.session_state.selected_model)
                     if processed_file:
+                        api_client.refresh_pdf(processed_file)
+                        processed_files[cache_key] = processed_file
                         st.session_state.files.append(processed_file)
                         
                         with cols[i % 4]:
                             if file.type.startswith('image/'):
                                 st.image(file, width=150)
                             st.caption(f"📄 {file.name}")
-        
+                            if processed_file.get("chunks", 0) > 1:
+                                # Chọn khoảng đoạn gửi kèm thay vì luôn cắt phần đầu file
+                                first, last = st.slider(
+                                    "Đoạn gửi kèm", 1, processed_file["chunks"], (1, processed_file["chunks"]),
+                                    key=f"chunks_{cache_key[0]}",
+                                    help=(
+                                        f"File được chia {processed_file['chunks']} đoạn; gửi tối đa {TEXT_ATTACH_CHARS:,} ký tự mỗi tin nhắn."
+                                        + (" Để nguyên cả file thì CSV được gửi dạng hồ sơ cột." if processed_file.get("csv_profile") else "")
+                                    )
+                                )
+                                processed_file["selected_chunks"] = list(range(first - 1, last))
+                st.session_state.processed_files = processed_files
+
+                pending_pdfs = [f for f in st.session_state.files if f.get("category") == "pdf"]
+                if pending_pdfs:
+                    render_pdf_progress(pending_pdfs)
+
         # Chat messages
         chat_container = st.container()
         
@@ -675,52 +4997,115 @@ def main():
             if not st.session_state.messages:
                 render_welcome_screen()
             else:
-                for message in st.session_state.messages:
-                    render_message(message, current_model['name'])
+                render_history(model_names, current_model['name'])
+            # Lỗi của lượt sinh vừa kết thúc, hiện một lần dưới lịch sử
+            if st.session_state.job_error:
+                st.error(st.session_state.job_error)
+                st.session_state.job_error = None
     
     st.markdown('</div>', unsafe_allow_html=True)
     
     # Chat input (fixed at bottom)
     if st.session_state.api_key:
-        user_input = st.chat_input("💬 Nhập tin nhắn của bạn...", key="chat_input")
+        # Mỗi session chỉ một lượt sinh cùng lúc: khóa ô nhập cho tới khi lượt trước xong hoặc bị dừng
+        user_input = st.chat_input("💬 Nhập tin nhắn của bạn...", key="chat_input",
+                                   disabled=bool(st.session_state.active_job))
         
-        if user_input:
+        if user_input and st.session_state.active_job:
+            st.toast("⏳ Câu trả lời trước chưa xong: chờ hoặc bấm Dừng trả lời rồi gửi lại")
+        elif user_input:
+            # Đánh chỉ mục tài liệu text đính kèm để các lượt sau tìm lại được
+            for file_info in st.session_state.files:
+                if file_info.get("category") == "text":
+                    st.session_state.retrieval_index.add_document(file_info["document"], file_info["name"])
+
             # Add user message
             if st.session_state.files:
-                message_content = api_client.create_message_with_files(user_input, st.session_state.files)
+                message_content = api_client.create_message_with_files(user_input, st.session_state.files,
+                                                                       st.session_state.session_id)
             else:
                 message_content = user_input
             
-            user_message = {"role": "user", "content": message_content}
-            st.session_state.messages.append(user_message)
-            
-            # Show typing indicator
-            with st.empty():
-                show_typing_indicator()
-                time.sleep(1)  # Brief pause for UX
-            
-            # Get AI response
-            try:
-                response = api_client.chat_completion(
-                    messages=st.session_state.messages,
-                    model=st.session_state.selected_model,
-                    max_tokens=max_tokens if 'max_tokens' in locals() else 4000,
-                    temperature=temperature if 'temperature' in locals() else 0.7
+            user_message = {"id": str(uuid.uuid4()), "role": "user", "content": message_content}
+            save_message(user_message)
+
+            render_message(user_message)
+
+            # Chế độ so sánh: gửi song song tới các model đã chọn
+            if 'compare_models' in locals() and len(compare_models) >= 2:
+                try:
+                    compare_message = run_compare_turn(
+                        api_client,
+                        api_client.model_catalog.by_id(),
+                        compare_models,
+                        max_tokens,
+                        temperature,
+                        context_budget,
+                        pin_first,
+                        True if use_cache else None,
+                        st.session_state.retrieval_index if use_retrieval else None
+                    )
+                    if compare_message:
+                        save_message(compare_message)
+                        st.session_state.files = []
+                    else:
+                        st.error("❌ Không model nào trả lời được. Vui lòng thử lại.")
+                except Exception as e:
+                    st.error(f"❌ Lỗi: {e}")
+                st.rerun()
+
+            # Chỉ gửi phần lịch sử vừa với context của model (chừa chỗ cho các đoạn tìm được)
+            retrieval = use_retrieval if 'use_retrieval' in locals() else False
+            context_messages = select_context_window(
+                st.session_state.messages,
+                current_model.get("context_window", DEFAULT_CONTEXT_WINDOW),
+                max_tokens if 'max_tokens' in locals() else 4000,
+                budget=context_budget if 'context_budget' in locals() else None,
+                pin_first=pin_first if 'pin_first' in locals() else False,
+                reserve=RETRIEVAL_TOKEN_BUDGET if retrieval else 0
+            )
+            dropped = len(st.session_state.messages) - len(context_messages)
+            if dropped:
+                st.caption(f"✂️ Đã bỏ {dropped} tin nhắn cũ để vừa giới hạn context")
+            if retrieval:
+                context_messages, retrieved = add_retrieved_context(
+                    st.session_state.retrieval_index, st.session_state.messages, context_messages
                 )
-                
-                if response and "choices" in response:
-                    assistant_message = response["choices"][0]["message"]["content"]
-                    st.session_state.messages.append({"role": "assistant", "content": assistant_message})
-                    
-                    # Clear files after sending
-                    st.session_state.files = []
-                else:
-                    st.error("❌ Không nhận được phản hồi từ AI. Vui lòng thử lại.")
-            
-            except Exception as e:
-                st.error(f"❌ Lỗi: {e}")
-            
-            st.rerun()
+                if retrieved:
+                    st.caption(f"🔎 Đã thêm {retrieved} đoạn liên quan từ tài liệu/hội thoại trước")
+
+            # Sinh câu trả lời trên worker nền: rerun (bấm widget khác, rời trang) không bỏ request đang chạy
+            store = get_conversation_store()
+            conversation_id = st.session_state.conversation_id
+            generate_options = dict(
+                messages=context_messages,
+                model=st.session_state.selected_model,
+                max_tokens=max_tokens if 'max_tokens' in locals() else 4000,
+                temperature=temperature if 'temperature' in locals() else 0.7,
+                use_cache=True if 'use_cache' in locals() and use_cache else None,
+                fallback=use_fallback if 'use_fallback' in locals() else False,
+                session_id=st.session_state.session_id,
+                hedge=use_hedge if 'use_hedge' in locals() else False
+            )
+
+            def generate(job: GenerationJob) -> Iterator[str]:
+                return api_client.chat_completion_stream(info=job.info, on_queue=job.on_queue,
+                                                         deadline=job.deadline, on_response=job.attach_response,
+                                                         **generate_options)
+
+            def persist(job: GenerationJob):
+                # Ghi ngay trên worker để câu trả lời không mất kể cả khi session đã đóng
+                message = job.message()
+                if message is not None and store is not None and conversation_id:
+                    store.append_message(conversation_id, message)
+
+            job = get_job_manager().submit(st.session_state.session_id, st.session_state.selected_model,
+                                           generate, persist)
+            st.session_state.active_job = job.id
+
+    # Gắn vào lượt sinh đang chạy (vừa gửi, hoặc từ lần chạy trước bị rerun cắt ngang)
+    if st.session_state.api_key and st.session_state.active_job:
+        attach_job(get_job_manager(), model_names, current_model['name'])
 
 if __name__ == "__main__":
     main()
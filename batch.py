@@ -0,0 +1,276 @@
+"""Chạy hàng loạt prompt từ file JSONL qua AgentRouterAPI, không cần giao diện Streamlit.
+
+Chạy:
+    AGENTROUTER_API_KEY=sk-... python batch.py prompts.jsonl results.jsonl --concurrency 8 --rpm 120
+    python batch.py requests.jsonl results.jsonl --base-url http://127.0.0.1:8765 --api-key sk-test
+
+Mỗi dòng input là một object JSON: "id" (hoặc "request_id", mặc định là số dòng) và nội dung là
+"prompt", "messages" (danh sách message) hoặc "body" (kèm "title" nếu có, như requests.jsonl);
+có thể ghi đè "model", "max_tokens", "temperature" và thêm "system" cho từng dòng. Dòng không đọc
+được (JSON lỗi, không phải object) được ghi thành kết quả lỗi với id là số dòng, batch vẫn chạy tiếp.
+
+Kết quả được ghi ra output ngay khi từng prompt xong. Chạy lại cùng lệnh sẽ bỏ qua các id đã
+có kết quả thành công trong output (--retry-errors để chạy lại cả các dòng lỗi).
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import app
+from benchmark import format_report, percentile
+
+
+def iter_prompts(path: str) -> Iterator[Tuple[str, Optional[Dict], Optional[str]]]:
+    """Đọc từng dòng input thành (id, request, lỗi); dòng trống bị bỏ qua, dòng lỗi JSON hoặc không phải
+    object cho (số dòng, None, mô tả lỗi) để batch ghi thành kết quả lỗi thay vì dừng giữa chừng"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield str(line_number), None, f"{path}:{line_number}: JSON không hợp lệ: {e}"
+                continue
+            if not isinstance(request, dict):
+                yield (str(line_number), None,
+                       f"{path}:{line_number}: mỗi dòng phải là một JSON object, nhận {type(request).__name__}")
+                continue
+            request_id = request.get("id", request.get("request_id", line_number))
+            yield str(request_id), request, None
+
+
+def build_messages(request: Dict) -> List[Dict]:
+    """Chuyển một dòng input thành danh sách message gửi lên"""
+    if request.get("messages"):
+        messages = list(request["messages"])
+    elif "prompt" in request:
+        messages = [{"role": "user", "content": request["prompt"]}]
+    elif "body" in request:
+        title = request.get("title")
+        text = f"{title}\n\n{request['body']}" if title else request["body"]
+        messages = [{"role": "user", "content": text}]
+    else:
+        raise ValueError("thiếu prompt, messages hoặc body")
+    if request.get("system"):
+        messages.insert(0, {"role": "system", "content": request["system"]})
+    return messages
+
+
+def load_finished(path: str, retry_errors: bool) -> Set[str]:
+    """Id đã có kết quả trong output (chỉ tính kết quả thành công nếu retry_errors); bỏ qua dòng ghi dở"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Dòng cuối bị cắt ngang khi process dừng đột ngột
+                continue
+            if result.get("status") == "ok" or not retry_errors:
+                finished.add(str(result.get("id")))
+    return finished
+
+
+class ResultWriter:
+    """Ghi kết quả JSONL theo kiểu append, mỗi dòng được flush ngay để resume được sau crash"""
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(path, "a", encoding="utf-8")
+        if needs_newline:
+            # Dòng cuối ghi dở: xuống dòng để kết quả mới không dính vào nó
+            self._file.write("\n")
+
+    def write(self, result: Dict):
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def run_prompt(api: app.AgentRouterAPI, request_id: str, request: Dict, args) -> Dict:
+    """Gửi một prompt (stream để có TTFT), trả về dòng kết quả; lỗi được ghi vào kết quả thay vì ném ra"""
+    model = request.get("model", args.model)
+    info = {}
+    result = {"id": request_id, "model": model}
+    start = time.perf_counter()
+    try:
+        text = "".join(api.chat_completion_stream(
+            build_messages(request), model,
+            max_tokens=request.get("max_tokens", args.max_tokens),
+            temperature=request.get("temperature", args.temperature),
+            fallback=args.fallback, info=info, session_id=request_id, hedge=args.hedge
+        ))
+        result.update(status="ok", output=text)
+    except (app.AgentRouterError, ValueError) as e:
+        result.update(status="error", error=str(e))
+    except Exception as e:
+        # Lỗi bất ngờ của một dòng (vd. messages sai dạng) không được làm dừng cả batch
+        result.update(status="error", error=f"{type(e).__name__}: {e}")
+    result["latency_seconds"] = time.perf_counter() - start
+    for name in ("queue_seconds", "ttft_seconds", "prompt_tokens", "completion_tokens",
+                 "cache_read_tokens", "attempts", "hedged", "hedge_won"):
+        if info.get(name) is not None:
+            result[name] = info[name]
+    if info.get("model") and info["model"] != model:
+        result["answered_by"] = info["model"]
+    result["finished_at"] = time.time()
+    return result
+
+
+def run_batch(args) -> Dict:
+    api_key = args.api_key or os.environ.get("AGENTROUTER_API_KEY", "")
+    if not api_key:
+        raise SystemExit("Thiếu API key: dùng --api-key hoặc biến môi trường AGENTROUTER_API_KEY")
+
+    # Scheduler giữ cả giới hạn đồng thời lẫn hạn mức request/phút (tính cả lần thử lại);
+    # batch chờ bao lâu cũng được nên không đặt max_wait
+    scheduler = app.UpstreamScheduler(
+        max_concurrency=args.concurrency, rpm=args.rpm, burst=args.burst or args.concurrency,
+        max_wait=float("inf")
+    )
+    api = app.AgentRouterAPI(
+        api_key, args.base_url or app.DEFAULT_BASE_URL,
+        session=app.create_http_session(pool_size=max(args.concurrency, app.HTTP_POOL_SIZE)),
+        metrics=app.MetricsRegistry(),
+        scheduler=scheduler,
+        hedge_budget=app.HedgeBudget()
+    )
+
+    finished = load_finished(args.output, args.retry_errors)
+    writer = ResultWriter(args.output)
+    latencies, ttfts = [], []
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    tokens = {"prompt_tokens": 0, "completion_tokens": 0}
+    seen = set()
+    start = time.perf_counter()
+
+    def record(result: Dict):
+        writer.write(result)
+        counts[result["status"]] += 1
+        if result["status"] == "ok":
+            latencies.append(result["latency_seconds"])
+            if result.get("ttft_seconds") is not None:
+                ttfts.append(result["ttft_seconds"])
+            for name in tokens:
+                tokens[name] += result.get(name) or 0
+        done = counts["ok"] + counts["error"]
+        if args.progress and done % args.progress == 0:
+            elapsed = time.perf_counter() - start
+            print(f"[{done}] {counts['ok']} ok, {counts['error']} lỗi, {done / elapsed:.2f} prompt/giây",
+                  file=sys.stderr, flush=True)
+
+    interrupted = False
+    # Giữ số prompt đang chờ ở mức vừa đủ để không đọc cả file vào bộ nhớ
+    max_pending = args.concurrency * 2
+    pending = set()
+
+    def collect(limit: int):
+        """Ghi kết quả các prompt đã xong cho tới khi còn tối đa limit prompt đang chờ"""
+        nonlocal pending
+        while len(pending) > limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if not future.cancelled():
+                    record(future.result())
+
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch")
+    try:
+        for request_id, request, error in iter_prompts(args.input):
+            if request_id in finished or request_id in seen:
+                counts["skipped"] += 1
+                continue
+            seen.add(request_id)
+            if args.limit and len(seen) > args.limit:
+                break
+            if error is not None:
+                record({"id": request_id, "status": "error", "error": error, "finished_at": time.time()})
+                continue
+            collect(max_pending - 1)
+            pending.add(executor.submit(run_prompt, api, request_id, request, args))
+        collect(0)
+    except KeyboardInterrupt:
+        # Prompt đang chạy vẫn được ghi; prompt chưa chạy sẽ được chạy ở lần resume
+        interrupted = True
+        for future in pending:
+            future.cancel()
+        collect(0)
+    except BaseException:
+        # Lỗi khác (vd. không đọc được input): prompt đã gửi vẫn được chờ và ghi kết quả rồi mới báo lỗi
+        collect(0)
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        writer.close()
+    wall = time.perf_counter() - start
+
+    completed = counts["ok"] + counts["error"]
+    return {
+        "mode": "batch",
+        "completed": completed,
+        "ok": counts["ok"],
+        "errors": counts["error"],
+        "skipped": counts["skipped"],
+        "interrupted": interrupted,
+        "wall_seconds": wall,
+        "throughput_rps": completed / wall if wall else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "prompt_tokens": tokens["prompt_tokens"],
+        "completion_tokens": tokens["completion_tokens"],
+        "queue": scheduler.stats(),
+        "hedge": api.hedge_budget.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chạy hàng loạt prompt JSONL qua AgentRouter")
+    parser.add_argument("input", help="File JSONL chứa prompt")
+    parser.add_argument("output", help="File JSONL kết quả (ghi tiếp, dùng để resume)")
+    parser.add_argument("--api-key", default="", help="Mặc định lấy từ AGENTROUTER_API_KEY")
+    parser.add_argument("--base-url", default="", help="Mặc định AGENTROUTER_BASE_URL hoặc agentrouter.org")
+    parser.add_argument("--model", default="claude-sonnet-4-20250514", help="Model mặc định cho dòng không ghi model")
+    parser.add_argument("--max-tokens", type=int, default=4000)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--concurrency", type=int, default=8, help="Số request đồng thời tối đa")
+    parser.add_argument("--rpm", type=float, default=app.RATE_LIMIT_RPM, help="Hạn mức request/phút (0 = không giới hạn)")
+    parser.add_argument("--burst", type=int, default=0, help="Số request gửi dồn tối đa (mặc định bằng --concurrency)")
+    parser.add_argument("--fallback", action="store_true", help="Bật model dự phòng khi lỗi")
+    parser.add_argument("--hedge", action="store_true", help="Gửi thêm request khi phản hồi chậm hơn p95 gần đây")
+    parser.add_argument("--retry-errors", action="store_true", help="Khi resume, chạy lại cả các dòng đã lỗi")
+    parser.add_argument("--limit", type=int, default=0, help="Chỉ chạy tối đa N prompt mới (0 = tất cả)")
+    parser.add_argument("--progress", type=int, default=50, help="In tiến độ sau mỗi N prompt (0 = tắt)")
+    parser.add_argument("--json", default="", help="Ghi báo cáo ra file JSON")
+    args = parser.parse_args()
+    args.concurrency = max(1, args.concurrency)
+
+    report = run_batch(args)
+    print(format_report({k: v for k, v in report.items() if k not in ("queue", "hedge")}))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if report["interrupted"]:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Benchmark offline: nhiều session giả lập gửi tới mock server (hoặc upstream thật).
+
+Chạy:
+    python benchmark.py --sessions 20 --turns 5 --history 40 --images 1 --image-side 3000
+    python benchmark.py --apptest 4 --turns 3
+    python benchmark.py --base-url http://127.0.0.1:8765 --json report.json
+
+Báo cáo throughput, p50/p95/p99 latency, TTFT và thời gian serialize body, peak RSS, byte gửi/nhận.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+import mock_server
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+class BenchmarkFile:
+    """File giả lập theo giao diện UploadedFile mà AgentRouterAPI.process_file_content dùng"""
+    def __init__(self, name: str, type: str, data: bytes):
+        self.name = name
+        self.type = type
+        self.size = len(data)
+        self._data = data
+
+    def getvalue(self) -> bytes:
+        return self._data
+
+
+def make_image(side: int) -> bytes:
+    """Ảnh PNG nhiễu kích thước side x side (khó nén như ảnh chụp thật)"""
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def make_history(length: int, words: int = 60) -> List[Dict]:
+    """Lịch sử hội thoại dài, xen kẽ user/assistant"""
+    text = " ".join(f"word{i}" for i in range(words))
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"Turn {i}: {text}"}
+        for i in range(length)
+    ]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """Peak RSS của process (RUSAGE_CHILDREN: process con lớn nhất đã kết thúc;
+    ru_maxrss tính bằng KB trên Linux, byte trên macOS)"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_api_benchmark(args, base_url: str) -> Dict:
+    """Mỗi session là một luồng gửi liên tiếp các lượt qua AgentRouterAPI dùng chung (như get_api_client)"""
+    import app
+
+    api = app.AgentRouterAPI(
+        "sk-benchmark", base_url,
+        session=app.create_http_session(pool_size=max(args.sessions, app.HTTP_POOL_SIZE)),
+        metrics=app.MetricsRegistry(log_path="")
+    )
+    image = make_image(args.image_side) if args.images else None
+    results = []
+    results_lock = threading.Lock()
+
+    def run_session(session_index: int):
+        messages = make_history(args.history)
+        for turn in range(args.turns):
+            files = []
+            for i in range(args.images):
+                upload = BenchmarkFile(f"image_{session_index}_{turn}_{i}.png", "image/png", image)
+                files.append(api.process_file_content(upload, args.model))
+            content = api.create_message_with_files(f"Session {session_index} turn {turn}", files)
+            messages.append({"role": "user", "content": content})
+            context = app.select_context_window(messages, app.DEFAULT_CONTEXT_WINDOW, args.max_tokens)
+
+            info = {}
+            start = time.perf_counter()
+            error = None
+            try:
+                if args.no_stream:
+                    result = api.chat_completion(
+                        context, args.model, args.max_tokens, fallback=args.fallback, info=info, hedge=args.hedge
+                    )
+                    if result is None:
+                        # chat_completion không ném lỗi mà trả về None, nguyên nhân nằm trong info
+                        raise app.AgentRouterError(info.get("error", "❌ Không nhận được phản hồi"))
+                    reply = result["choices"][0]["message"]["content"]
+                else:
+                    reply = "".join(api.chat_completion_stream(
+                        context, args.model, args.max_tokens, fallback=args.fallback, info=info, hedge=args.hedge
+                    ))
+            except app.AgentRouterError as e:
+                reply, error = "", str(e)
+            elapsed = time.perf_counter() - start
+            if error:
+                # Lượt lỗi không để lại câu trả lời rỗng trong lịch sử
+                messages.pop()
+            else:
+                messages.append({"role": "assistant", "content": reply})
+
+            with results_lock:
+                results.append({
+                    "latency": elapsed,
+                    "ttft": info.get("ttft_seconds"),
+                    "serialize": info.get("serialize_seconds"),
+                    "request_bytes": info.get("request_bytes", 0),
+                    "response_bytes": info.get("response_bytes", 0),
+                    "error": error,
+                })
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        for future in [executor.submit(run_session, i) for i in range(args.sessions)]:
+            future.result()
+    wall = time.perf_counter() - start
+
+    latencies = [r["latency"] for r in results if not r["error"]]
+    ttfts = [r["ttft"] for r in results if r["ttft"] is not None]
+    serialize = [r["serialize"] for r in results if r["serialize"] is not None]
+    return {
+        "mode": "api",
+        "sessions": args.sessions,
+        "turns": len(results),
+        "errors": sum(1 for r in results if r["error"]),
+        "wall_seconds": wall,
+        "throughput_rps": len(results) / wall if wall else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "serialize_p50": percentile(serialize, 50),
+        "serialize_p95": percentile(serialize, 95),
+        "request_bytes": sum(r["request_bytes"] for r in results),
+        "response_bytes": sum(r["response_bytes"] for r in results),
+        "hedged": api.hedge_budget.stats()["hedged"],
+        "hedge_won": api.hedge_budget.stats()["won"],
+    }
+
+
+def run_apptest_session(session_index: int, turns: int, timeout: float, base_url: str) -> Tuple[List[float], List[str]]:
+    """Một session AppTest trong process riêng; trả về (thời gian từng lượt, lỗi). Lỗi khi chạy
+    (kể cả exception của chính AppTest) được trả về như một lỗi thay vì làm hỏng cả benchmark"""
+    from streamlit.testing.v1 import AppTest
+
+    os.environ["AGENTROUTER_BASE_URL"] = base_url
+    run_times, errors = [], []
+    try:
+        at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        at.run()
+        at.sidebar.text_input[0].input(f"sk-benchmark-{session_index}").run()
+        for turn in range(turns):
+            start = time.perf_counter()
+            at.chat_input[0].set_value(f"Session {session_index} turn {turn}").run()
+            run_times.append(time.perf_counter() - start)
+            errors.extend(str(e.value) for e in at.error)
+            errors.extend(str(e.value) for e in at.exception)
+    except Exception as e:
+        errors.append(f"{type(e).__name__}: {e}")
+    return run_times, errors
+
+
+def run_apptest_benchmark(args, base_url: str) -> Dict:
+    """Chạy chính script Streamlit bằng AppTest, mỗi session là một AppTest riêng trong một process:
+    AppTest dựa vào Runtime toàn cục của Streamlit nên không chạy song song được trên nhiều luồng"""
+    import multiprocessing
+
+    run_times = []
+    errors = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.apptest, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(run_apptest_session, i, args.turns, args.timeout, base_url)
+            for i in range(args.apptest)
+        ]
+        for future in futures:
+            try:
+                session_times, session_errors = future.result()
+            except Exception as e:
+                # Process con chết giữa chừng
+                session_times, session_errors = [], [f"{type(e).__name__}: {e}"]
+            run_times.extend(session_times)
+            errors.extend(session_errors)
+    wall = time.perf_counter() - start
+
+    return {
+        "mode": "apptest",
+        "sessions": args.apptest,
+        "turns": len(run_times),
+        "errors": len(errors),
+        "wall_seconds": wall,
+        "throughput_rps": len(run_times) / wall if wall else 0.0,
+        "latency_p50": percentile(run_times, 50),
+        "latency_p95": percentile(run_times, 95),
+        "latency_p99": percentile(run_times, 99),
+        "session_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def format_report(report: Dict) -> str:
+    lines = []
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        elif value is None:
+            value = "-"
+        lines.append(f"{key:>18}: {value}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AgentRouter chat")
+    parser.add_argument("--base-url", default="", help="Upstream có sẵn; để trống để chạy mock server trong process")
+    parser.add_argument("--sessions", type=int, default=10, help="Số session đồng thời gọi AgentRouterAPI")
+    parser.add_argument("--turns", type=int, default=5, help="Số lượt chat mỗi session")
+    parser.add_argument("--history", type=int, default=20, help="Số tin nhắn có sẵn trong lịch sử mỗi session")
+    parser.add_argument("--images", type=int, default=0, help="Số ảnh đính kèm mỗi lượt")
+    parser.add_argument("--image-side", type=int, default=2048, help="Cạnh ảnh gốc (px)")
+    parser.add_argument("--model", default="claude-sonnet-4-20250514")
+    parser.add_argument("--max-tokens", type=int, default=1000)
+    parser.add_argument("--no-stream", action="store_true", help="Dùng chat_completion thay vì stream")
+    parser.add_argument("--fallback", action="store_true", help="Bật model dự phòng khi lỗi")
+    parser.add_argument("--hedge", action="store_true", help="Gửi thêm request khi phản hồi chậm hơn p95 gần đây")
+    parser.add_argument("--apptest", type=int, default=0, help="Số session chạy script Streamlit qua AppTest (0 = bỏ qua)")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout mỗi lần chạy AppTest (giây)")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Mock: độ trễ giữa các token")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock: độ trễ trước khi trả lời")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="Mock: độ trễ ngẫu nhiên cộng thêm")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Mock: tỉ lệ request lỗi")
+    parser.add_argument("--json", default="", help="Ghi báo cáo ra file JSON")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        server = mock_server.create_server(
+            port=0, token_delay=args.token_delay, latency=args.latency,
+            latency_jitter=args.latency_jitter, error_rate=args.error_rate, echo_payload=True
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    reports = []
+    phases = []
+    if args.sessions:
+        phases.append(run_api_benchmark)
+    if args.apptest:
+        phases.append(run_apptest_benchmark)
+    try:
+        for phase in phases:
+            before = server.stats() if server is not None else None
+            report = phase(args, base_url)
+            # Peak RSS tính cho cả process nên là mức cao nhất tới hết phase này
+            report["peak_rss_mb"] = peak_rss_mb()
+            if server is not None:
+                after = server.stats()
+                report["server"] = {name: after[name] - before[name] for name in after}
+            reports.append(report)
+            print(format_report(report))
+            print()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Server giả lập Redis (giao thức RESP2, RESP3 khi client xin qua HELLO) cho backend trạng thái dùng chung, dùng khi chạy offline.
+
+Chạy:
+    python mock_redis.py --port 6390
+    STATE_BACKEND=redis://127.0.0.1:6390/0 streamlit run app.py --server.port 8501
+    STATE_BACKEND=redis://127.0.0.1:6390/0 streamlit run app.py --server.port 8502
+
+Chỉ hỗ trợ các lệnh mà RedisStateBackend (app.py) dùng, cộng vài lệnh client gửi khi kết nối.
+Dữ liệu nằm trong RAM, mất khi dừng server.
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class RedisError(Exception):
+    """Lỗi trả về cho client dưới dạng -ERR"""
+
+
+class MockRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        resp3 = False
+        while True:
+            try:
+                command = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            try:
+                reply = self.server.execute(command)
+                if command[0].upper() == b"HELLO":
+                    resp3 = isinstance(reply, dict)
+            except RedisError as e:
+                reply = e
+            self.wfile.write(encode(reply, resp3))
+            self.wfile.flush()
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Lệnh inline (vd. gõ tay qua telnet)
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            header = self.rfile.readline()
+            if not header.startswith(b"$"):
+                raise ValueError("bulk string không hợp lệ")
+            length = int(header[1:])
+            args.append(self.rfile.read(length + 2)[:length])
+        return args
+
+
+def encode(value, resp3: bool = False) -> bytes:
+    """Mã hóa kết quả: str là simple string, bytes là bulk string; RESP2 và RESP3 chỉ khác ở null và map"""
+    if isinstance(value, RedisError):
+        return f"-ERR {value}\r\n".encode("utf-8")
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, bool):
+        return b":1\r\n" if value else b":0\r\n"
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode("utf-8")
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item, resp3) for item in value)
+    if isinstance(value, dict):
+        # Map của RESP3, chỉ dùng cho HELLO 3
+        return b"%%%d\r\n" % len(value) + b"".join(
+            encode(key, resp3) + encode(item, resp3) for key, item in value.items()
+        )
+    raise TypeError(f"Không mã hóa được {type(value)}")
+
+
+class MockRedisServer(socketserver.ThreadingTCPServer):
+    """ThreadingTCPServer giữ dữ liệu kiểu Redis (chuỗi và danh sách) kèm hạn sống theo key"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, MockRedisHandler)
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+        self.commands = 0
+
+    def _live(self, key: bytes):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    def _list(self, key: bytes) -> list:
+        value = self._live(key)
+        if value is not None and not isinstance(value, list):
+            raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def execute(self, args):
+        if not args:
+            raise RedisError("empty command")
+        name = args[0].decode().upper()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            raise RedisError(f"unknown command '{name}'")
+        with self._lock:
+            self.commands += 1
+            return handler(*args[1:])
+
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_hello(self, protover=b"2", *args):
+        """Bắt tay của client mới (redis-py >= 5 mặc định xin RESP3); các reply khác giống nhau ở hai phiên bản"""
+        info = {b"server": b"redis", b"version": b"7.0.0", b"proto": int(protover), b"id": 1,
+                b"mode": b"standalone", b"role": b"master", b"modules": []}
+        if int(protover) == 3:
+            return info
+        return [item for pair in info.items() for item in pair]
+
+    def cmd_client(self, *args):
+        return "OK"
+
+    def cmd_select(self, index):
+        return "OK"
+
+    def cmd_flushdb(self, *args):
+        self._data.clear()
+        self._expires.clear()
+        return "OK"
+
+    def cmd_dbsize(self):
+        return sum(1 for key in list(self._data) if self._live(key) is not None)
+
+    def cmd_get(self, key):
+        value = self._live(key)
+        if isinstance(value, list):
+            raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def cmd_set(self, key, value, *options):
+        options = [option.decode().upper() for option in options]
+        ttl = None
+        if "EX" in options:
+            ttl = float(options[options.index("EX") + 1])
+        elif "PX" in options:
+            ttl = float(options[options.index("PX") + 1]) / 1000
+        self._data[key] = value
+        self._expires.pop(key, None)
+        if ttl is not None:
+            self._expires[key] = time.time() + ttl
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._live(key) is not None:
+                removed += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._live(key) is not None)
+
+    def cmd_pexpire(self, key, milliseconds):
+        if self._live(key) is None:
+            return 0
+        self._expires[key] = time.time() + int(milliseconds) / 1000
+        return 1
+
+    def cmd_expire(self, key, seconds):
+        return self.cmd_pexpire(key, int(seconds) * 1000)
+
+    def cmd_persist(self, key):
+        if self._live(key) is None or key not in self._expires:
+            return 0
+        del self._expires[key]
+        return 1
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b"1")
+
+    def cmd_incrby(self, key, amount):
+        value = self._live(key)
+        try:
+            value = int(value or 0) + int(amount)
+        except (TypeError, ValueError):
+            raise RedisError("value is not an integer or out of range")
+        self._data[key] = str(value).encode()
+        return value
+
+    def cmd_rpush(self, key, *values):
+        items = self._list(key)
+        if items is None:
+            items = self._data[key] = []
+        items.extend(values)
+        return len(items)
+
+    def cmd_lrange(self, key, start, stop):
+        items = self._list(key) or []
+        start, stop = int(start), int(stop)
+        start = max(0, len(items) + start) if start < 0 else start
+        stop = len(items) + stop if stop < 0 else stop
+        return items[start:stop + 1] if stop >= 0 else []
+
+    def cmd_llen(self, key):
+        return len(self._list(key) or [])
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._list(key)
+        if items is not None:
+            self._data[key] = self.cmd_lrange(key, start, stop)
+        return "OK"
+
+
+def create_server(host: str = "127.0.0.1", port: int = 6390) -> MockRedisServer:
+    """Tạo server giả lập Redis (port=0 để chọn port ngẫu nhiên)"""
+    return MockRedisServer((host, port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Redis server cho STATE_BACKEND")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port)
+    print(f"Mock Redis đang chạy tại redis://{args.host}:{server.server_address[1]}/0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
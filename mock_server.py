@@ -0,0 +1,304 @@
+"""Mock server cho AgentRouter /v1/chat/completions, dùng để chạy app offline.
+
+Chạy:
+    python mock_server.py --port 8765
+    AGENTROUTER_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+
+Mô phỏng được độ trễ upstream (--latency, --latency-jitter), tỉ lệ lỗi (--error-rate),
+prompt cache theo breakpoint cache_control (token đọc/ghi trong usage và /stats)
+và trả lại thống kê payload nhận được (--echo-payload) để chạy benchmark.py.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Danh sách trả về ở /v1/models (ghi đè bằng --models)
+MOCK_MODELS = [
+    ("claude-sonnet-4-20250514", "anthropic"),
+    ("claude-opus-4-20250514", "anthropic"),
+    ("claude-opus-4-1-20250805", "anthropic"),
+    ("claude-3-5-haiku-20241022", "anthropic"),
+    ("gpt-5", "openai"),
+    ("glm-4.5", "zhipu"),
+]
+
+
+def last_user_text(messages) -> str:
+    """Lấy nội dung text của tin nhắn user cuối cùng"""
+    for message in reversed(messages or []):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, list):
+            return "".join(item.get("text", "") for item in content if item.get("type") == "text")
+        return content or ""
+    return ""
+
+
+def prompt_blocks(payload: dict):
+    """Các block của prompt theo thứ tự: (block đã bỏ cache_control dạng JSON, số token, có breakpoint không)"""
+    for message in payload.get("messages") or []:
+        content = message.get("content")
+        blocks = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for block in blocks:
+            stripped = {key: value for key, value in block.items() if key != "cache_control"}
+            encoded = json.dumps([message.get("role"), stripped], sort_keys=True)
+            yield encoded, len(encoded.split()), "cache_control" in block
+
+
+def usage_for(payload: dict, reply: str, cache_read: int = 0, cache_write: int = 0) -> dict:
+    """Usage giả lập: mỗi từ tính là một token; như Anthropic, prompt_tokens không gồm token đọc/ghi cache"""
+    prompt_tokens = sum(tokens for _, tokens, _ in prompt_blocks(payload))
+    completion_tokens = len(reply.split())
+    usage = {
+        "prompt_tokens": prompt_tokens - cache_read - cache_write,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+    if cache_read or cache_write:
+        usage["cache_read_input_tokens"] = cache_read
+        usage["cache_creation_input_tokens"] = cache_write
+    return usage
+
+
+def payload_summary(payload: dict, size: int) -> str:
+    """Tóm tắt payload nhận được: số byte, số message và số ảnh"""
+    messages = payload.get("messages") or []
+    images = sum(
+        1 for message in messages if isinstance(message.get("content"), list)
+        for item in message["content"] if item.get("type") in ("image", "image_url")
+    )
+    return f"[payload {size} bytes, {len(messages)} messages, {images} images]"
+
+
+class MockAgentRouterHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 + chunked để client nhận từng event ngay khi gửi
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats())
+        elif self.path == "/v1/models":
+            self.server.count(requests=1)
+            self._send_json(200, {
+                "object": "list",
+                "data": [
+                    {"id": model_id, "object": "model", "created": 0, "owned_by": owner}
+                    for model_id, owner in self.server.models
+                ]
+            })
+        else:
+            self._send_json(404, {"error": {"message": f"Not found: {self.path}"}})
+
+    def do_POST(self):
+        if self.path != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Not found: {self.path}"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.server.count(requests=1, bytes_in=len(body))
+        try:
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            payload = json.loads(body or b"{}")
+        except (OSError, json.JSONDecodeError) as e:
+            self._send_json(400, {"error": {"message": f"Invalid body: {e}"}})
+            return
+
+        server = self.server
+        if server.latency or server.latency_jitter:
+            time.sleep(server.latency + random.uniform(0, server.latency_jitter))
+        if server.error_rate and random.random() < server.error_rate:
+            server.count(errors=1)
+            self._send_json(server.error_status, {"error": {"message": "Mock upstream overloaded"}},
+                            {"Retry-After": "0"} if server.error_status in (429, 503) else None)
+            return
+
+        reply = f"Echo: {last_user_text(payload.get('messages'))}"
+        if server.echo_payload:
+            reply += f" {payload_summary(payload, len(body))}"
+        cache_read, cache_write = server.prompt_cache(payload)
+        if payload.get("stream"):
+            self._send_stream(payload, reply, usage_for(payload, reply, cache_read, cache_write))
+        else:
+            time.sleep(self.server.token_delay * len(reply.split()))
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage_for(payload, reply, cache_read, cache_write)
+            })
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(bytes_out=len(data))
+
+    def _send_stream(self, payload: dict, reply: str, usage: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        self._write_chunk(b": keep-alive\n\n")
+        for i, word in enumerate(reply.split(" ")):
+            time.sleep(self.server.token_delay)
+            event = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else f" {word}"}}]
+            }
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            event = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": payload.get("model"),
+                "choices": [],
+                "usage": usage
+            }
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes):
+        chunk = f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n"
+        self.wfile.write(chunk)
+        self.wfile.flush()
+        self.server.count(bytes_out=len(chunk))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MockAgentRouterServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer kèm cấu hình mô phỏng và bộ đếm request/byte"""
+    daemon_threads = True
+
+    def __init__(self, address, token_delay: float = 0.05, latency: float = 0.0,
+                 latency_jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 503,
+                 echo_payload: bool = False, verbose: bool = False, models=None):
+        super().__init__(address, MockAgentRouterHandler)
+        self.models = list(models) if models is not None else list(MOCK_MODELS)
+        self.token_delay = token_delay
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.echo_payload = echo_payload
+        self.verbose = verbose
+        self._counters = {
+            "requests": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0,
+            "cache_read_tokens": 0, "cache_write_tokens": 0
+        }
+        self._cached_prefixes = set()
+        self._lock = threading.Lock()
+
+    def count(self, **deltas):
+        with self._lock:
+            for name, value in deltas.items():
+                self._counters[name] += value
+
+    def prompt_cache(self, payload: dict):
+        """Mô phỏng prompt cache theo model: trả về (token đọc từ cache, token ghi vào cache).
+
+        Mỗi breakpoint cache_control lưu prefix tới block đó; request sau đọc được prefix dài nhất
+        đã lưu và ghi thêm phần từ đó tới breakpoint cuối.
+        """
+        digest = hashlib.sha256(str(payload.get("model")).encode("utf-8"))
+        tokens = 0
+        breakpoints = []
+        for encoded, block_tokens, marked in prompt_blocks(payload):
+            digest.update(encoded.encode("utf-8"))
+            tokens += block_tokens
+            if marked:
+                breakpoints.append((digest.hexdigest(), tokens))
+        if not breakpoints:
+            return 0, 0
+
+        with self._lock:
+            read = max((tokens for key, tokens in breakpoints if key in self._cached_prefixes), default=0)
+            write = breakpoints[-1][1] - read
+            if len(self._cached_prefixes) > 100000:
+                self._cached_prefixes.clear()
+            self._cached_prefixes.update(key for key, _ in breakpoints)
+            self._counters["cache_read_tokens"] += read
+            self._counters["cache_write_tokens"] += write
+        return read, write
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    def handle_error(self, request, client_address):
+        # Client đóng kết nối keep-alive hoặc hủy stream giữa chừng là chuyện bình thường
+        if self.verbose:
+            super().handle_error(request, client_address)
+
+
+def create_server(host: str = "127.0.0.1", port: int = 8765, token_delay: float = 0.05,
+                  verbose: bool = False, latency: float = 0.0, latency_jitter: float = 0.0,
+                  error_rate: float = 0.0, error_status: int = 503,
+                  echo_payload: bool = False, models=None) -> MockAgentRouterServer:
+    """Tạo mock server (port=0 để chọn port ngẫu nhiên); models là danh sách (id, owned_by) cho /v1/models"""
+    return MockAgentRouterServer(
+        (host, port), token_delay=token_delay, latency=latency, latency_jitter=latency_jitter,
+        error_rate=error_rate, error_status=error_status, echo_payload=echo_payload, verbose=verbose,
+        models=models
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock AgentRouter server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token-delay", type=float, default=0.05, help="Độ trễ giữa các token (giây)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Độ trễ trước khi trả lời (giây)")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="Độ trễ ngẫu nhiên cộng thêm tối đa (giây)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request trả lỗi (0-1)")
+    parser.add_argument("--error-status", type=int, default=503, help="Mã HTTP khi trả lỗi")
+    parser.add_argument("--echo-payload", action="store_true", help="Thêm thống kê payload vào câu trả lời")
+    parser.add_argument("--models", default="", help="Danh sách id model cho /v1/models, cách nhau bởi dấu phẩy")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = create_server(
+        args.host, args.port, args.token_delay, args.verbose, latency=args.latency,
+        latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+        error_status=args.error_status, echo_payload=args.echo_payload,
+        models=[(model_id.strip(), "mock") for model_id in args.models.split(",") if model_id.strip()] or None
+    )
+    print(f"Mock AgentRouter đang chạy tại http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""Trích xuất text PDF trong process con của PdfExtractor (app.py).
+
+Module riêng, không import streamlit, để process con khởi động nhanh và pickle được hàm.
+"""
+from typing import List
+
+
+def count_pages(path: str) -> int:
+    """Số trang của file PDF"""
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def extract_pages(path: str, start: int, stop: int) -> List[str]:
+    """Text của các trang [start, stop); trang lỗi trả về chuỗi rỗng thay vì làm hỏng cả lô"""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    texts = []
+    for index in range(start, min(stop, len(reader.pages))):
+        try:
+            texts.append(reader.pages[index].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
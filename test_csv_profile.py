@@ -0,0 +1,41 @@
+"""Kiểm tra hồ sơ CSV gửi kèm tin nhắn.
+
+Chạy: python -m pytest -q test_csv_profile.py
+"""
+import io
+
+import app
+
+
+CSV = b"""id,city,created,signed_up
+1,Hanoi,2024-03-05 08:30:00,2024-03-05
+2,Hue,2023-11-20 17:05:10,2023-11-20
+3,Hanoi,2024-01-01 00:00:00,2024-01-01
+4,,,
+"""
+
+
+def _row(text: str, column: str) -> str:
+    return next(line for line in text.splitlines() if line.startswith(f"| {column} |"))
+
+
+def test_temporal_columns_show_min_max():
+    text = app.format_csv_profile("users.csv", app.profile_csv(io.BytesIO(CSV)))
+
+    created = _row(text, "created")
+    assert "| thời gian | 1 |" in created
+    assert "min 2023-11-20 17:05:10" in created
+    assert "max 2024-03-05 08:30:00" in created
+
+    signed_up = _row(text, "signed_up")
+    assert "| thời gian | 1 |" in signed_up
+    assert "min 2023-11-20" in signed_up
+    assert "max 2024-03-05" in signed_up
+
+
+def test_numeric_and_text_columns_unchanged():
+    text = app.format_csv_profile("users.csv", app.profile_csv(io.BytesIO(CSV)))
+
+    assert text.startswith("📊 **Hồ sơ CSV: users.csv** (4 dòng × 4 cột)")
+    assert "min 1, max 4, TB 2.5" in _row(text, "id")
+    assert "phổ biến: Hanoi (2)" in _row(text, "city")